@@ -0,0 +1,116 @@
+'''
+    Standalone entry points, run from src/:
+      python -m app api [--workers N]        Local Allocation Manager API only
+      python -m app consumer [--processes N]  Kafka loop only, N consumers in the same group
+    The API scales with uvicorn workers and the kafka loop with processes, independently.
+    "uvicorn main:app" keeps running both in one process.
+'''
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+def _consumer_process():
+    '''
+    One kafka consumer process, stopped gracefully on SIGTERM
+    '''
+    from app import loop  # pylint: disable=import-outside-toplevel
+
+    def stop(_signum, _frame):
+        if loop.supervisor is not None:
+            loop.supervisor.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    loop.run()
+
+
+def run_consumers(processes: int):
+    '''
+    Run processes kafka consumers, restarting any that dies
+    '''
+    children = {}
+    stopping = False
+
+    def start(index):
+        process = multiprocessing.Process(target=_consumer_process,
+                                          name=f"de-consumer-{index}")
+        process.start()
+        children[index] = process
+        logger.info("Started kafka consumer process %s (pid %s)", index,
+                    process.pid)
+
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for process in children.values():
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(processes):
+        start(index)
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(children.items()):
+            if not process.is_alive() and not stopping:
+                logger.error(
+                    "Kafka consumer process %s exited with %s, restarting",
+                    index, process.exitcode)
+                start(index)
+    for process in children.values():
+        process.join()
+
+
+def run_api(host: str, port: int, workers: int):
+    '''
+    Run the FastAPI app without the embedded kafka loop
+    '''
+    import uvicorn  # pylint: disable=import-outside-toplevel
+    from app import config  # pylint: disable=import-outside-toplevel
+
+    # app.config is already imported here (python -m app imports the package first),
+    #   the environment covers the worker processes started with --workers > 1
+    os.environ['EMBEDDED_CONSUMER'] = 'false'
+    config.EMBEDDED_CONSUMER = False
+    uvicorn.run("app:app", host=host, port=port, workers=workers)
+
+
+def main():
+    '''
+    Parse command line and run the selected mode
+    '''
+    parser = argparse.ArgumentParser(prog="python -m app",
+                                     description="HLO Deployment Engine")
+    modes = parser.add_subparsers(dest="mode", required=True)
+    api_parser = modes.add_parser("api",
+                                  help="Local Allocation Manager REST API")
+    api_parser.add_argument("--host", default="0.0.0.0")
+    api_parser.add_argument("--port", type=int, default=8000)
+    api_parser.add_argument("--workers",
+                            type=int,
+                            default=int(os.environ.get('API_WORKERS', '1')))
+    consumer_parser = modes.add_parser("consumer",
+                                       help="Kafka deployment loop")
+    consumer_parser.add_argument("--processes",
+                                 type=int,
+                                 default=int(
+                                     os.environ.get('CONSUMER_PROCESSES',
+                                                    '1')))
+    args = parser.parse_args()
+
+    if args.mode == "api":
+        run_api(args.host, args.port, args.workers)
+    elif args.processes > 1:
+        run_consumers(args.processes)
+    else:
+        _consumer_process()
+
+
+if __name__ == "__main__":
+    main()
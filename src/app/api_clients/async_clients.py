@@ -0,0 +1,78 @@
+'''
+    Awaitable counterparts of the LLO client, continuum_utils and k8s-shim for the async
+      API handlers.
+    The blocking clients run on a shared, bounded I/O thread pool (ROUTER_IO_THREADS)
+      while the handler awaits, so one slow LLO or CB call no longer freezes the event loop
+      and every other request of the worker. Connections stay pooled in the clients'
+      keep-alive sessions.
+'''
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import threading
+from app.api_clients.llo_api_client import LLORESTClient
+from app.api_clients import k8s_shim_client
+from app.utils import continuum_utils
+from app.config import ROUTER_IO_THREADS
+
+# Process wide executor, see get_io_executor()
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+def get_io_executor() -> concurrent.futures.ThreadPoolExecutor:
+    '''
+    Thread pool shared by all awaitable clients, created on first use
+    '''
+    global _io_executor  # pylint: disable=global-statement
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ROUTER_IO_THREADS, thread_name_prefix="router-io")
+    return _io_executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    '''
+    Await func(*args, **kwargs) run on the I/O thread pool, in a copy of the current context
+    '''
+    call = functools.partial(contextvars.copy_context().run, func, *args,
+                             **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(
+        get_io_executor(), call)
+
+
+class AsyncClient:
+    '''
+        Awaitable facade of a blocking client (or module of functions):
+          every callable attribute becomes a coroutine function run on the I/O thread pool
+    '''
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await run_blocking(attr, *args, **kwargs)
+
+        return call
+
+
+class AsyncLLORESTClient(AsyncClient):
+    '''
+        Awaitable LLORESTClient
+    '''
+
+    def __init__(self):
+        super().__init__(LLORESTClient())
+
+
+# Awaitable continuum_utils and k8s_shim_client functions
+continuum = AsyncClient(continuum_utils)
+k8s_shim = AsyncClient(k8s_shim_client)
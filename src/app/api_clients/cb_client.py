@@ -1,12 +1,205 @@
 '''
  NGSI-LD REST API Client
 '''
+import contextvars
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
 import app.config as config
 from app.utils.decorators import catch_requests_exceptions
+from app.utils import deadline
+from app.utils.singleflight import SingleFlight
 from app.api_clients import k8s_shim_client
 
+# Process wide session to Orion-LD, see get_session()
+_session = None
+_session_lock = threading.Lock()
+# Identical GETs in flight at the same time share one request
+_get_flight = SingleFlight()
+# Timeout of a shared GET, not capped by the budget of the caller sending it
+_SHARED_GET_TIMEOUT = 15
+
+
+def get_session() -> requests.Session:
+    '''
+        Process wide requests.Session shared by every CBClient.
+        Connections to the context broker are kept alive and reused from a pool
+          of CB_POOL_MAXSIZE connections instead of opening one per request
+    '''
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=config.CB_POOL_CONNECTIONS,
+                                  pool_maxsize=config.CB_POOL_MAXSIZE)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def get_session_stats() -> dict:
+    '''
+        Requests sent through the shared session and connections opened for them,
+          every request above the opened connections reused a kept alive one
+    '''
+    if _session is None:
+        return {}
+    sent = opened = 0
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            sent += pool.num_requests
+            opened += pool.num_connections
+    return {
+        "cb_requests": sent,
+        "cb_connections_opened": opened,
+        "cb_connections_reused": max(sent - opened, 0),
+    }
+
+
+def get_singleflight_stats() -> dict:
+    '''
+        GETs sent to the context broker and GETs saved by sharing an identical one in flight
+    '''
+    stats = _get_flight.stats()
+    return {
+        "cb_gets_sent": stats["calls"],
+        "cb_gets_saved": stats["shared"],
+    }
+
+
+def chunk_ids(entity_ids: list, room: int) -> list:
+    '''
+        Split entity ids in chunks whose comma separated, url encoded length fits in room
+    '''
+    chunks = []
+    chunk = []
+    used = 0
+    for entity_id in entity_ids:
+        length = len(quote(entity_id, safe=':')) + (1 if chunk else 0)
+        if chunk and used + length > room:
+            chunks.append(chunk)
+            chunk = []
+            used = 0
+            length = len(quote(entity_id, safe=':'))
+        chunk.append(entity_id)
+        used += length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def merge_entities(entities: list) -> list:
+    '''
+        Merge entity fragments by id, in order of first appearance.
+        Attributes of later fragments override those of earlier ones
+    '''
+    merged = {}
+    for entity in entities:
+        merged.setdefault(entity["id"], {}).update(entity)
+    return list(merged.values())
+
+
+def parse_batch_response(response: requests.Response, batch: list,
+                         results: dict):
+    '''
+        Add the per entity outcome of an entityOperations response to results.
+        204 means every entity of the batch was updated, 201 that all were created
+          (upsert), 207 lists successes and errors, anything else failed the whole batch
+    '''
+    if response.status_code in (201, 204):
+        results["success"].extend(entity["id"] for entity in batch)
+    elif response.status_code == 207:
+        body = response.json()
+        results["success"].extend(body.get("success", []))
+        for error in body.get("errors", []):
+            results["errors"][error.get("entityId")] = error.get("error")
+    else:
+        for entity in batch:
+            results["errors"][entity["id"]] = {
+                "status": response.status_code,
+                "title": response.reason
+            }
+
+
+class EntityPages:
+    '''
+        Pages of an NGSI-LD entities query, walked with limit/offset.
+        The first page is requested with count=true, so total is known after it and the
+          scan stops without asking for an empty page. With prefetch the next page is
+          requested while the caller handles the current one.
+        Only one or two pages are held in memory at a time. Offsets are not a snapshot:
+          entities created or deleted during the scan may be skipped or seen twice.
+        Request errors are raised to the caller while iterating
+    '''
+
+    def __init__(self,
+                 client,
+                 ngsild_params: str,
+                 page_size: int = None,
+                 prefetch: bool = False):
+        self.client = client
+        self.ngsild_params = ngsild_params
+        self.page_size = page_size or config.CB_PAGE_SIZE
+        self.prefetch = prefetch
+        self.total = None
+        self.pages = 0
+
+    def _fetch(self, offset: int) -> list:
+        '''
+        The page starting at offset, the first one also sets total
+        '''
+        entity_url = f"{self.client.api_url}:{self.client.api_port}/{self.client.url_version}" \
+                     f"entities?{self.ngsild_params}&limit={self.page_size}&offset={offset}"
+        if offset == 0:
+            entity_url += "&count=true"
+        response = self.client._request('GET',
+                                        entity_url,
+                                        timeout=deadline.timeout(15))
+        response.raise_for_status()
+        if offset == 0 and 'NGSILD-Results-Count' in response.headers:
+            self.total = int(response.headers['NGSILD-Results-Count'])
+        return response.json()
+
+    def _has_next(self, offset: int, page: list) -> bool:
+        if self.total is not None:
+            return offset < self.total
+        return len(page) == self.page_size
+
+    def __iter__(self):
+        page = self._fetch(0)
+        offset = len(page)
+        if not self.prefetch:
+            while True:
+                self.pages += 1
+                yield page
+                if not page or not self._has_next(offset, page):
+                    return
+                page = self._fetch(offset)
+                offset += len(page)
+        executor = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix="cb-prefetch")
+        try:
+            while True:
+                following = None
+                if page and self._has_next(offset, page):
+                    # Prefetch in the caller's context, so its deadline applies
+                    following = executor.submit(contextvars.copy_context().run,
+                                                self._fetch, offset)
+                self.pages += 1
+                yield page
+                if following is None:
+                    return
+                page = following.result()
+                offset += len(page)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
 
 class CBClient:
     '''
@@ -22,14 +215,61 @@ class CBClient:
         self.api_url = config.CB_URL
         self.api_port = config.CB_PORT
         self.url_version = config.URL_VERSION
-        self.m2m_cb_token = k8s_shim_client.get_m2m_cb_token()
-        self.headers = {
+        self.session = get_session()
+
+    @property
+    def m2m_cb_token(self):
+        '''
+            Process wide cached m2m token
+        '''
+        return k8s_shim_client.get_m2m_cb_token()
+
+    @property
+    def headers(self) -> dict:
+        '''
+            Request headers with the current m2m token
+        '''
+        return self._headers(self.m2m_cb_token)
+
+    @staticmethod
+    def _headers(token) -> dict:
+        return {
             'Content-Type': 'application/json',
             'Accept': 'application/json',
             'aeriOS': 'true',
-            'Authorization': f'Bearer {self.m2m_cb_token}'
+            'Authorization': f'Bearer {token}'
         }
 
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        '''
+            Send a request through the shared session with the cached m2m token.
+            Concurrent identical GETs (same URL, i.e. entity id and params) share one
+              request and its response, each caller parses its own copy of the body.
+            A shared GET is sent with the default timeout, not the one the first caller
+              capped to its budget; each caller waits for it within its own budget
+        '''
+        if method == 'GET' and config.CB_SINGLEFLIGHT:
+            return _get_flight.do(url, self._send, method, url,
+                                  **dict(kwargs, timeout=_SHARED_GET_TIMEOUT))
+        return self._send(method, url, **kwargs)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        '''
+            On 401 the token is dropped and the request retried once with a fresh one
+        '''
+        token = self.m2m_cb_token
+        response = self.session.request(method,
+                                        url,
+                                        headers=self._headers(token),
+                                        **kwargs)
+        if response.status_code == 401:
+            k8s_shim_client.invalidate_m2m_cb_token(token)
+            response = self.session.request(method,
+                                            url,
+                                            headers=self.headers,
+                                            **kwargs)
+        return response
+
     @catch_requests_exceptions
     def query_entity(self, entity_id, ngsild_params) -> dict:
         '''
@@ -41,7 +281,9 @@ class CBClient:
             ngsi-ld object
         '''
         entity_url = f'{self.api_url}:{self.api_port}/{self.url_version}entities/{entity_id}?{ngsild_params}'
-        response = requests.get(entity_url, headers=self.headers, timeout=15)
+        response = self._request('GET',
+                                 entity_url,
+                                 timeout=deadline.timeout(15))
         # response.raise_for_status()
         return response.json()
 
@@ -55,10 +297,87 @@ class CBClient:
             ngsi-ld object
         '''
         entity_url = f"{self.api_url}:{self.api_port}/{self.url_version}entities?{ngsild_params}"
-        response = requests.get(entity_url, headers=self.headers, timeout=15)
+        response = self._request('GET',
+                                 entity_url,
+                                 timeout=deadline.timeout(15))
         # response.raise_for_status()
         return response.json()
 
+    def query_entity_pages(self,
+                           ngsild_params: str,
+                           page_size: int = None,
+                           prefetch: bool = False) -> EntityPages:
+        '''
+            Query entities with ngsi-ld params, page by page
+            :input
+            @param ngsild_params: the query params, without limit, offset or count
+            @param page_size: entities per page, CB_PAGE_SIZE by default
+            @param prefetch: request the next page while the current one is handled
+            :output
+              iterable of lists of entities, its total is set once the first page is read
+        '''
+        return EntityPages(self,
+                           ngsild_params,
+                           page_size=page_size,
+                           prefetch=prefetch)
+
+    def iter_entities(self,
+                      ngsild_params: str,
+                      page_size: int = None,
+                      prefetch: bool = False):
+        '''
+            Query entities with ngsi-ld params, one entity at a time in bounded memory.
+            Unlike query_entities, request errors are raised while iterating
+            :input
+            @param ngsild_params: the query params, without limit, offset or count
+            @param page_size: entities per page, CB_PAGE_SIZE by default
+            @param prefetch: request the next page while the current one is handled
+            :output
+              generator of ngsi-ld objects
+        '''
+        for page in self.query_entity_pages(ngsild_params,
+                                            page_size=page_size,
+                                            prefetch=prefetch):
+            yield from page
+
+    @catch_requests_exceptions
+    def query_entities_by_id(self,
+                             entity_ids: list,
+                             attrs_list: list[str] = None,
+                             entity_type: str = None,
+                             ngsi_ld_params: str = 'format=simplified') -> list:
+        '''
+            Query several entities at once (entities?id=a,b,c),
+              split in as many requests as needed to keep URLs below CB_MAX_URL_LENGTH
+            :input
+            @param entity_ids: the ids of the queried entities
+            @attrs_list: the attributes of interest, all when None
+            @entity_type: type of the entities, if known
+            @ngsi_ld_params: string with any more options, e.g. local=true
+            :output
+              list of json-ld dictionaries, entities not found are left out
+        '''
+        entity_ids = list(dict.fromkeys(entity_id for entity_id in entity_ids
+                                        if entity_id))
+        base_url = f"{self.api_url}:{self.api_port}/{self.url_version}entities?{ngsi_ld_params}"
+        if attrs_list:
+            base_url += f"&attrs={','.join(attrs_list)}"
+        if entity_type:
+            base_url += f"&type={entity_type}"
+        # Room left for the ids, "&limit=NNNN&id=" included
+        room = config.CB_MAX_URL_LENGTH - len(base_url) - len("&limit=1000&id=")
+        entities = []
+        for chunk in chunk_ids(entity_ids, room):
+            # Orion-LD returns 20 entities per page unless told otherwise
+            ids = ','.join(quote(entity_id, safe=':') for entity_id in chunk)
+            entity_url = f"{base_url}&limit={len(chunk)}&id={ids}"
+            response = self._request('GET',
+                                     entity_url,
+                                     timeout=deadline.timeout(15))
+            response.raise_for_status()
+            entities.extend(response.json())
+        return entities
+
     @catch_requests_exceptions
     def patch_entity(self, entity_id, upd_object: dict) -> dict:
         '''
@@ -70,13 +389,38 @@ class CBClient:
             
         '''
         entity_url = f'{self.api_url}:{self.api_port}/{self.url_version}entities/{entity_id}'
-        response = requests.patch(entity_url,
-                                  headers=self.headers,
-                                  data=json.dumps(upd_object),
-                                  timeout=15)
+        response = self._request('PATCH',
+                                 entity_url,
+                                 data=json.dumps(upd_object),
+                                 timeout=deadline.timeout(15))
         # response.raise_for_status()
         return response.status_code
 
+    @catch_requests_exceptions
+    def update_entities(self, entities: list, upsert: bool = False) -> dict:
+        '''
+            Batch update of several entities (entityOperations/update or upsert).
+            Fragments of the same entity are merged first, later attributes win,
+              and at most CB_BATCH_MAX_ENTITIES entities are sent per request
+            :input
+            @param entities: list of json objects, each with id, type and the attributes to update
+            @param upsert: create missing entities instead of reporting them as errors
+            :output
+            {"success": [entity ids], "errors": {entity id: error}}
+        '''
+        merged = merge_entities(entities)
+        operation = 'upsert?options=update' if upsert else 'update'
+        entity_url = f'{self.api_url}:{self.api_port}/{self.url_version}entityOperations/{operation}'
+        results = {"success": [], "errors": {}}
+        for start in range(0, len(merged), config.CB_BATCH_MAX_ENTITIES):
+            batch = merged[start:start + config.CB_BATCH_MAX_ENTITIES]
+            response = self._request('POST',
+                                     entity_url,
+                                     data=json.dumps(batch),
+                                     timeout=deadline.timeout(15))
+            parse_batch_response(response, batch, results)
+        return results
+
     @catch_requests_exceptions
     def patch_entity_attr(self, entity_id, attr, upd_object: dict) -> dict:
         '''
@@ -90,13 +434,29 @@ class CBClient:
             
         '''
         entity_url = f'{self.api_url}:{self.api_port}/{self.url_version}entities/{entity_id}/attrs/{attr}'
-        response = requests.patch(entity_url,
-                                  headers=self.headers,
-                                  data=json.dumps(upd_object),
-                                  timeout=15)
+        response = self._request('PATCH',
+                                 entity_url,
+                                 data=json.dumps(upd_object),
+                                 timeout=deadline.timeout(15))
         # response.raise_for_status()
         return response.status_code
 
+    @catch_requests_exceptions
+    def create_subscription(self, subscription: dict) -> int:
+        '''
+            Register an NGSI-LD subscription
+            :input
+            @param subscription: the json subscription, with its id so registering twice is harmless
+            :output
+            status code, 201 when created and 409 when a subscription with this id exists
+        '''
+        entity_url = f'{self.api_url}:{self.api_port}/{self.url_version}subscriptions'
+        response = self._request('POST',
+                                 entity_url,
+                                 data=json.dumps(subscription),
+                                 timeout=deadline.timeout(15))
+        return response.status_code
+
     @catch_requests_exceptions
     def query_entity_attrs(self,
                            entity_id,
@@ -114,6 +474,8 @@ class CBClient:
         '''
         attrs_string = ','.join(attrs_list)
         entity_url = f'{self.api_url}:{self.api_port}/{self.url_version}entities/{entity_id}?attrs={attrs_string}&{ngsi_ld_params}'
-        response = requests.get(entity_url, headers=self.headers, timeout=15)
+        response = self._request('GET',
+                                 entity_url,
+                                 timeout=deadline.timeout(15))
         # response.raise_for_status()
         return response.json()
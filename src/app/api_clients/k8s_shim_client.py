@@ -4,24 +4,28 @@ Used when accessing CB, even when accessing it internally
    as this is used to propagate federation requests to other Orion-LD brokers
 Used also for accessing Deployment engine local allocation manager 
    for submitting final pod placements
+Tokens are cached process wide until shortly before they expire, see app.utils.token_cache
 '''
 import requests
 from app.utils.decorators import catch_requests_exceptions
+from app.utils import deadline
 from app.utils.log import get_app_logger
-from app.config import TOKEN_URL, WG_SERVER_URL, DEV
+from app.utils.token_cache import TokenCache
+from app.config import TOKEN_URL, WG_SERVER_URL, DEV, TOKEN_REFRESH_MARGIN, \
+    TOKEN_DEFAULT_TTL
 
 logger = get_app_logger()
 
 
 @catch_requests_exceptions
-def get_m2m_cb_token():
+def _fetch_m2m_cb_token():
     '''
-    Get m2m token for Orion-LD queries
+    Fetch a new m2m token for Orion-LD queries
     '''
     url = f"{TOKEN_URL}/cb"
 
     # Make a GET request to the endpoint
-    response = requests.get(url=url, timeout=10)
+    response = requests.get(url=url, timeout=deadline.timeout(10))
 
     # Raise an exception for HTTP errors
     # response.raise_for_status() # No, handled already be decorator
@@ -39,14 +43,14 @@ def get_m2m_cb_token():
 
 
 @catch_requests_exceptions
-def get_m2m_hlo_token():
+def _fetch_m2m_hlo_token():
     '''
-    Get m2m token for HLO Local Allocation Engine queries
+    Fetch a new m2m token for HLO Local Allocation Engine queries
     '''
     url = f"{TOKEN_URL}/hlo"
 
     # Make a GET request to the endpoint
-    response = requests.get(url=url, timeout=10)
+    response = requests.get(url=url, timeout=deadline.timeout(10))
 
     # Parse the JSON response from the server
     token_data = response.json()
@@ -60,6 +64,51 @@ def get_m2m_hlo_token():
         return None
 
 
+_cb_token = TokenCache(_fetch_m2m_cb_token,
+                       name="cb_token",
+                       refresh_margin=TOKEN_REFRESH_MARGIN,
+                       default_ttl=TOKEN_DEFAULT_TTL)
+_hlo_token = TokenCache(_fetch_m2m_hlo_token,
+                        name="hlo_token",
+                        refresh_margin=TOKEN_REFRESH_MARGIN,
+                        default_ttl=TOKEN_DEFAULT_TTL)
+
+
+def get_m2m_cb_token():
+    '''
+    Get m2m token for Orion-LD queries, cached until it is about to expire
+    '''
+    return _cb_token.get()
+
+
+def get_m2m_hlo_token():
+    '''
+    Get m2m token for HLO Local Allocation Engine queries, cached until it is about to expire
+    '''
+    return _hlo_token.get()
+
+
+def invalidate_m2m_cb_token(token: str = None):
+    '''
+    Drop the cached Orion-LD token after it was rejected (401)
+    '''
+    _cb_token.invalidate(token)
+
+
+def invalidate_m2m_hlo_token(token: str = None):
+    '''
+    Drop the cached HLO Local Allocation Engine token after it was rejected (401)
+    '''
+    _hlo_token.invalidate(token)
+
+
+def get_token_stats() -> dict:
+    '''
+    Cache hits, fetches and failed fetches of both tokens
+    '''
+    return {**_cb_token.stats(), **_hlo_token.stats()}
+
+
 @catch_requests_exceptions
 def setup_wireguard_server(service_id: str, wg_clients: list):
     '''
@@ -68,7 +117,7 @@ def setup_wireguard_server(service_id: str, wg_clients: list):
     url = f'{WG_SERVER_URL}/service-network-overlay'
     payload = {"service_id": service_id, "peers": wg_clients}
     # Make a POST request to the endpoint
-    response = requests.post(url=url, json=payload, timeout=10)
+    response = requests.post(url=url, json=payload, timeout=deadline.timeout(10))
 
     # Raise an exception for HTTP errors
     # response.raise_for_status()
@@ -90,7 +139,7 @@ def allocate_subnet(service_id: str) -> str:
     try:
         payload = {"service_id": service_id}
         # Make a GET request to the `/next_subnet` endpoint
-        response = requests.post(url, json=payload, timeout=5)
+        response = requests.post(url, json=payload, timeout=deadline.timeout(5))
 
         # Raise an error if the response status code is not 200 (OK)
         # response.raise_for_status()
@@ -119,7 +168,7 @@ def delete_wireguard_overlay_allocation(service_id: str):
     # Make a GET request to the endpoint
     response = requests.delete(url=url,
                                json={"service_id": service_id},
-                               timeout=10)  # <==== check here
+                               timeout=deadline.timeout(10))  # <==== check here
 
     # Raise an exception for HTTP errors
     # response.raise_for_status()
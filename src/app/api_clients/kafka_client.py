@@ -1,12 +1,18 @@
 '''
     Protobuf and kafka related functions
 '''
+import threading
+from confluent_kafka import Producer
+from app.config import producer_config
 from app.utils.log import get_app_logger
 from app.app_models.py_files  import deployment_engine_pb2 as deployment_engine
 
 
 logger = get_app_logger()
 
+_producer = None
+_producer_lock = threading.Lock()
+
 ###################################################
 ############ BINARY PROTOBUF  #####################
 
@@ -19,6 +25,41 @@ def parse_from_bytes(data):
     return data_input
 
 
+###################################################
+############ PRODUCER  ############################
+
+def get_producer():
+    '''
+        Process wide kafka producer, created on first use.
+        confluent_kafka Producer is thread safe, so it is shared by the loop and its workers
+    '''
+    global _producer  # pylint: disable=global-statement
+    with _producer_lock:
+        if _producer is None:
+            _producer = Producer(producer_config)
+    return _producer
+
 
+def publish_result(topic: str, result):
+    '''
+        Produce an HLODeploymentEngineResult keyed by service id.
+        Delivery is asynchronous, batched by the producer according to linger.ms
+    '''
+    producer = get_producer()
+    value = result.SerializeToString()
+    key = result.service_id.encode('utf-8')
+    try:
+        producer.produce(topic, value=value, key=key, on_delivery=log_delivery)
+    except BufferError:
+        # Local queue full, serve delivery reports to make room and retry once
+        producer.poll(1)
+        producer.produce(topic, value=value, key=key, on_delivery=log_delivery)
+    producer.poll(0)
 
 
+def log_delivery(err, msg):
+    '''
+        Delivery report callback for produced messages
+    '''
+    if err is not None:
+        logger.error("Failed to deliver message to %s: %s", msg.topic(), err)
@@ -6,8 +6,11 @@
     TBD: integrate remote pem files instead of using verify false
 '''
 import concurrent.futures
+import contextvars
+import time
 import requests
 from app.utils.decorators import catch_requests_exceptions
+from app.utils import deadline
 from app.app_models.py_files import hlo_pb2 as hlo
 from app.localAllocationManager.models import ServiceComponentAllocation, InfrastructureElementCR
 from app.utils.log import get_app_logger
@@ -27,17 +30,51 @@ class HLOALClient:
         self.logger = get_app_logger()
         self.logger.info("Setting remote HLO_AL URL")
         self.api_url = api_url  # API URL of selected domain
-        self.m2m_hlo_token = k8s_shim_client.get_m2m_hlo_token()
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.m2m_hlo_token}'
-        }
         self.logger.info(
             "Called with api_url argument: %s and now our domain api_url for hlo_al is: %s ",
             api_url, self.api_url)
         self.logger.info("HLO_AL headers: %s", self.headers)
 
+    @property
+    def m2m_hlo_token(self):
+        '''
+            Process wide cached m2m token
+        '''
+        return k8s_shim_client.get_m2m_hlo_token()
+
+    @property
+    def headers(self) -> dict:
+        '''
+            Request headers with the current m2m token
+        '''
+        return self._headers(self.m2m_hlo_token)
+
+    @staticmethod
+    def _headers(token) -> dict:
+        return {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {token}'
+        }
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        '''
+            Send a request with the cached m2m token.
+            On 401 the token is dropped and the request retried once with a fresh one
+        '''
+        token = self.m2m_hlo_token
+        response = requests.request(method,
+                                    url,
+                                    headers=self._headers(token),
+                                    **kwargs)
+        if response.status_code == 401:
+            k8s_shim_client.invalidate_m2m_hlo_token(token)
+            response = requests.request(method,
+                                        url,
+                                        headers=self.headers,
+                                        **kwargs)
+        return response
+
     @catch_requests_exceptions
     def request_deallocate_scompenent(
         self,
@@ -53,10 +90,10 @@ class HLOALClient:
             parts = scomponent_id.split(':')
             service_id = ':'.join(parts[:4])  ### REMOVE HERE TOO
         delete_url = f'{self.api_url}/hlo_al/services/{service_id}/service_components/{service_component_id}'
-        response = requests.delete(url=delete_url,
-                                   headers=self.headers,
-                                   timeout=15,
-                                   verify=False)
+        response = self._request('DELETE',
+                                 delete_url,
+                                 timeout=deadline.timeout(15),
+                                 verify=False)
         response.raise_for_status()
         return response.status_code
 
@@ -145,10 +182,10 @@ class HLOALClient:
         if overlay_conf:
             payload["scomponent_network_conf"] = overlay_conf.model_dump()
 
-        response = requests.post(url=allocate_url,
+        response = self._request('POST',
+                                 allocate_url,
                                  json=payload,
-                                 headers=self.headers,
-                                 timeout=15,
+                                 timeout=deadline.timeout(15),
                                  verify=False)
         # From this point on we move to Local Allocation Manager component, i.e. REST API exposed
         # response.raise_for_status()
@@ -167,10 +204,10 @@ class HLOALClient:
         if DEV:
             self.logger.info("URL: %s", self.api_url)
         destroy_overlay_url = f'{self.api_url}/hlo_al/services/{service_id}/overlay'
-        response = requests.delete(url=destroy_overlay_url,
-                                   headers=self.headers,
-                                   timeout=15,
-                                   verify=False)
+        response = self._request('DELETE',
+                                 destroy_overlay_url,
+                                 timeout=deadline.timeout(15),
+                                 verify=False)
         # response.raise_for_status()
         return response.status_code
 
@@ -194,44 +231,164 @@ def call_method(instance, method_name, params):
     return method(**params)  # Call the method with any parameters
 
 
+class RemoteAllocationDispatcher:
+    '''
+    Streaming variant of submit_remote_allocations:
+      every method call runs on a thread as soon as it is submitted,
+      so remote (de)allocations start while the next ones are still being resolved.
+    Leaving the with block waits for all calls and handles their results.
+    When a DeploymentReport is given, every call outcome and duration is recorded in it
+    '''
+
+    def __init__(self, report=None):
+        self.logger = get_app_logger()
+        self.report = report
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+        self.future_to_method = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wait()
+
+    def submit(self, instance, method_name: str, params: dict, on_done=None):
+        '''
+        Dispatch one HLOALClient method call.
+        The call runs in a copy of the current context, so it shares the message deadline
+        :param on_done: optional callable() run on the worker once the call returned or raised,
+                        not when it was cancelled
+        '''
+        future = self.executor.submit(contextvars.copy_context().run,
+                                      self._call, instance, method_name,
+                                      params, on_done)
+        self.future_to_method[future] = (instance, method_name, params)
+
+    def _call(self, instance, method_name: str, params: dict, on_done):
+        started = time.monotonic()
+        result, error = None, None
+        try:
+            if deadline.expired():
+                raise deadline.DeadlineExceeded(
+                    "Message deadline exceeded before the call started")
+            try:
+                result = call_method(instance, method_name, params)
+            finally:
+                if on_done is not None:
+                    on_done()
+            return result
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            if self.report is not None:
+                self.report.record_call(method_name, params, result, error,
+                                        time.monotonic() - started)
+
+    def wait(self):
+        '''
+        Wait for every submitted call.
+        Once the message deadline is spent, calls not started yet are cancelled.
+        Components whose call raised, failed (returned None) or was cancelled
+          are set to FAILED in one batched write.
+        Running calls are not interrupted, their request timeout is bounded by the
+          remaining budget anyway
+        '''
+        pending = set(self.future_to_method)
+        # Components whose call raised, failed, was cancelled or started too late,
+        #   all set to FAILED in one batched write at the end
+        failed = []
+        cancelled = False
+        while pending:
+            budget = None if cancelled else deadline.remaining()
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=None if budget is None else max(budget, 0),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                self._handle_result(future, failed)
+            if pending and not cancelled and deadline.expired():
+                cancelled = True
+                for future in list(pending):
+                    if future.cancel():
+                        pending.discard(future)
+                        self._handle_cancelled(future, failed)
+        if failed:
+            self.logger.error("Setting %s service components to failed",
+                              len(failed))
+            # Recorded even when the budget is spent
+            with deadline.suspended():
+                c_utils.set_service_components_status(
+                    scomponent_ids=failed,
+                    scomponent_status=aeriOS_c.ServiceComponentStatusEnum.
+                    FAILED)
+        self.future_to_method = {}
+        self.executor.shutdown()
+
+    def _handle_result(self, future, failed: list):
+        _, method_name, params = self.future_to_method[future]
+        try:
+            result = future.result()
+            self.logger.info(
+                "Method: %s called with params %s and result is %s",
+                method_name, params, result)
+            if result is None:
+                # catch_requests_exceptions turned a failed request into None,
+                #   deadline exceeded during the call included
+                self.logger.error("Method %s with params %s failed",
+                                  method_name, params)
+                if _scomponent_id(params):
+                    failed.append(_scomponent_id(params))
+            # if result != 201:
+            #     c_utils.set_service_component_status(
+            #         service_id=params['service_id'],
+            #         scomponent_id=params['scomponent_allocation'].id,
+            #         scomponent_status=aeriOS_c.ServiceComponentStatusEnum.
+            #         FAILED)
+        except deadline.DeadlineExceeded:
+            self.logger.error("Method %s with params %s not started in time",
+                              method_name, params)
+            if _scomponent_id(params):
+                failed.append(_scomponent_id(params))
+        except Exception as exc:
+            self.logger.error(
+                "Method %s with params %s generated an exception: %s",
+                method_name, params, exc)
+            if _scomponent_id(params):
+                failed.append(_scomponent_id(params))
+
+    def _handle_cancelled(self, future, failed: list):
+        _, method_name, params = self.future_to_method[future]
+        self.logger.error("Method %s with params %s cancelled, deadline exceeded",
+                          method_name, params)
+        scomponent_id = _scomponent_id(params)
+        if scomponent_id:
+            failed.append(scomponent_id)
+            if self.report is not None:
+                self.report.set_status(
+                    scomponent_id, aeriOS_c.ServiceComponentStatusEnum.FAILED,
+                    f"{method_name}: cancelled, deadline exceeded")
+
+
+def _scomponent_id(params: dict):
+    '''
+    Service component targeted by a method call, None for service level calls
+    '''
+    if "scomponent_allocation" in params:
+        return params["scomponent_allocation"].id
+    return params.get("service_component_id")
+
+
 def submit_remote_allocations(hloalclients_list: list):
     '''
     Method to dispatch parallel threads for calling remote domains local allocation managers
     Inputs:
         list of [hloclient_object, method, params_dict]
     '''
-    logger = get_app_logger()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    with RemoteAllocationDispatcher() as dispatcher:
         # Submit each method call to be run in a separate thread
-        future_to_method = {
-            executor.submit(call_method, instance, method_name, params):
-            (instance, method_name, params)
-            for instance, method_name, params in hloalclients_list
-        }
-
-        # Collect and print the results as they complete
-        for future in concurrent.futures.as_completed(future_to_method):
-            instance, method_name, params = future_to_method[future]
-            try:
-                result = future.result()
-                logger.info(
-                    "Method: %s called with params %s and result is %s",
-                    method_name, params, result)
-                # if result != 201:
-                #     c_utils.set_service_component_status(
-                #         service_id=params['service_id'],
-                #         scomponent_id=params['scomponent_allocation'].id,
-                #         scomponent_status=aeriOS_c.ServiceComponentStatusEnum.
-                #         FAILED)
-            except Exception as exc:
-                logger.error(
-                    "Method %s with params %s generated an exception: %s",
-                    method_name, params, exc)
-                c_utils.set_service_component_status(
-                    service_id=params['service_id'],
-                    scomponent_id=params['scomponent_allocation'].id,
-                    scomponent_status=aeriOS_c.ServiceComponentStatusEnum.FAILED
-                )
+        for instance, method_name, params in hloalclients_list:
+            dispatcher.submit(instance, method_name, params)
 
 # To test delays between allocation requests
 # import time
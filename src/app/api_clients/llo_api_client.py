@@ -1,13 +1,17 @@
 '''
  aeriOS LLO REST API Client
 '''
+import threading
 from typing import Tuple, Dict, Any, List
 import requests
+from requests.adapters import HTTPAdapter
 import app.config as config
 from app.utils.log import get_app_logger
 from app.utils.decorators import catch_requests_exceptions
+from app.utils import deadline
 from app.localAllocationManager.models import ServiceComponentParameters, Port, CliArgs, EnvVars, WgClientConf
 from app.api_clients.cb_client import CBClient
+from app.utils.topology import get_topology_index
 
 test_str = """
 apiVersion: llo.aeriOS-project.eu/v1alpha1
@@ -50,6 +54,26 @@ NetworkingInfo:
     PrivateKey -> client private key
 """
 
+# Process wide session to the LLO REST API, see get_session()
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    '''
+        Process wide requests.Session shared by every LLORESTClient,
+          keeping up to LLO_POOL_MAXSIZE connections alive
+    '''
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_maxsize=config.LLO_POOL_MAXSIZE)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
 
 class LLORESTClient:
     '''
@@ -61,6 +85,7 @@ class LLORESTClient:
         self.api_url = config.LLO_REST_URL
         self.api_port = config.LLO_REST_PORT
         self.llo_rest_api_base_url = f'{self.api_url}:{self.api_port}/v1/service-components'
+        self.session = get_session()
         # self.url_version = config.URL_VERSION
         self.headers = {
             'Content-Type': 'application/yaml',
@@ -78,10 +103,10 @@ class LLORESTClient:
             logger = get_app_logger()
             logger.info("YAML forwarded to LLO API:\n")
             logger.info(yaml_str)
-        response = requests.post(entity_url,
-                                 data=yaml_str,
-                                 headers=self.headers,
-                                 timeout=15)
+        response = self.session.post(entity_url,
+                                     data=yaml_str,
+                                     headers=self.headers,
+                                     timeout=deadline.timeout(15))
         return response.status_code, response.json()
 
     @catch_requests_exceptions
@@ -114,9 +139,9 @@ class LLORESTClient:
         entity_url = f'{self.llo_rest_api_base_url}/{service_name}?type={llo_type}'
 
         # Perform the DELETE request to deallocate the component
-        response = requests.delete(entity_url,
-                                   headers=self.headers,
-                                   timeout=15)
+        response = self.session.delete(entity_url,
+                                       headers=self.headers,
+                                       timeout=deadline.timeout(15))
 
         return response.status_code
 
@@ -130,7 +155,9 @@ class LLORESTClient:
         '''
         service_name = f'aeriOS-{scomponent_id.replace("urn:ngsi-ld:", "").replace(":", "-").lower()}'
         entity_url = f'{self.llo_rest_api_base_url}/{service_name}'
-        response = requests.get(entity_url, headers=self.headers, timeout=15)
+        response = self.session.get(entity_url,
+                                    headers=self.headers,
+                                    timeout=deadline.timeout(15))
         response_json = response.json()
         if not "spec" in response_json.keys():
             return None
@@ -169,13 +196,15 @@ class LLORESTClient:
                 else:
                     arg = EnvVars(key=item["key"])
                 env_vars.append(arg)
-        cb = CBClient()
-        ngsild_params = "format=simplified"
-        ie_json = cb.query_entity(
-            infrastructure_element.replace(
-                'IE', 'InfrastructureElement'),  # BUG in LLO naming
-            ngsild_params=ngsild_params)
-        llo_id = ie_json["lowLevelOrchestrator"]
+        ie_id = infrastructure_element.replace(
+            'IE', 'InfrastructureElement')  # BUG in LLO naming
+        index = get_topology_index()
+        llo_id = index.llo_of(ie_id) if index is not None else None
+        if llo_id is None:
+            cb = CBClient()
+            ngsild_params = "format=simplified"
+            ie_json = cb.query_entity(ie_id, ngsild_params=ngsild_params)
+            llo_id = ie_json["lowLevelOrchestrator"]
         scomponent_parameters = ServiceComponentParameters(
             image=image,
             envVars=env_vars,
@@ -201,7 +230,9 @@ class LLORESTClient:
         '''
         service_name = f'aeriOS-{scomponent_id.replace("urn:ngsi-ld:", "").replace(":", "-").lower()}'
         entity_url = f'{self.llo_rest_api_base_url}/{service_name}'
-        response = requests.get(entity_url, headers=self.headers, timeout=15)
+        response = self.session.get(entity_url,
+                                    headers=self.headers,
+                                    timeout=deadline.timeout(15))
         response_json = response.json()
         network_conf = response_json["spec"]["networkOverlay"]
 
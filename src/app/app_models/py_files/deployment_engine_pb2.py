@@ -14,7 +14,7 @@ _sym_db = _symbol_database.Default()
 from . import hlo_pb2 as hlo__pb2
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x17\x64\x65ployment_engine.proto\x1a\thlo.proto\"\x9e\x01\n\x1aServiceComponentAllocation\x12\x44\n$old_allocated_infrastructure_element\x18\x01 \x01(\x0b\x32\x16.InfrastructureElement\x12:\n\x1fnew_allocated_service_component\x18\x02 \x01(\x0b\x32\x11.ServiceComponent\"^\n\x18HLODeploymentEngineInput\x12\x42\n\x1dservice_component_allocations\x18\x01 \x03(\x0b\x32\x1b.ServiceComponentAllocationb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x17\x64\x65ployment_engine.proto\x1a\thlo.proto\"\x9e\x01\n\x1aServiceComponentAllocation\x12\x44\n$old_allocated_infrastructure_element\x18\x01 \x01(\x0b\x32\x16.InfrastructureElement\x12:\n\x1fnew_allocated_service_component\x18\x02 \x01(\x0b\x32\x11.ServiceComponent\"x\n\x18HLODeploymentEngineInput\x12\x42\n\x1dservice_component_allocations\x18\x01 \x03(\x0b\x32\x1b.ServiceComponentAllocation\x12\x18\n\x10\x64\x65\x61\x64line_seconds\x18\x02 \x01(\r\"-\n\x0bStageTiming\x12\r\n\x05stage\x18\x01 \x01(\t\x12\x0f\n\x07seconds\x18\x02 \x01(\x01\"\xb1\x01\n\x16ServiceComponentResult\x12\x1c\n\x14service_component_id\x18\x01 \x01(\t\x12\x0e\n\x06status\x18\x02 \x01(\t\x12\x11\n\tdomain_id\x18\x03 \x01(\t\x12!\n\x19infrastructure_element_id\x18\x04 \x01(\t\x12#\n\rstage_timings\x18\x05 \x03(\x0b\x32\x0c.StageTiming\x12\x0e\n\x06\x65rrors\x18\x06 \x03(\t\"\xcd\x01\n\x19HLODeploymentEngineResult\x12\x12\n\nservice_id\x18\x01 \x01(\t\x12\x13\n\x0b\x61\x63tion_type\x18\x02 \x01(\t\x12:\n\x19service_component_results\x18\x03 \x03(\x0b\x32\x17.ServiceComponentResult\x12#\n\rstage_timings\x18\x04 \x03(\x0b\x32\x0c.StageTiming\x12\x0e\n\x06\x65rrors\x18\x05 \x03(\t\x12\x16\n\x0e\x66inished_at_ms\x18\x06 \x01(\x03\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'deployment_engine_pb2', globals())
@@ -24,5 +24,11 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _SERVICECOMPONENTALLOCATION._serialized_start=39
   _SERVICECOMPONENTALLOCATION._serialized_end=197
   _HLODEPLOYMENTENGINEINPUT._serialized_start=199
-  _HLODEPLOYMENTENGINEINPUT._serialized_end=293
+  _HLODEPLOYMENTENGINEINPUT._serialized_end=319
+  _STAGETIMING._serialized_start=321
+  _STAGETIMING._serialized_end=366
+  _SERVICECOMPONENTRESULT._serialized_start=369
+  _SERVICECOMPONENTRESULT._serialized_end=546
+  _HLODEPLOYMENTENGINERESULT._serialized_start=549
+  _HLODEPLOYMENTENGINERESULT._serialized_end=754
 # @@protoc_insertion_point(module_scope)
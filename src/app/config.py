@@ -47,5 +47,140 @@ consumer_config = {
     'group.id':
     os.environ.get('GROUP_ID', 'python-consumer'),
     'auto.offset.reset':
-    os.environ.get('AUTO_OFFSET_RESET', 'earliest')
+    os.environ.get('AUTO_OFFSET_RESET', 'earliest'),
+    # Offsets are committed by app.runtime.offsets.OffsetTracker only
+    'enable.auto.commit':
+    False
 }
+
+# Kafka loop processing
+# LOOP_WORKERS > 1 processes different services in parallel,
+#   messages of the same service keep their order (keyed on service id)
+LOOP_WORKERS = int(os.environ.get('LOOP_WORKERS', '1'))
+LOOP_WORKER_QUEUE_SIZE = int(os.environ.get('LOOP_WORKER_QUEUE_SIZE', '100'))
+# LOOP_BATCH_SIZE > 1 consumes messages in batches (up to LOOP_BATCH_TIMEOUT seconds)
+#   and coalesces superseded allocations of the same service before processing
+LOOP_BATCH_SIZE = int(os.environ.get('LOOP_BATCH_SIZE', '1'))
+LOOP_BATCH_TIMEOUT = float(os.environ.get('LOOP_BATCH_TIMEOUT', '1.0'))
+# Offsets are committed up to the last contiguous completed message,
+#   every COMMIT_INTERVAL seconds or COMMIT_EVERY completed messages
+COMMIT_INTERVAL = float(os.environ.get('COMMIT_INTERVAL', '5.0'))
+COMMIT_EVERY = int(os.environ.get('COMMIT_EVERY', '100'))
+
+producer_config = {
+    'bootstrap.servers': consumer_config['bootstrap.servers'],
+    'linger.ms': int(os.environ.get('PRODUCER_LINGER_MS', '20')),
+    'batch.num.messages': int(os.environ.get('PRODUCER_BATCH_MESSAGES', '1000')),
+}
+
+# Failed messages are republished to RETRY_TOPIC with exponential backoff
+#   (RETRY_BACKOFF_BASE * 2^(attempt-1), capped to RETRY_BACKOFF_MAX seconds)
+#   and to DLQ_TOPIC after RETRY_MAX_ATTEMPTS.
+# Unset RETRY_TOPIC keeps the consumer restart on failure
+RETRY_TOPIC = os.environ.get('RETRY_TOPIC')
+DLQ_TOPIC = os.environ.get('DLQ_TOPIC')
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BACKOFF_BASE = float(os.environ.get('RETRY_BACKOFF_BASE', '5.0'))
+RETRY_BACKOFF_MAX = float(os.environ.get('RETRY_BACKOFF_MAX', '300.0'))
+
+# Backoff (seconds) before the loop supervisor recovers from a failed processing step
+SUPERVISOR_BACKOFF_BASE = float(os.environ.get('SUPERVISOR_BACKOFF_BASE', '1.0'))
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get('SUPERVISOR_BACKOFF_MAX', '60.0'))
+
+# Completed messages remembered to skip redeliveries (0 disables),
+#   DEDUP_SQLITE_PATH persists them across restarts
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', '10000'))
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', '86400'))
+DEDUP_SQLITE_PATH = os.environ.get('DEDUP_SQLITE_PATH')
+
+# Messages polled ahead of processing by the intake thread (0 polls on the processing thread),
+#   partitions are paused while the hand-off queue is full
+INTAKE_QUEUE_SIZE = int(os.environ.get('INTAKE_QUEUE_SIZE', '100'))
+
+# Start the kafka loop inside the API process ("uvicorn main:app").
+#   "python -m app api" sets it to false and the loop runs with "python -m app consumer"
+EMBEDDED_CONSUMER = os.environ.get('EMBEDDED_CONSUMER', 'true').lower() == 'true'
+
+# SCHEDULER_WINDOW > 0 keeps up to that many polled messages in a priority scheduler:
+#   destroys/overloads and cheap services first, SCHEDULER_AGING seconds of score
+#   earned per second waited
+SCHEDULER_WINDOW = int(os.environ.get('SCHEDULER_WINDOW', '0'))
+SCHEDULER_AGING = float(os.environ.get('SCHEDULER_AGING', '1.0'))
+
+# Worker threads processing inputs posted to /hlo_de/allocations,
+#   INGEST_WAIT_TIMEOUT bounds how long a request with ?wait=true is held
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '4'))
+INGEST_WAIT_TIMEOUT = float(os.environ.get('INGEST_WAIT_TIMEOUT', '300'))
+
+# Topic receiving an HLODeploymentEngineResult per processed input, empty disables it
+RESULT_TOPIC = os.environ.get('RESULT_TOPIC', '')
+
+# Budget in seconds for all remote calls of one message, 0 disables it.
+#   HLODeploymentEngineInput.deadline_seconds overrides it per message
+MESSAGE_DEADLINE = float(os.environ.get('MESSAGE_DEADLINE', '0'))
+
+# Outbox of planned remote calls, so a crashed or failed input resumes instead of
+#   starting over. In memory (failed attempts of the same process only) when no file is set
+OUTBOX_SQLITE_PATH = os.environ.get('OUTBOX_SQLITE_PATH', '')
+OUTBOX_TTL = float(os.environ.get('OUTBOX_TTL', '86400'))
+
+# Keep-alive connection pool to the context broker shared by every CBClient
+CB_POOL_CONNECTIONS = int(os.environ.get('CB_POOL_CONNECTIONS', '4'))
+CB_POOL_MAXSIZE = int(os.environ.get('CB_POOL_MAXSIZE', '32'))
+# Concurrent identical GETs to the context broker share one request in flight
+CB_SINGLEFLIGHT = os.environ.get('CB_SINGLEFLIGHT', 'true').lower() == 'true'
+
+# M2M tokens are cached until TOKEN_REFRESH_MARGIN seconds before their JWT "exp"
+#   and refreshed in the background, tokens without exp are kept TOKEN_DEFAULT_TTL seconds
+TOKEN_REFRESH_MARGIN = float(os.environ.get('TOKEN_REFRESH_MARGIN', '60'))
+TOKEN_DEFAULT_TTL = float(os.environ.get('TOKEN_DEFAULT_TTL', '300'))
+
+# Longest URL sent to the context broker, batch queries by id are split to stay below it
+CB_MAX_URL_LENGTH = int(os.environ.get('CB_MAX_URL_LENGTH', '2000'))
+# Entities per page of paginated queries (Orion-LD serves at most 1000)
+CB_PAGE_SIZE = int(os.environ.get('CB_PAGE_SIZE', '1000'))
+# Entities sent per entityOperations request
+CB_BATCH_MAX_ENTITIES = int(os.environ.get('CB_BATCH_MAX_ENTITIES', '100'))
+
+# Service component status/IE updates are queued and written behind in one batch,
+#   WRITE_BEHIND_INTERVAL seconds after the first one or once WRITE_BEHIND_MAX_BATCH
+#   components are pending. Kafka offsets are committed only after the queue is flushed,
+#   waiting at most WRITE_BEHIND_FLUSH_TIMEOUT seconds
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', 'true').lower() == 'true'
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.005'))
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', '100'))
+WRITE_BEHIND_FLUSH_TIMEOUT = float(
+    os.environ.get('WRITE_BEHIND_FLUSH_TIMEOUT', '30'))
+
+# Read-through cache of continuum topology lookups (IE -> domain, domain -> publicUrl/publicKey,
+#   IE -> containerTechnology/hostname). A TTL of 0 disables caching that kind of entity,
+#   lookups finding nothing are kept CB_CACHE_NEGATIVE_TTL seconds.
+#   Service component status is never cached
+CB_CACHE_MAX_ENTRIES = int(os.environ.get('CB_CACHE_MAX_ENTRIES', '10000'))
+CB_CACHE_IE_TTL = float(os.environ.get('CB_CACHE_IE_TTL', '300'))
+CB_CACHE_DOMAIN_TTL = float(os.environ.get('CB_CACHE_DOMAIN_TTL', '600'))
+CB_CACHE_NEGATIVE_TTL = float(os.environ.get('CB_CACHE_NEGATIVE_TTL', '10'))
+
+# In memory index of Domains, LLOs and IEs, loaded at startup in pages of TOPOLOGY_PAGE_SIZE.
+#   Entities modified since the last refresh are fetched every TOPOLOGY_REFRESH_INTERVAL
+#   seconds, everything is reloaded every TOPOLOGY_FULL_RELOAD_INTERVAL seconds
+TOPOLOGY_INDEX = os.environ.get('TOPOLOGY_INDEX', 'true').lower() == 'true'
+TOPOLOGY_PAGE_SIZE = int(os.environ.get('TOPOLOGY_PAGE_SIZE', '1000'))
+TOPOLOGY_REFRESH_INTERVAL = float(
+    os.environ.get('TOPOLOGY_REFRESH_INTERVAL', '60'))
+TOPOLOGY_FULL_RELOAD_INTERVAL = float(
+    os.environ.get('TOPOLOGY_FULL_RELOAD_INTERVAL', '3600'))
+
+# URL of /hlo_de/notifications as reachable from Orion-LD, empty disables the subscriptions.
+#   Domain, IE and LLO changes are then pushed to the topology index and lookup cache
+#   (of the API process and its embedded consumer), which allows long CB_CACHE_*_TTL values.
+#   Notifications are applied in batches, NOTIFICATION_DEBOUNCE seconds after the first one
+NOTIFICATION_URL = os.environ.get('NOTIFICATION_URL', '')
+NOTIFICATION_DEBOUNCE = float(os.environ.get('NOTIFICATION_DEBOUNCE', '0.5'))
+NOTIFICATION_MAX_BATCH = int(os.environ.get('NOTIFICATION_MAX_BATCH', '500'))
+
+# Threads running blocking CB/LLO/k8s-shim calls for the async API handlers,
+#   i.e. requests in flight per API worker before they queue
+ROUTER_IO_THREADS = int(os.environ.get('ROUTER_IO_THREADS', '128'))
+# Keep-alive connection pool to the LLO REST API shared by every LLORESTClient
+LLO_POOL_MAXSIZE = int(os.environ.get('LLO_POOL_MAXSIZE', '32'))
@@ -5,37 +5,64 @@
   Exposes aeriOS REST API for local service component allocation.
   aeriOS OpenAPI: https://aeriOS-public.pages.aeriOS-project.eu/openapis/#/hlo_al
 '''
+import asyncio
+import queue
 import threading
 import yaml
-from fastapi import HTTPException, APIRouter
+from fastapi import HTTPException, APIRouter, Request
 from fastapi.responses import JSONResponse
+from google.protobuf.message import DecodeError
 from app.api_clients import k8s_shim_client
 from app.localAllocationManager.models import ServiceComponentAllocation, \
     ServiceComponentParameters, ServiceComponentNotAllocated
 from app.utils import continuum_utils as manager_utils
-from app.api_clients.llo_api_client import LLORESTClient
+from app.api_clients.async_clients import AsyncLLORESTClient, continuum, k8s_shim, \
+    run_blocking
 from app.utils.log import get_app_logger
-from app.loop import run
-from app.config import DEV
+from app.api_clients.kafka_client import parse_from_bytes
+from app.api_clients.cb_client import get_session_stats, get_singleflight_stats
+from app.loop import run, get_consumer_stats, get_orchestrated_service_id, submit_input
+from app.utils.subscriptions import register_subscriptions, get_notification_batcher
+from app.config import DEV, INGEST_WAIT_TIMEOUT, NOTIFICATION_URL
+import app.config as config
 from app.localAllocationManager import crdGenarator
 import app.localAllocationManager.models as LAModels
 import app.app_models.aeriOS_continuum as aeriOS_c
 
 logger = get_app_logger()
 
-m2m_hlo_token = k8s_shim_client.get_m2m_hlo_token()
-
 
 async def kafka_loop():
     '''
-    New thread for the kafka consumer
+    New thread for the kafka consumer, unless the loop runs in its own process(es).
+    EMBEDDED_CONSUMER is read here and not at import, "python -m app api" imports
+      this module before it turns the flag off, see app/__main__.py
     '''
+    if not config.EMBEDDED_CONSUMER:
+        logger.info("Kafka loop not embedded in the API process")
+        return
     thread = threading.Thread(target=run, args=())
     thread.daemon = True  # Optional: makes the thread terminate when the main process does
     thread.start()
 
 
-router = APIRouter(on_startup=[kafka_loop])
+async def cb_subscriptions():
+    '''
+    Subscribe to Domain, IE and LLO changes, notified to /hlo_de/notifications
+    '''
+    await run_blocking(register_subscriptions)
+
+
+async def cb_write_behind():
+    '''
+    Write the queued service component updates before the process exits
+    '''
+    await run_blocking(manager_utils.stop_service_component_updates)
+
+
+router = APIRouter(
+    on_startup=[kafka_loop] + ([cb_subscriptions] if NOTIFICATION_URL else []),
+    on_shutdown=[cb_write_behind])
 
 
 @router.post("/hlo_al/services/{service_id}",
@@ -66,7 +93,7 @@ async def allocate_service_component(
     # Check service component does not already exist and runs
     # FIXME: Take care, check again!!
     # upd: again back (was removed, think again Race conditions)
-    service_exists = manager_utils.check_service_component_exists(
+    service_exists = await continuum.check_service_component_exists(
         service_id=service_id, service_component_id=service_component.id)
     if service_exists:
         raise HTTPException(status_code=409,
@@ -81,9 +108,9 @@ async def allocate_service_component(
     yaml_obj = yaml.dump(yaml_json)
     logger.info("YAML_Object: %s", yaml_obj)
     # Send for LLO REST API
-    llo_client = LLORESTClient()
+    llo_client = AsyncLLORESTClient()
     try:
-        status_code, deployment_response = llo_client.request_deployment(
+        status_code, deployment_response = await llo_client.request_deployment(
             yaml_str=yaml_obj)
     except TypeError as er:
         logger.error("Error happned: %s", er)
@@ -96,14 +123,13 @@ async def allocate_service_component(
     logger.info("Response is: %s", deployment_response)
     # Update service component status in the aeriOS contiunuum
     if status_code == 201:
-        manager_utils.set_service_component_status(
-            service_id=service_id,
-            scomponent_id=service_component.id,
-            scomponent_status=aeriOS_c.ServiceComponentStatusEnum.RUNNING)
-        manager_utils.set_service_component_ie(
-            service_id=service_id,
-            scomponent_id=service_component.id,
-            allocated_ie_id=service_component.infrastructure_element.id)
+        # Status and IE in one CB write, written behind
+        await continuum.queue_service_component_updates([
+            manager_utils.service_component_update(
+                service_component.id,
+                scomponent_status=aeriOS_c.ServiceComponentStatusEnum.RUNNING,
+                allocated_ie_id=service_component.infrastructure_element.id)
+        ])
         # return {"status": "service component allocated"}
         return JSONResponse(
             status_code=201,
@@ -112,7 +138,7 @@ async def allocate_service_component(
                 f"service component allocated for service component: : {service_id} "
             })
     else:
-        manager_utils.set_service_component_status(
+        await continuum.set_service_component_status(
             service_id=service_id,
             scomponent_id=service_component.id,
             scomponent_status=aeriOS_c.ServiceComponentStatusEnum.FAILED)
@@ -145,13 +171,13 @@ async def get_scomponent_parameters(service_id: str,
     :param service_component_id: The ID of the service (path parameter).
     :return: Information about the service component.
     '''
-    service_exists = manager_utils.check_service_component_exists(
+    service_exists = await continuum.check_service_component_exists(
         service_id=service_id, service_component_id=service_component_id)
     if not service_exists:
         raise HTTPException(status_code=404,
                             detail="Service Component not Allocated")
-    llo_client = LLORESTClient()
-    deployment_parametrs = llo_client.get_deployment_parameters(
+    llo_client = AsyncLLORESTClient()
+    deployment_parametrs = await llo_client.get_deployment_parameters(
         scomponent_id=service_component_id)
     if not deployment_parametrs:
         raise HTTPException(status_code=404,
@@ -179,7 +205,7 @@ async def update_scomponent_parameters(service_id: str,
     '''
     Update allocation parameters of an existing service component in the domain
     '''
-    service_exists = manager_utils.check_service_component_exists(
+    service_exists = await continuum.check_service_component_exists(
         service_id=service_id, service_component_id=service_component_id)
     if not service_exists:
         raise HTTPException(status_code=404,
@@ -206,17 +232,17 @@ async def deallocate_scomponents(service_id: str, service_component_id: str):
     Deallocate an existing service component in the domain
     '''
     # upd: again back (was removed, think again Race conditions)
-    service_exists = manager_utils.check_service_component_exists(
+    service_exists = await continuum.check_service_component_exists(
         service_id=service_id, service_component_id=service_component_id)
     if not service_exists:
         raise HTTPException(status_code=404,
                             detail="Service Component not allocated")
-    hosting_ie = manager_utils.get_scompnent_hosting_ie(
+    hosting_ie = await continuum.get_scompnent_hosting_ie(
         scomponent_id=service_component_id)
-    llo_type = manager_utils.get_ie_llo_type(hosting_ie)
+    llo_type = await continuum.get_ie_llo_type(hosting_ie)
 
-    llo_client = LLORESTClient()
-    status_code = llo_client.request_delete_deployment(
+    llo_client = AsyncLLORESTClient()
+    status_code = await llo_client.request_delete_deployment(
         scomponent_id=service_component_id, llo_type=llo_type)
 
     # logger.info('LLO REST API Response for service: %s, the component:',
@@ -230,13 +256,12 @@ async def deallocate_scomponents(service_id: str, service_component_id: str):
 
     # FIXME: We need to tell if it comes from deallocate, as at that case we whould not update service status
     # because it is a race condition with new HLO-LA who will update the last
-    manager_utils.set_service_component_status(
-        service_id=service_id,
-        scomponent_id=service_component_id,
-        scomponent_status=aeriOS_c.ServiceComponentStatusEnum.FINISHED)
-    manager_utils.set_service_component_ie(service_id=service_id,
-                                           scomponent_id=service_component_id,
-                                           allocated_ie_id="urn:ngsi-ld:null")
+    await continuum.queue_service_component_updates([
+        manager_utils.service_component_update(
+            service_component_id,
+            scomponent_status=aeriOS_c.ServiceComponentStatusEnum.FINISHED,
+            allocated_ie_id="urn:ngsi-ld:null")
+    ])
     return {"status": "Service component deallocated"}
 
 
@@ -255,7 +280,170 @@ async def destroy_service_overlay(service_id: str):
     This domain had recieved intial allocation request and thus provides overlay
     '''
     logger.info("Deleting overlay subnet allocated for %s", service_id)
-    service_exists = manager_utils.check_service_exists(service_id=service_id)
+    service_exists = await continuum.check_service_exists(service_id=service_id)
     if not service_exists:
         raise HTTPException(status_code=404, detail="Service not found")
-    k8s_shim_client.delete_wireguard_overlay_allocation(service_id=service_id)
+    await k8s_shim.delete_wireguard_overlay_allocation(service_id=service_id)
+
+
+@router.get("/hlo_de/consumer/stats",
+            responses={200: {
+                "description": "Kafka consumer loop counters"
+            }})
+async def consumer_stats():
+    '''
+    Restart and processing counters of the Deployment Engine kafka loop
+    '''
+    return get_consumer_stats()
+
+
+@router.get("/hlo_de/http/stats",
+            responses={200: {
+                "description": "Context broker connection pool, m2m token and lookup cache counters"
+            }})
+async def http_stats():
+    '''
+    Requests sent to the context broker and how many reused a kept alive connection,
+      GETs saved by sharing an identical one in flight, m2m token cache hits and fetches,
+      topology lookup cache hit rates and service component updates written behind
+    '''
+    return {
+        **get_session_stats(),
+        **get_singleflight_stats(),
+        **k8s_shim_client.get_token_stats(), "continuum_cache":
+        manager_utils.get_cache_stats(),
+        "write_behind": manager_utils.get_write_behind_stats()
+    }
+
+
+@router.post("/hlo_de/notifications",
+             status_code=204,
+             responses={
+                 204: {
+                     "description": "notification queued"
+                 },
+                 400: {
+                     "description": "not an NGSI-LD notification"
+                 }
+             })
+async def cb_notification(request: Request):
+    '''
+    NGSI-LD notification of Domain, IE or LLO changes,
+      applied in batches to the topology index and lookup cache
+    '''
+    try:
+        notification = await request.json()
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="Invalid JSON") from exc
+    entities = notification.get("data") if isinstance(notification,
+                                                       dict) else None
+    if not isinstance(entities, list):
+        raise HTTPException(status_code=400,
+                            detail="Expected an NGSI-LD notification")
+    get_notification_batcher().add(
+        [entity for entity in entities if isinstance(entity, dict)])
+
+
+@router.get("/hlo_de/notifications/stats",
+            responses={200: {
+                "description": "Change notification counters"
+            }})
+async def notification_stats():
+    '''
+    Notified and applied entities, batches
+    '''
+    return get_notification_batcher().stats()
+
+
+@router.post("/hlo_de/allocations",
+             status_code=202,
+             responses={
+                 200: {
+                     "description":
+                     "allocation processed (wait=true), status and errors per service component"
+                 },
+                 202: {
+                     "description": "allocation accepted for processing"
+                 },
+                 400: {
+                     "description": "invalid HLODeploymentEngineInput"
+                 },
+                 415: {
+                     "description": "body is not application/x-protobuf"
+                 },
+                 500: {
+                     "description": "allocation processing failed (wait=true)"
+                 },
+                 503: {
+                     "description": "too many allocations queued, retry later"
+                 }
+             },
+             openapi_extra={
+                 "requestBody": {
+                     "required": True,
+                     "content": {
+                         "application/x-protobuf": {
+                             "schema": {
+                                 "type": "string",
+                                 "format": "binary"
+                             }
+                         }
+                     }
+                 }
+             })
+async def ingest_allocation(request: Request,
+                            wait: bool = False,
+                            timeout: float = INGEST_WAIT_TIMEOUT):
+    '''
+    Process a serialized HLODeploymentEngineInput without going through kafka,
+      e.g. for local allocators and load tests.
+    :param wait: respond once processing is over instead of right after parsing,
+                 with the outcome of every service component
+    :param timeout: seconds to wait at most when wait is set
+    :return: Response message and status code.
+    '''
+    content_type = request.headers.get("content-type", "")
+    if content_type.split(";")[0].strip() != "application/x-protobuf":
+        raise HTTPException(status_code=415,
+                            detail="Expected application/x-protobuf body")
+    try:
+        input_protbuf_msg = parse_from_bytes(await request.body())
+    except DecodeError as exc:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid HLODeploymentEngineInput") from exc
+    if not input_protbuf_msg.service_component_allocations:
+        raise HTTPException(status_code=400,
+                            detail="No service_component_allocations")
+    service_id = get_orchestrated_service_id(input_protbuf_msg)
+    try:
+        future = submit_input(input_protbuf_msg)
+    except queue.Full as exc:
+        # Workers are saturated, let the client back off instead of blocking the event loop
+        raise HTTPException(status_code=503,
+                            detail="Too many allocations queued",
+                            headers={"Retry-After": "1"}) from exc
+    if not wait:
+        return {"status": "accepted", "service_id": service_id}
+    try:
+        report = await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(future)), timeout=timeout)
+    except asyncio.TimeoutError:
+        return {"status": "processing", "service_id": service_id}
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.error("Failed to process allocation of %s: %s", service_id,
+                     exc)
+        return JSONResponse(status_code=500,
+                            content={
+                                "status": "failed",
+                                "service_id": service_id,
+                                "detail": repr(exc)
+                            })
+    # Statuses are written behind, have them in CB before the caller reads them back
+    await continuum.flush_service_component_updates(report.scomponent_ids())
+    return JSONResponse(status_code=200,
+                        content={
+                            "status":
+                            "failed" if report.failed() else "completed",
+                            **report.to_dict()
+                        })
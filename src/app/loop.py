@@ -2,343 +2,972 @@
     Component runtime Control
     Subscribe to kafka and wait for events from HLO_ALLOCATOR msg 
 '''
+import concurrent.futures
+import contextlib
+import functools
 import ipaddress
+import queue
+import threading
+import time
 # import re
 from confluent_kafka import Consumer, KafkaException
-from app.config import consumer_config, CONSUMER_TOPIC, DEV
+from google.protobuf.message import DecodeError
+from app.config import consumer_config, CONSUMER_TOPIC, DEV, LOOP_WORKERS, \
+    LOOP_WORKER_QUEUE_SIZE, LOOP_BATCH_SIZE, LOOP_BATCH_TIMEOUT, COMMIT_INTERVAL, \
+    COMMIT_EVERY, RETRY_TOPIC, DLQ_TOPIC, RETRY_MAX_ATTEMPTS, RETRY_BACKOFF_BASE, \
+    RETRY_BACKOFF_MAX, SUPERVISOR_BACKOFF_BASE, SUPERVISOR_BACKOFF_MAX, DEDUP_MAX_ENTRIES, \
+    DEDUP_TTL, DEDUP_SQLITE_PATH, INTAKE_QUEUE_SIZE, SCHEDULER_WINDOW, SCHEDULER_AGING, \
+    INGEST_WORKERS, RESULT_TOPIC, MESSAGE_DEADLINE, OUTBOX_SQLITE_PATH, OUTBOX_TTL
 from app.utils.log import get_app_logger
-from app.utils import continuum_utils, tools
-from app.api_clients.kafka_client import parse_from_bytes
-from app.api_clients.la_manager_client import HLOALClient, submit_remote_allocations
+from app.utils import continuum_utils, tools, deadline
+from app.utils.topology import get_topology_index
+from app.api_clients.kafka_client import parse_from_bytes, get_producer, publish_result
+from app.api_clients.la_manager_client import HLOALClient, RemoteAllocationDispatcher
 from app.localAllocationManager import models as LAModels
 from app.api_clients import k8s_shim_client
 from app.api_clients import llo_api_client
 from app.app_models import aeriOS_continuum as aeriOS_c
+from app.runtime.workers import KeyedWorkerPool
+from app.runtime.coalesce import coalesce_inputs
+from app.runtime.offsets import OffsetTracker
+from app.runtime.retry import RetryRouter
+from app.runtime.supervisor import ConsumerSupervisor
+from app.runtime.dedup import DedupStore, message_key
+from app.runtime.intake import PollingIntake
+from app.runtime.scheduler import PriorityScheduler
+from app.runtime.report import DeploymentReport
+from app.runtime.outbox import Outbox
 from app.utils.tools import generate_wireguard_server_url
 if DEV:
     from app.config import DEV_HLO_AL_URL, DEV_HLO_AL_PORT
 
 logger = get_app_logger()
 
+# ConsumerSupervisor of the running loop, see run()
+supervisor = None
+# Outbox of planned remote calls, see get_outbox()
+_outbox = None
+_outbox_lock = threading.Lock()
+# Keyed workers for inputs received without kafka, see submit_input()
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
 
-def run():
+
+# Action type CB reports once a planned action was handled, see continuum_utils.service_handled
+_HANDLED_ACTION_TYPES = {
+    aeriOS_c.ServiceActionTypeEnum.DEPLOYING:
+    aeriOS_c.ServiceActionTypeEnum.DEPLOYED,
+    aeriOS_c.ServiceActionTypeEnum.DESTROYING:
+    aeriOS_c.ServiceActionTypeEnum.FINISHED,
+}
+
+
+def get_outbox() -> Outbox:
     '''
-        Staying on a loop and awaiting redpanda messages
-        Messages should be binary formated and modeled according to protobuf models in gitlab:
-          https://gitlab.aeriOS-project.eu/wp3/t3.3/specs 
+    Process wide outbox, created on first use
     '''
-    consumer = Consumer(consumer_config)
-    # Subscribe to the topic
-    consumer.subscribe([CONSUMER_TOPIC])
+    global _outbox  # pylint: disable=global-statement
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(sqlite_path=OUTBOX_SQLITE_PATH, ttl=OUTBOX_TTL)
+    return _outbox
+
 
+def get_orchestrated_service_id(input_protbuf_msg) -> str:
+    '''
+    Indirectly check which service is orchestrated:
+      Bad trick as allocation object "msg.service_component_allocations"
+          does not have a direct reference to service
+      but it is indircetly included in service components attributes.
+      All service components arriving in the portobuf msg are part of the same service
+      So just get the first components service attribute, it is the same for all
+    :param input_protbuf_msg: HLODeploymentEngineInput protobuf object
+    :return the service id
+    '''
+    first_allocation_component = input_protbuf_msg.service_component_allocations[
+        0]
+    first_service_component = first_allocation_component.new_allocated_service_component
+    if DEV:
+        logger.info(
+            "##################### service new_allocated_service_component: ########### %s",
+            first_service_component)
+    return first_service_component.service.id
+
+
+def classify_message(input_protbuf_msg) -> str:
+    '''
+    Work class used for scheduling:
+      OVERLOAD when a service component is moved away from an IE,
+      else the service action type (DEPLOYING/DESTROYING) from CB
+    '''
+    for allocation_component in input_protbuf_msg.service_component_allocations:
+        if allocation_component.old_allocated_infrastructure_element.id:
+            return aeriOS_c.ServiceComponentStatusEnum.OVERLOAD
     try:
-        while True:
-            msg = consumer.poll(timeout=1.0)
-            if msg is None:
-                # No message was received before the timeout expired.
-                continue
-            if msg.error():
-                if msg.error().code() == KafkaException:
-                    # End of partition event
-                    logger.error('%s %s reached end at offset %s\n',
-                                 msg.topic(), msg.partition(), {msg.offset()})
-                else:
-                    logger.error('Error recceiving message: %s', msg.error())
-                    raise KafkaException(msg.error())
+        action_type, _ = continuum_utils.get_service_action_type(
+            get_orchestrated_service_id(input_protbuf_msg))
+    except AttributeError:
+        # Service not found in CB, process_message will report it
+        logger.exception('Failed to classify message')
+        return aeriOS_c.ServiceActionTypeEnum.DEPLOYING
+    return action_type
+
+
+def get_message_domains(input_protbuf_msg) -> list:
+    '''
+    Target domain id of every service component of the input
+    '''
+    return [
+        allocation_component.new_allocated_service_component.
+        infrastructure_element.domain.id for allocation_component in
+        input_protbuf_msg.service_component_allocations
+    ]
+
+
+def process_message(input_protbuf_msg, msgs: list = None):
+    '''
+        Handle one HLODeploymentEngineInput:
+          resolve every service component against the continuum state,
+          set up service overlay when needed and
+          submit all remote (de)allocations.
+        Returns once every remote (de)allocation completed or was cancelled
+          because the deadline of the input was exceeded.
+        A new attempt of a kafka delivery that failed or crashed resumes from its outbox entry
+        :param msgs: the kafka messages the input was built from, None when received
+                     without kafka (such inputs are not resumed)
+        :return the DeploymentReport of the input
+    '''
+    report = DeploymentReport(get_orchestrated_service_id(input_protbuf_msg))
+    entry = get_outbox().open(msgs)
+    try:
+        # Every remote call of this input shares one budget, see app.utils.deadline
+        with deadline.deadline_scope(input_protbuf_msg.deadline_seconds or
+                                     MESSAGE_DEADLINE):
+            with RemoteAllocationDispatcher(report=report) as dispatcher:
+                dispatch_remote_allocations(input_protbuf_msg, dispatcher,
+                                            report, entry)
+        # Kept on failure, the next attempt resumes from it
+        get_outbox().finish(entry)
+        return report
+    except Exception as exc:
+        report.fail(exc)
+        if not msgs:
+            # Nothing redelivers it, so nothing would resume the entry
+            get_outbox().finish(entry)
+        raise
+    finally:
+        if RESULT_TOPIC:
+            publish_result(RESULT_TOPIC, report.to_protobuf())
+
+
+def dispatch_remote_allocations(input_protbuf_msg, dispatcher, report, entry):
+    '''
+        Resolve service components one by one and submit each remote (de)allocation
+          to dispatcher as soon as its own lookups are done,
+          so remote calls overlap with resolving the next components.
+        The wireguard server is set up once all its peers are known,
+          while the remote allocations are already running.
+        Stage timings and component outcomes are recorded in report (DeploymentReport).
+        Calls are recorded in the outbox entry before they are submitted; when the entry
+          was left by a previous attempt its unfinished calls are replayed and
+          the components it already planned are skipped
+    '''
+    # Overlay subnet used when creating new service and allocating its components
+    orchestrated_service_id = get_orchestrated_service_id(input_protbuf_msg)
+    with report.stage("service_lookup"):
+        orchestration_action_type, has_overlay = continuum_utils.get_service_action_type(
+            orchestrated_service_id)
+    if entry.resumed:
+        planned_action_type = entry.state.get("action_type")
+        # A previous attempt may already have marked its action handled in CB
+        if planned_action_type is not None and orchestration_action_type in (
+                planned_action_type, _HANDLED_ACTION_TYPES.get(planned_action_type)):
+            orchestration_action_type = planned_action_type
+            has_overlay = entry.state["has_overlay"]
+        else:
+            logger.warning(
+                "Service %s is %s in CB, dropping outbox entry planned for %s",
+                orchestrated_service_id, orchestration_action_type,
+                planned_action_type)
+            entry.reset()
+    report.action_type = orchestration_action_type
+
+    # wg server overlay configuration object, peers planned by a previous attempt included
+    wg_server_obect = list(entry.state.get("wg_peers", []))
+
+    # Calls planned by a previous attempt of this input and not done yet
+    for call_id, api_url, method_name, params in entry.unfinished():
+        logger.info("Replaying %s planned by a previous attempt", method_name)
+        dispatcher.submit(HLOALClient(api_url),
+                          method_name,
+                          params,
+                          on_done=functools.partial(entry.done, call_id))
+
+    # Just to avoid E0606 linter complaining
+    # We should not need this
+    host_domain_pk = None
+    host_domain_url = None
+    allowed_ips = None
+    handler_domain_url = None
+    overall_service_error = False
+    peer_overlay_ip = None
+
+    # Update service status
+    # Set from HLO-FrontEnd when action type starts and updated here that action concludes
+    if not entry.resumed:
+        continuum_utils.service_handled(
+            entity_id=orchestrated_service_id,
+            action_type=orchestration_action_type)
+        entry.update(action_type=orchestration_action_type,
+                     has_overlay=has_overlay)
+
+    # Check if we need overlay for this service
+    # If we have overlay, we need to create wireguard server and clients
+    # If we do not have overlay, we can not proceed with service deployment
+    if has_overlay:
+        logger.info("Service %s has overlay, action type: %s",
+                    orchestrated_service_id,
+                    orchestration_action_type)
+        # A. we are in service deploying action type,
+        #     so get all networking information needed to create overlay
+        #      i) wireguard and dnsmasquarade server localy
+        #     ii) wirguard client as scomponent sidecar in remote domains
+        if orchestration_action_type == aeriOS_c.ServiceActionTypeEnum.DEPLOYING:
+            if "overlay_subnet" in entry.state:
+                # Keep the subnet, and so the peer IPs, of the previous attempt
+                overlay_subnet = entry.state["overlay_subnet"]
             else:
-                # Process the message
-                event_data = msg.value()  #.decode('utf-8')
-                logger.info('Message received: %s', event_data)
-
-                if not event_data:
-                    logger.warning("Received empty message on kafka topic, skipping")
-                    consumer.commit(asynchronous=True)
-                    continue
-
-                #  Parse protobuf msg and get Service Id
-                input_protbuf_msg = parse_from_bytes(event_data)
-                # logger.info("Deserialize input from RedPanda: %s", input_protbuf_msg)
-                if not input_protbuf_msg.service_component_allocations:
-                    logger.warning(
-                        "Received message with no service_component_allocations, skipping: %s",
-                        input_protbuf_msg
-                    )
-                    consumer.commit(asynchronous=True)
-                    continue
-                method_calls = []
-                # wg server overlay configuration object
-                wg_server_obect = []
-
-                ##########################
-                # Overlay subnet used when creating new service and allocating its components
-                # Indirectly check which service is orchestrated:
-                #   Bad trick as allocation object "msg.service_component_allocations"
-                #       does not have a direct reference to service
-                #   but it is indircetly included in service components attributes.
-                #   All service components arriving in the portobuf msg are part of the same service
-                #   So just get the first components service attribute, it is the same for all
-                first_allocation_component = input_protbuf_msg.service_component_allocations[
-                    0]
-                first_service_component = first_allocation_component.new_allocated_service_component
-                if DEV:
-                    logger.info(
-                        "##################### service new_allocated_service_component: ########### %s",
-                        first_service_component)
-                orchestrated_service_id = first_service_component.service.id
-                orchestration_action_type, has_overlay = continuum_utils.get_service_action_type(
+                with report.stage("overlay_subnet"):
+                    overlay_subnet = k8s_shim_client.allocate_subnet(
+                        service_id=orchestrated_service_id)
+            logger.error(
+                "Overlay subnet allocated for service %s: %s",
+                orchestrated_service_id, overlay_subnet)
+            if not overlay_subnet:
+                # with no overlay we can not proceed, set flag to use it later
+                overall_service_error = True
+                logger.error(
+                    "Error while allocating subnet for service: %s",
                     orchestrated_service_id)
+                report.fail("overlay subnet allocation failed")
+            else:
+                allowed_ips = overlay_subnet
+                if "host_domain_url" in entry.state:
+                    host_domain_url = entry.state["host_domain_url"]
+                    host_domain_pk = entry.state["host_domain_pk"]
+                else:
+                    host_domain_url, host_domain_pk = continuum_utils.get_host_domain(
+                    )
+                    entry.update(overlay_subnet=overlay_subnet,
+                                 host_domain_url=host_domain_url,
+                                 host_domain_pk=host_domain_pk)
+                # e.g. if subnet is 10.0.0.0, (wg,dns)server will be 10.0.0.1
+                #      and clients will start on top of this (i.e. 10.0.0.2)
+                #      Remove subnet mask "/24" and then string to ip_address object
+                overlay_subnet_ip = ipaddress.ip_address(
+                    overlay_subnet.split('/')[0])
+                wg_dns_server_overlay_ip = overlay_subnet_ip + 1
+                peer_overlay_ip = ipaddress.ip_address(
+                    entry.state.get("peer_overlay_ip",
+                                    str(wg_dns_server_overlay_ip)))
+
+        # B. we are on service destroying
+        #   so take care to also remove service overlay
+        #   so find service handler domain and add method to call it
+        elif orchestration_action_type == aeriOS_c.ServiceActionTypeEnum.DESTROYING and \
+                not entry.state.get("overlay_destroy_planned"):
+            handler_domain_url = continuum_utils.get_service_handler_domain_url(
+                orchestrated_service_id)
+            if DEV:
+                logger.info("Using development HLO_AL")
+                overlay_handler_client = HLOALClient(
+                    f'{DEV_HLO_AL_URL}:{DEV_HLO_AL_PORT}')
+            else:
+                overlay_handler_client = HLOALClient(
+                    handler_domain_url)
+            _submit_planned(dispatcher,
+                            entry, [(overlay_handler_client,
+                                     "request_destroy_service_overlay", {
+                                         "service_id": orchestrated_service_id
+                                     })],
+                            overlay_destroy_planned=True)
+
+        # C. If we are in OVERLOAD we do not have to do something on service level
+        #    as this is a component level activity
+
+    # Resolve status and domain of all pending components up front,
+    #   a constant number of CB round trips whatever the number of components
+    pending_components = [
+        allocation_component for allocation_component in
+        input_protbuf_msg.service_component_allocations
+        if not entry.is_planned(
+            allocation_component.new_allocated_service_component.id)
+    ]
+    with report.stage("resolve"):
+        scomponent_statuses = continuum_utils.get_service_components_status([
+            allocation_component.new_allocated_service_component.id
+            for allocation_component in pending_components
+        ])
+        # Overloaded components are also deallocated from their old IE
+        domain_urls = continuum_utils.get_domain_urls([
+            allocation_component.new_allocated_service_component.
+            infrastructure_element.id
+            for allocation_component in pending_components
+        ] + [
+            allocation_component.old_allocated_infrastructure_element.id
+            for allocation_component in pending_components
+            if scomponent_statuses.get(allocation_component.
+                                       new_allocated_service_component.id)
+            == aeriOS_c.ServiceComponentStatusEnum.OVERLOAD
+        ])
+
+    # Components failed before any remote call, set to FAILED in one CB write
+    failed_scomponent_ids = []
+    # Now go component per component
+    for allocation_component in pending_components:
+        # a. Get (new_allocated)service_component id and
+        #           retrieve aeriOS continuum service component status
+        # b. STARTING/MIGRATING/REMOVING/OVERLOAD to act accordingly
+        # c. Get (new_allocated)service_component selcted_IE id and
+        #           retrieve selected domain URL.
+        #    Access Local Allocation Manager API for selected IE
+        #      "new_allocated_service_component.infrastructure_element.domain"
+        # d. Create Local Allocation Manager client with
+        #       Domain URL and AL_EP path and submit
+        scomponent_id = allocation_component.new_allocated_service_component.id
+        selected_ie_id = allocation_component.new_allocated_service_component.infrastructure_element.id
+        calls = []
+        if DEV:
+            logger.info("COMPONENT RECEIVED %s: %s", scomponent_id,
+                        allocation_component)
+        report.component(scomponent_id,
+                         domain_id=allocation_component.
+                         new_allocated_service_component.infrastructure_element.
+                         domain.id,
+                         ie_id=selected_ie_id)
+        selected_domain_url, selected_domain_pk = domain_urls[selected_ie_id]
+        # When developing, specify domain for Local Allocation Manager to use in config file
+        if DEV:
+            logger.info("Using development HLO_AL")
+            local_alocation_client = HLOALClient(
+                f'{DEV_HLO_AL_URL}:{DEV_HLO_AL_PORT}')
+        else:
+            local_alocation_client = HLOALClient(
+                selected_domain_url)
+        # local_alocation_client = HLOALClient(selected_domain_url)
+
+        service_component_status = scomponent_statuses.get(scomponent_id)
+        logger.info("Service component status received: %s",
+                    service_component_status)
 
-                # Just to avoid E0606 linter complaining
-                # We should not need this
-                host_domain_pk = None
-                host_domain_url = None
-                allowed_ips = None
-                handler_domain_url = None
-                overall_service_error = False
-
-                # Update service status
-                # Set from HLO-FrontEnd when action type starts and updated here that action concludes
-                continuum_utils.service_handled(
-                    entity_id=orchestrated_service_id,
-                    action_type=orchestration_action_type)
-
-                # Check if we need overlay for this service
-                # If we have overlay, we need to create wireguard server and clients
-                # If we do not have overlay, we can not proceed with service deployment
+        # A. Removing service component
+        if service_component_status == aeriOS_c.ServiceComponentStatusEnum.REMOVING:
+            logger.info("Deallocating %s: %s", scomponent_id,
+                        allocation_component)
+            calls.append((local_alocation_client,
+                          "request_deallocate_scompenent", {
+                              "service_id":
+                              "",
+                              "service_component_id":
+                              scomponent_id
+                          }))
+
+        # B. Allocating service component
+        elif service_component_status == aeriOS_c.ServiceComponentStatusEnum.STARTING:
+            if overall_service_error:
+                logger.error(
+                    "Setting %s to failed", allocation_component.
+                    new_allocated_service_component.id)
+                failed_scomponent_ids.append(scomponent_id)
+                report.set_status(scomponent_id,
+                                  aeriOS_c.ServiceComponentStatusEnum.FAILED,
+                                  "no overlay subnet")
+            else:
+                logger.info(
+                    "Service component To be allocated%s: %s",
+                    scomponent_id, allocation_component)
+                # If we have overlay, we need to create overlay wg objects
                 if has_overlay:
-                    logger.info("Service %s has overlay, action type: %s",
-                                orchestrated_service_id,
-                                orchestration_action_type)
-                    # A. we are in service deploying action type,
-                    #     so get all networking information needed to create overlay
-                    #      i) wireguard and dnsmasquarade server localy
-                    #     ii) wirguard client as scomponent sidecar in remote domains
-                    if orchestration_action_type == aeriOS_c.ServiceActionTypeEnum.DEPLOYING:
-                        overlay_subnet = k8s_shim_client.allocate_subnet(
-                            service_id=orchestrated_service_id)
-                        logger.error(
-                            "Overlay subnet allocated for service %s: %s",
-                            orchestrated_service_id, overlay_subnet)
-                        if not overlay_subnet:
-                            # with no overlay we can not proceed, set flag to use it later
-                            overall_service_error = True
-                            logger.error(
-                                "Error while allocating subnet for service: %s",
-                                orchestrated_service_id)
-                        else:
-                            allowed_ips = overlay_subnet
-                            host_domain_url, host_domain_pk = continuum_utils.get_host_domain(
-                            )
-                            # e.g. if subnet is 10.0.0.0, (wg,dns)server will be 10.0.0.1
-                            #      and clients will start on top of this (i.e. 10.0.0.2)
-                            #      Remove subnet mask "/24" and then string to ip_address object
-                            overlay_subnet_ip = ipaddress.ip_address(
-                                overlay_subnet.split('/')[0])
-                            wg_dns_server_overlay_ip = overlay_subnet_ip + 1
-                            peer_overlay_ip = wg_dns_server_overlay_ip
-
-                    # B. we are on service destroying
-                    #   so take care to also remove service overlay
-                    #   so find service handler domain and add method to call it
-                    elif orchestration_action_type == aeriOS_c.ServiceActionTypeEnum.DESTROYING:
-                        handler_domain_url = continuum_utils.get_service_handler_domain_url(
-                            orchestrated_service_id)
-                        if DEV:
-                            logger.info("Using development HLO_AL")
-                            overlay_handler_client = HLOALClient(
-                                f'{DEV_HLO_AL_URL}:{DEV_HLO_AL_PORT}')
-                        else:
-                            overlay_handler_client = HLOALClient(
-                                handler_domain_url)
-                        method_calls.append(
-                            (overlay_handler_client,
-                             "request_destroy_service_overlay", {
-                                 "service_id": orchestrated_service_id
-                             }))
-
-                    # C. If we are in OVERLOAD we do not have to do something on service level
-                    #    as this is a component level activity
-
-                # Now go component per component
-                for allocation_component in input_protbuf_msg.service_component_allocations:
-                    # a. Get (new_allocated)service_component id and
-                    #           retrieve aeriOS continuum service component status
-                    # b. STARTING/MIGRATING/REMOVING/OVERLOAD to act accordingly
-                    # c. Get (new_allocated)service_component selcted_IE id and
-                    #           retrieve selected domain URL.
-                    #    Access Local Allocation Manager API for selected IE
-                    #      "new_allocated_service_component.infrastructure_element.domain"
-                    # d. Create Local Allocation Manager client with
-                    #       Domain URL and AL_EP path and submit
-                    scomponent_id = allocation_component.new_allocated_service_component.id
-                    selected_ie_id = allocation_component.new_allocated_service_component.infrastructure_element.id
-                    if DEV:
-                        logger.info("COMPONENT RECEIVED %s: %s", scomponent_id,
-                                    allocation_component)
-                    selected_domain_url, selected_domain_pk = continuum_utils.get_domain_url(
-                        selected_ie_id)
-                    # When developing, specify domain for Local Allocation Manager to use in config file
-                    if DEV:
-                        logger.info("Using development HLO_AL")
-                        local_alocation_client = HLOALClient(
-                            f'{DEV_HLO_AL_URL}:{DEV_HLO_AL_PORT}')
-                    else:
-                        local_alocation_client = HLOALClient(
-                            selected_domain_url)
-                    # local_alocation_client = HLOALClient(selected_domain_url)
-
-                    service_component_status = continuum_utils.get_service_component_status(
-                        service_component_id=scomponent_id)
-                    logger.info("Service component status received: %s",
-                                service_component_status)
-
-                    # A. Removing service component
-                    if service_component_status == aeriOS_c.ServiceComponentStatusEnum.REMOVING:
-                        logger.info("Deallocating %s: %s", scomponent_id,
-                                    allocation_component)
-                        method_calls.append((local_alocation_client,
-                                             "request_deallocate_scompenent", {
-                                                 "service_id":
-                                                 "",
-                                                 "service_component_id":
-                                                 scomponent_id
-                                             }))
-
-                    # B. Allocating service component
-                    elif service_component_status == aeriOS_c.ServiceComponentStatusEnum.STARTING:
-                        if overall_service_error:
-                            logger.error(
-                                "Setting %s to failed", allocation_component.
-                                new_allocated_service_component.id)
-                            continuum_utils.set_service_component_status(
-                                service_id=orchestrated_service_id,
-                                scomponent_id=allocation_component.
-                                new_allocated_service_component.id,
-                                scomponent_status=aeriOS_c.
-                                ServiceComponentStatusEnum.FAILED)
-                        else:
-                            logger.info(
-                                "Service component To be allocated%s: %s",
-                                scomponent_id, allocation_component)
-                            # If we have overlay, we need to create overlay wg objects
-                            if has_overlay:
-                                # get a private/public key per service component
-                                scomponent_private_key, scomponent_public_key = tools.generate_wireguard_keys(
-                                )
-                                peer_overlay_ip += 1
-                                scomponent_name = scomponent_id.split(":")[-1]
-                                conf = {
-                                    "Address":
-                                    str(peer_overlay_ip),
-                                    "DNS":
-                                    str(wg_dns_server_overlay_ip),
-                                    "PublicKey":
-                                    host_domain_pk,
-                                    "Endpoint":
-                                    generate_wireguard_server_url(
-                                        host_domain_url=host_domain_url),
-                                    "AllowedIPs":
-                                    allowed_ips,
-                                    "PrivateKey":
-                                    scomponent_private_key
-                                }
-                                remote_wg_client_conf = LAModels.WgClientConf(
-                                    **conf)
-                                wg_server_obect.append({
-                                    "name":
-                                    f"{scomponent_name}",
-                                    "peer_public_key":
-                                    scomponent_public_key,
-                                    "peer_overlay_ip":
-                                    str(peer_overlay_ip)
-                                })
-                            else:
-                                remote_wg_client_conf = {}
-                            method_calls.append(
-                                (local_alocation_client,
-                                 "request_allocate_scompenent", {
-                                     "service_id":
-                                     "",
-                                     "scomponent_allocation":
-                                     allocation_component.
-                                     new_allocated_service_component,
-                                     "overlay_conf":
-                                     remote_wg_client_conf
-                                 }))
-
-                    #C. Migrating service component
-                    # CHECKME Please: Not validated!!
-                    elif service_component_status == aeriOS_c.ServiceComponentStatusEnum.OVERLOAD:
-                        logger.info(
-                            "Overload, reallocating service component %s: %s",
-                            scomponent_id, allocation_component)
-                        # Selecting Domain to request de-allocation (due to overload)
-                        overloaded_ie_id = allocation_component.old_allocated_infrastructure_element.id
-                        overloaded_selected_domain_url = continuum_utils.get_domain_url(
-                            overloaded_ie_id)
-                        overloaded_local_alocation_client = HLOALClient(
-                            overloaded_selected_domain_url)
-
-                        # this seems ok, deallocate works the same......
-                        method_calls.append((overloaded_local_alocation_client,
-                                             "request_deallocate_scompenent", {
-                                                 "service_id":
-                                                 "",
-                                                 "service_component_id":
-                                                 scomponent_id
-                                             }))
-                        # a) first get network deployment obj from LLO API
-                        remote_wg_client_conf = llo_api_client.LLORESTClient(
-                        ).get_network_overlay_deployment_parameters(
-                            scomponent_id=scomponent_id)
-                        if DEV:
-                            logger.info(
-                                "Networking object for re-allocation: %s",
-                                remote_wg_client_conf)
-                        # b) send full allocation reques to remote (new) LA API
-                        method_calls.append(
-                            (local_alocation_client,
-                             "request_allocate_scompenent", {
-                                 "service_id": "",
-                                 "scomponent_allocation": allocation_component.
-                                 new_allocated_service_component,
-                                 "overlay_conf": remote_wg_client_conf
-                             }))
-                    else:
-                        logger.info(
-                            "Could not classify service component status received: %s",
-                            service_component_status)
-
-                # We will only get in if hasOverlay is True which menas wg_server_object is not empty
-                if wg_server_obect:
-                    logger.info("Setting up local wireguard server")
-                    # Add wireguard server details
+                    # get a private/public key per service component
+                    scomponent_private_key, scomponent_public_key = tools.generate_wireguard_keys(
+                    )
+                    peer_overlay_ip += 1
+                    scomponent_name = scomponent_id.split(":")[-1]
+                    conf = {
+                        "Address":
+                        str(peer_overlay_ip),
+                        "DNS":
+                        str(wg_dns_server_overlay_ip),
+                        "PublicKey":
+                        host_domain_pk,
+                        "Endpoint":
+                        generate_wireguard_server_url(
+                            host_domain_url=host_domain_url),
+                        "AllowedIPs":
+                        allowed_ips,
+                        "PrivateKey":
+                        scomponent_private_key
+                    }
+                    remote_wg_client_conf = LAModels.WgClientConf(
+                        **conf)
                     wg_server_obect.append({
                         "name":
-                        "WG server",
+                        f"{scomponent_name}",
                         "peer_public_key":
-                        "we_do_not_care_about_this",
+                        scomponent_public_key,
                         "peer_overlay_ip":
-                        str(wg_dns_server_overlay_ip),
-                        "is_master":
-                        True
+                        str(peer_overlay_ip)
                     })
-                    # Call k8s-shim to create wg server
-                    k8s_shim_client.setup_wireguard_server(
-                        service_id=orchestrated_service_id,
-                        wg_clients=wg_server_obect)
-
-                logger.info("Ready to call all remote (de)allocations")
-                submit_remote_allocations(method_calls)
-
-                consumer.commit(asynchronous=True)
-    except KeyboardInterrupt:
-        pass
-    except Exception:
-        logger.exception(
-            'An exception while processing msg in Deployment Engine')
-    finally:
-        # Close the consumer
-        logger.info('Closing kafka consumer')
-        consumer.close()
-        run()
+                else:
+                    remote_wg_client_conf = {}
+                calls.append((
+                    local_alocation_client,
+                    "request_allocate_scompenent", {
+                        "service_id":
+                        "",
+                        "scomponent_allocation":
+                        allocation_component.
+                        new_allocated_service_component,
+                        "overlay_conf":
+                        remote_wg_client_conf
+                    }))
+
+        #C. Migrating service component
+        # CHECKME Please: Not validated!!
+        elif service_component_status == aeriOS_c.ServiceComponentStatusEnum.OVERLOAD:
+            logger.info(
+                "Overload, reallocating service component %s: %s",
+                scomponent_id, allocation_component)
+            # Selecting Domain to request de-allocation (due to overload)
+            overloaded_ie_id = allocation_component.old_allocated_infrastructure_element.id
+            overloaded_selected_domain_url, _ = domain_urls[overloaded_ie_id]
+            overloaded_local_alocation_client = HLOALClient(
+                overloaded_selected_domain_url)
+
+            # this seems ok, deallocate works the same......
+            calls.append((overloaded_local_alocation_client,
+                          "request_deallocate_scompenent", {
+                              "service_id":
+                              "",
+                              "service_component_id":
+                              scomponent_id
+                          }))
+            # a) first get network deployment obj from LLO API
+            remote_wg_client_conf = llo_api_client.LLORESTClient(
+            ).get_network_overlay_deployment_parameters(
+                scomponent_id=scomponent_id)
+            if DEV:
+                logger.info(
+                    "Networking object for re-allocation: %s",
+                    remote_wg_client_conf)
+            # b) send full allocation reques to remote (new) LA API
+            calls.append((
+                local_alocation_client,
+                "request_allocate_scompenent", {
+                    "service_id": "",
+                    "scomponent_allocation": allocation_component.
+                    new_allocated_service_component,
+                    "overlay_conf": remote_wg_client_conf
+                }))
+        else:
+            logger.info(
+                "Could not classify service component status received: %s",
+                service_component_status)
+            report.set_status(scomponent_id, service_component_status or "")
+
+        _submit_planned(
+            dispatcher,
+            entry,
+            calls,
+            planned=entry.state.get("planned", []) + [scomponent_id],
+            wg_peers=list(wg_server_obect),
+            peer_overlay_ip=str(peer_overlay_ip) if peer_overlay_ip else None)
+
+    if failed_scomponent_ids:
+        continuum_utils.set_service_components_status(
+            scomponent_ids=failed_scomponent_ids,
+            scomponent_status=aeriOS_c.ServiceComponentStatusEnum.FAILED)
+
+    # We will only get in if hasOverlay is True which menas wg_server_object is not empty
+    if wg_server_obect and not entry.state.get("wg_server_done"):
+        logger.info("Setting up local wireguard server")
+        # Add wireguard server details
+        wg_server_obect.append({
+            "name":
+            "WG server",
+            "peer_public_key":
+            "we_do_not_care_about_this",
+            "peer_overlay_ip":
+            str(wg_dns_server_overlay_ip),
+            "is_master":
+            True
+        })
+        # Call k8s-shim to create wg server
+        with report.stage("wireguard_server"):
+            k8s_shim_client.setup_wireguard_server(
+                service_id=orchestrated_service_id,
+                wg_clients=wg_server_obect)
+        entry.update(wg_server_done=True)
+
+    logger.info("Waiting for all remote (de)allocations")
+
+
+def _submit_planned(dispatcher, entry, calls: list, **state):
+    '''
+    Record calls [(HLOALClient, method_name, params)] and the planning state in the
+      outbox entry, then submit them; each call is marked done once it completed
+    '''
+    call_ids = entry.plan([(client.api_url, method_name, params)
+                           for client, method_name, params in calls], **state)
+    for call_id, (client, method_name, params) in zip(call_ids, calls):
+        dispatcher.submit(client,
+                          method_name,
+                          params,
+                          on_done=functools.partial(entry.done, call_id))
+
+
+class DeploymentEngineConsumer:
+    '''
+        Kafka side of the Deployment Engine.
+        Polls HLODeploymentEngineInput messages and hands them to process_message,
+          inline, on keyed workers (LOOP_WORKERS > 1)
+          or as coalesced batches (LOOP_BATCH_SIZE > 1).
+        With SCHEDULER_WINDOW > 0 polled messages wait in a PriorityScheduler
+          and are processed by class, estimated cost and age instead of arrival order.
+        Messages are polled by a PollingIntake thread (INTAKE_QUEUE_SIZE > 0),
+          offsets are committed through OffsetTracker,
+          failed messages go to the retry/dead letter topics when RETRY_TOPIC is set.
+    '''
+
+    def __init__(self, consumer=None, producer=None):
+        self.consumer = consumer or Consumer(consumer_config)
+        # Only contiguous completed offsets are committed, see OffsetTracker,
+        #   and only once the status updates written behind for them are in CB
+        self.offset_tracker = OffsetTracker(
+            self.consumer,
+            commit_interval=COMMIT_INTERVAL,
+            commit_every=COMMIT_EVERY,
+            before_commit=continuum_utils.flush_service_component_updates)
+        self.worker_pool = None
+        if LOOP_WORKERS > 1:
+            logger.info("Processing messages with %s keyed workers",
+                        LOOP_WORKERS)
+            self.worker_pool = KeyedWorkerPool(
+                workers=LOOP_WORKERS, queue_size=LOOP_WORKER_QUEUE_SIZE)
+        self.dedup = None
+        if DEDUP_MAX_ENTRIES > 0:
+            self.dedup = DedupStore(max_entries=DEDUP_MAX_ENTRIES,
+                                    ttl=DEDUP_TTL,
+                                    sqlite_path=DEDUP_SQLITE_PATH)
+        self.scheduler = None
+        if SCHEDULER_WINDOW > 0:
+            self.scheduler = PriorityScheduler(aging=SCHEDULER_AGING)
+        # Worker failures with no retry topic, raised on the polling thread by step()
+        self._worker_errors = queue.SimpleQueue()
+        topics = [CONSUMER_TOPIC]
+        self.retry_router = None
+        if RETRY_TOPIC:
+            self.retry_router = RetryRouter(producer or get_producer(),
+                                            retry_topic=RETRY_TOPIC,
+                                            dlq_topic=DLQ_TOPIC,
+                                            max_attempts=RETRY_MAX_ATTEMPTS,
+                                            backoff_base=RETRY_BACKOFF_BASE,
+                                            backoff_max=RETRY_BACKOFF_MAX)
+            topics.append(RETRY_TOPIC)
+        # Subscribe to the topic
+        self.consumer.subscribe(topics, on_revoke=self._on_revoke)
+        # Poll on a dedicated thread so long fan-outs do not exceed max.poll.interval.ms
+        self.intake = None
+        if INTAKE_QUEUE_SIZE > 0:
+            self.intake = PollingIntake(
+                self.consumer,
+                admit=self._admit,
+                max_queued=INTAKE_QUEUE_SIZE,
+                keep_paused=self.retry_router.is_deferred
+                if self.retry_router else None)
+            self.intake.start()
+
+    def _on_revoke(self, consumer, partitions):
+        self.offset_tracker.on_revoke(consumer, partitions)
+        if self.retry_router:
+            self.retry_router.forget(partitions)
+        if self.intake:
+            self.intake.discard(partitions)
+        if self.scheduler is not None:
+            revoked = {(partition.topic, partition.partition)
+                       for partition in partitions}
+            self.scheduler.discard(lambda item: (item[0].topic(), item[0].partition())
+                                   in revoked)
+
+    def _admit(self, msg) -> bool:
+        '''
+        Check a polled message and track it as in flight
+        :return False if it must not be processed (EOF event, retry not yet due)
+        '''
+        if msg.error():
+            _handle_message_error(msg)
+            return False
+        if self.retry_router and self.retry_router.defer_if_not_due(
+                self.consumer, msg):
+            return False
+        self.offset_tracker.track(msg)
+        return True
+
+    def step(self):
+        '''
+        Poll and process one message, or one batch in batch mode
+        '''
+        if not self._worker_errors.empty():
+            raise self._worker_errors.get()
+        self.offset_tracker.maybe_commit()
+        if self.retry_router:
+            self.retry_router.poll()
+            self.retry_router.resume_due(self.consumer)
+        if LOOP_BATCH_SIZE > 1:
+            self._step_batch()
+            return
+        if self.scheduler is not None:
+            self._step_scheduled()
+            return
+        for msg in self._receive(1, timeout=1.0):
+            input_protbuf_msg = self._prepare(msg)
+            if input_protbuf_msg is not None:
+                self._dispatch(get_orchestrated_service_id(input_protbuf_msg),
+                               [msg], input_protbuf_msg)
+
+    def _step_batch(self):
+        '''
+        Consume up to LOOP_BATCH_SIZE messages, coalesce them per service
+          and process each service once.
+        Offsets of the whole batch are committed once, after all services are done
+        '''
+        inputs = []
+        # service_id -> kafka messages coalesced in it
+        service_msgs = {}
+        for msg in self._receive(LOOP_BATCH_SIZE, timeout=LOOP_BATCH_TIMEOUT):
+            input_protbuf_msg = self._prepare(msg)
+            if input_protbuf_msg is None:
+                continue
+            inputs.append(input_protbuf_msg)
+            service_msgs.setdefault(
+                get_orchestrated_service_id(input_protbuf_msg), []).append(msg)
+        if not inputs:
+            return
+
+        for service_id, service_input in coalesce_inputs(inputs).items():
+            self._dispatch(service_id, service_msgs[service_id], service_input)
+        if self.worker_pool is not None:
+            self.worker_pool.join()
+        self.offset_tracker.commit(asynchronous=False)
+
+    def _step_scheduled(self):
+        '''
+        Move polled messages into the priority scheduler and process its best pick
+        '''
+        workers_busy = (self.worker_pool is not None and
+                        self.worker_pool.pending() >= self.worker_pool.workers)
+        if not self.scheduler:
+            timeout = 1.0
+        else:
+            # Only wait when there is no capacity to take work from the scheduler
+            timeout = 0.05 if workers_busy else 0
+        room = max(SCHEDULER_WINDOW - len(self.scheduler), 0)
+        for msg in self._receive(room, timeout=timeout) if room else []:
+            input_protbuf_msg = self._prepare(msg)
+            if input_protbuf_msg is not None:
+                self.scheduler.push(
+                    get_orchestrated_service_id(input_protbuf_msg),
+                    (msg, input_protbuf_msg),
+                    work_class=classify_message(input_protbuf_msg),
+                    domains=get_message_domains(input_protbuf_msg))
+        if workers_busy:
+            return
+        work = self.scheduler.pop()
+        if work is None:
+            return
+        service_id, (msg, input_protbuf_msg) = work
+        self._dispatch(service_id, [msg], input_protbuf_msg)
+
+    def _receive(self, max_messages: int, timeout: float) -> list:
+        '''
+        Up to max_messages admitted messages, from the intake thread or polled here
+        '''
+        if self.intake is not None:
+            return self.intake.get_batch(max_messages, timeout=timeout)
+        return self._consume_batch(max_messages, timeout)
+
+    def _consume_batch(self, max_messages: int, timeout: float) -> list:
+        '''
+        Consume and admit up to max_messages messages directly from the consumer
+        '''
+        admitted = []
+        deferred_partitions = set()
+        for msg in self.consumer.consume(num_messages=max_messages,
+                                         timeout=timeout):
+            partition_key = (msg.topic(), msg.partition())
+            # Everything after a deferred retry message is consumed again on resume
+            if partition_key in deferred_partitions:
+                continue
+            if self._admit(msg):
+                admitted.append(msg)
+            elif self.retry_router and self.retry_router.is_deferred(
+                    *partition_key):
+                deferred_partitions.add(partition_key)
+        return admitted
+
+    def _prepare(self, msg):
+        '''
+        Skip already completed messages and decode the others
+        :return HLODeploymentEngineInput or None if there is nothing to process
+        '''
+        if self._already_completed(msg):
+            return None
+        try:
+            input_protbuf_msg = decode_message(msg)
+        except DecodeError as exc:
+            self._fail([msg], exc, retriable=False)
+            return None
+        if input_protbuf_msg is None:
+            self.offset_tracker.done(msg)
+        return input_protbuf_msg
+
+    def _dispatch(self, service_id: str, msgs: list, input_protbuf_msg):
+        '''
+        Process an input inline or on the worker owning service_id
+        :param msgs: the kafka messages the input was built from
+        '''
+        if self.worker_pool is None:
+            try:
+                self._process(input_protbuf_msg, msgs)
+            except Exception as exc:  # pylint: disable=broad-except
+                self._fail(msgs, exc)
+                return
+            self._completed(msgs)
+        else:
+            self.worker_pool.submit(service_id,
+                                    self._process,
+                                    input_protbuf_msg,
+                                    msgs,
+                                    callback=self._worker_callback(msgs))
+
+    def _process(self, input_protbuf_msg, msgs: list):
+        started = time.monotonic()
+        process_message(input_protbuf_msg, msgs)
+        if self.scheduler is not None:
+            self.scheduler.observe(get_message_domains(input_protbuf_msg),
+                                   time.monotonic() - started)
+
+    def _already_completed(self, msg) -> bool:
+        '''
+        Skip a tracked message already completed before a redelivery
+        '''
+        if self.dedup is None or not self.dedup.seen(message_key(msg)):
+            return False
+        logger.info("Skipping already completed message %s/%s/%s",
+                    msg.topic(), msg.partition(), msg.offset())
+        self.offset_tracker.done(msg)
+        return True
+
+    def _completed(self, msgs: list):
+        '''
+        Mark successfully processed messages done and remember them for dedup
+        '''
+        for msg in msgs:
+            if self.dedup is not None:
+                self.dedup.add(message_key(msg))
+            self.offset_tracker.done(msg)
+
+    def _fail(self, msgs: list, error: Exception, retriable: bool = True):
+        '''
+        Hand failed messages to the retry router.
+        Without RETRY_TOPIC the error is raised and the messages are redelivered.
+        The outbox entries of dead lettered messages are dropped
+        '''
+        if self.retry_router is None:
+            raise error
+        for msg in msgs:
+            retried = self.retry_router.publish_failure(
+                msg,
+                error,
+                retriable=retriable,
+                on_published=functools.partial(self.offset_tracker.done, msg))
+            if not retried:
+                get_outbox().abandon(msg)
+
+    def _worker_callback(self, msgs: list):
+        '''
+        Build a worker callback marking msgs done once they have been processed.
+        Without RETRY_TOPIC a failed message stays in flight and its error is
+          raised by the next step(), so the supervisor rewinds and redelivers it
+        '''
+
+        def callback(_result, error):
+            if error is None:
+                self._completed(msgs)
+            elif self.retry_router is not None:
+                self._fail(msgs, error)
+            else:
+                self._worker_errors.put(error)
+
+        return callback
+
+    def recover(self):
+        '''
+        Bring the consumer back to a consistent state after step() raised:
+          wait for the workers, commit what is done and
+          rewind every partition to its first unfinished message
+        '''
+        if self.worker_pool is not None:
+            self.worker_pool.join()
+        with (self.intake.suspended()
+              if self.intake else contextlib.nullcontext()):
+            # The rewind below redelivers every failed message anyway
+            while not self._worker_errors.empty():
+                self._worker_errors.get()
+            if self.scheduler is not None:
+                self.scheduler.discard(lambda _item: True)
+            self.offset_tracker.commit(asynchronous=False)
+            for position in self.offset_tracker.rewind():
+                logger.info("Rewinding %s [%s] to offset %s", position.topic,
+                            position.partition, position.offset)
+                self.consumer.seek(position)
+
+    def stats(self) -> dict:
+        '''
+        Consumer side counters
+        '''
+        stats = {
+            "in_flight": self.offset_tracker.in_flight(),
+            "commits": self.offset_tracker.commits,
+        }
+        if self.intake is not None:
+            stats["intake_queue"] = self.intake.qsize()
+            stats["intake_pauses"] = self.intake.pauses
+        if self.worker_pool is not None:
+            stats["worker_queue"] = self.worker_pool.pending()
+        if self.retry_router is not None:
+            stats["retried"] = self.retry_router.retried
+            stats["dead_lettered"] = self.retry_router.dead_lettered
+        if self.scheduler is not None:
+            stats["scheduled"] = len(self.scheduler)
+        if self.dedup is not None:
+            stats.update(self.dedup.stats())
+        return stats
+
+    def close(self):
+        '''
+        Drain workers, flush the updates written behind,
+          commit completed offsets and close the consumer
+        '''
+        if self.intake is not None:
+            self.intake.stop()
+        if self.worker_pool is not None:
+            # Let queued messages finish before the consumer goes away
+            self.worker_pool.shutdown(wait=True)
+        if self.retry_router is not None:
+            self.retry_router.flush()
+        if RESULT_TOPIC:
+            get_producer().flush()
+        # Flushed even when no offset is left to commit
+        continuum_utils.flush_service_component_updates()
+        self.offset_tracker.commit(asynchronous=False)
+        self.consumer.close()
+        if self.dedup is not None:
+            self.dedup.close()
+
+
+def run():
+    '''
+        Staying on a loop and awaiting redpanda messages
+        Messages should be binary formated and modeled according to protobuf models in gitlab:
+          https://gitlab.aeriOS-project.eu/wp3/t3.3/specs 
+        See DeploymentEngineConsumer for the processing modes.
+        Failures are recovered by ConsumerSupervisor on the same consumer.
+    '''
+    global supervisor  # pylint: disable=global-statement
+    # Load the topology index before the first message needs it
+    get_topology_index()
+    supervisor = ConsumerSupervisor(DeploymentEngineConsumer,
+                                    backoff_base=SUPERVISOR_BACKOFF_BASE,
+                                    backoff_max=SUPERVISOR_BACKOFF_MAX)
+    supervisor.run()
+
+
+def submit_input(input_protbuf_msg) -> concurrent.futures.Future:
+    '''
+    Process an HLODeploymentEngineInput received without kafka, e.g. over HTTP.
+    It runs process_message on a keyed worker, so inputs of the same service
+      are handled in arrival order. Never blocks, e.g. on the API event loop
+    :return Future resolved with the DeploymentReport once process_message returned,
+              or with its exception
+    :raise queue.Full when the queue of the worker (LOOP_WORKER_QUEUE_SIZE) is full
+    '''
+    global _ingest_pool  # pylint: disable=global-statement
+    with _ingest_pool_lock:
+        if _ingest_pool is None:
+            _ingest_pool = KeyedWorkerPool(workers=INGEST_WORKERS,
+                                           queue_size=LOOP_WORKER_QUEUE_SIZE)
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
+
+    def resolve(result, error):
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    _ingest_pool.submit(get_orchestrated_service_id(input_protbuf_msg),
+                        process_message,
+                        input_protbuf_msg,
+                        callback=resolve,
+                        block=False)
+    return future
+
+
+def get_consumer_stats() -> dict:
+    '''
+    Supervisor and consumer counters of the running loop, empty if not started
+    '''
+    if supervisor is None:
+        return {}
+    stats = supervisor.stats()
+    if supervisor.engine is not None:
+        stats.update(supervisor.engine.stats())
+    return stats
+
+
+def decode_message(msg):
+    '''
+    Parse the protobuf payload of a kafka message
+    :param msg: confluent_kafka Message without error
+    :return HLODeploymentEngineInput or None when there is nothing to process
+    '''
+    event_data = msg.value()  #.decode('utf-8')
+    logger.info('Message received: %s', event_data)
+
+    if not event_data:
+        logger.warning("Received empty message on kafka topic, skipping")
+        return None
+
+    #  Parse protobuf msg and get Service Id
+    input_protbuf_msg = parse_from_bytes(event_data)
+    # logger.info("Deserialize input from RedPanda: %s", input_protbuf_msg)
+    if not input_protbuf_msg.service_component_allocations:
+        logger.warning(
+            "Received message with no service_component_allocations, skipping: %s",
+            input_protbuf_msg)
+        return None
+    return input_protbuf_msg
+
+
+def _handle_message_error(msg):
+    '''
+    Log partition EOF events, raise on any other consumer error
+    '''
+    if msg.error().code() == KafkaException:
+        # End of partition event
+        logger.error('%s %s reached end at offset %s\n', msg.topic(),
+                     msg.partition(), {msg.offset()})
+    else:
+        logger.error('Error recceiving message: %s', msg.error())
+        raise KafkaException(msg.error())
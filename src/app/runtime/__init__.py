@@ -0,0 +1,3 @@
+'''
+    Runtime building blocks for the Deployment Engine kafka loop
+'''
@@ -0,0 +1,68 @@
+'''
+    Coalescing of a window of HLODeploymentEngineInput messages.
+    Action type (DEPLOYING/DESTROYING) and service component status are read
+      from CB when a message is processed, so every message of a service in the
+      window would act on the same, latest, continuum state.
+    Merging them in one input per service, with the latest allocation per
+      service component, runs that state once:
+        a component re-allocated within the window is (de)allocated only to its
+          last selected IE,
+        a deploy cancelled by a later destroy never allocates subnet, keys or
+          remote service components, only the destroy is executed.
+'''
+from collections import OrderedDict
+from app.app_models.py_files import deployment_engine_pb2 as deployment_engine
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+def coalesce_inputs(inputs: list) -> "OrderedDict[str, object]":
+    '''
+    Group inputs by service and collapse superseded service component allocations
+    :param inputs: list of HLODeploymentEngineInput, in arrival order
+    :return OrderedDict service_id -> merged HLODeploymentEngineInput,
+            services ordered by first arrival
+    '''
+    # service_id -> OrderedDict(scomponent_id -> ServiceComponentAllocation)
+    per_service = OrderedDict()
+    # service_id -> tightest deadline_seconds requested in the window
+    deadlines = {}
+    received = 0
+    for input_protbuf_msg in inputs:
+        for allocation in input_protbuf_msg.service_component_allocations:
+            received += 1
+            scomponent = allocation.new_allocated_service_component
+            components = per_service.setdefault(scomponent.service.id,
+                                                OrderedDict())
+            previous = components.pop(scomponent.id, None)
+            merged = deployment_engine.ServiceComponentAllocation()
+            merged.CopyFrom(allocation)
+            # Component moved twice in the window: it still has to be
+            # removed from where it was before the first move
+            if previous is not None and previous.HasField(
+                    'old_allocated_infrastructure_element'):
+                merged.old_allocated_infrastructure_element.CopyFrom(
+                    previous.old_allocated_infrastructure_element)
+            # Re-insert so the order follows the latest allocation
+            components[scomponent.id] = merged
+            if input_protbuf_msg.deadline_seconds:
+                deadlines[scomponent.service.id] = min(
+                    deadlines.get(scomponent.service.id,
+                                  input_protbuf_msg.deadline_seconds),
+                    input_protbuf_msg.deadline_seconds)
+
+    coalesced = OrderedDict()
+    kept = 0
+    for service_id, components in per_service.items():
+        service_input = deployment_engine.HLODeploymentEngineInput()
+        service_input.service_component_allocations.extend(
+            components.values())
+        service_input.deadline_seconds = deadlines.get(service_id, 0)
+        coalesced[service_id] = service_input
+        kept += len(components)
+    if received != kept or len(inputs) != len(coalesced):
+        logger.info(
+            "Coalesced %s messages (%s allocations) into %s services (%s allocations)",
+            len(inputs), received, len(coalesced), kept)
+    return coalesced
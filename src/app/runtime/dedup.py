@@ -0,0 +1,127 @@
+'''
+    Deduplication of redelivered kafka messages.
+    After a rebalance or a rewind the same message is consumed again; re-running it means
+      a new subnet, new WireGuard keys and remote allocations failing with 409 anyway.
+    Completed messages are remembered, keyed by topic/partition/offset and a digest of the
+      protobuf bytes, in a bounded LRU with TTL, optionally persisted in a local SQLite file
+      so the entries survive a process restart.
+'''
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+def message_key(msg) -> str:
+    '''
+    Dedup key of a kafka message: topic:partition:offset:sha256(value)
+    '''
+    digest = hashlib.sha256(msg.value() or b'').hexdigest()
+    return f"{msg.topic()}:{msg.partition()}:{msg.offset()}:{digest}"
+
+
+class DedupStore:
+    '''
+        Bounded LRU/TTL set of completed message keys
+    '''
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 ttl: float = 3600.0,
+                 sqlite_path: str = None,
+                 clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # key -> completion timestamp, oldest used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, completed_at REAL)"
+            )
+            self._db.commit()
+            self._load()
+
+    def _load(self):
+        '''
+        Load the most recent non expired entries from SQLite
+        '''
+        oldest = self.clock() - self.ttl
+        self._db.execute("DELETE FROM dedup WHERE completed_at < ?", (oldest, ))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT key, completed_at FROM dedup ORDER BY completed_at DESC LIMIT ?",
+            (self.max_entries, )).fetchall()
+        for key, completed_at in reversed(rows):
+            self._entries[key] = completed_at
+        logger.info("Loaded %s dedup entries", len(rows))
+
+    def seen(self, key: str) -> bool:
+        '''
+        Whether key was completed within ttl; counts hits and misses
+        '''
+        with self._lock:
+            completed_at = self._entries.get(key)
+            if completed_at is not None and self.clock(
+            ) - completed_at > self.ttl:
+                self._remove(key)
+                completed_at = None
+            if completed_at is None:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, key: str):
+        '''
+        Remember key as completed
+        '''
+        now = self.clock()
+        with self._lock:
+            self._entries[key] = now
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO dedup (key, completed_at) VALUES (?, ?)",
+                    (key, now))
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+            if self._db is not None:
+                self._db.commit()
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM dedup WHERE key = ?", (key, ))
+
+    def stats(self) -> dict:
+        '''
+        Hit and miss counters
+        '''
+        with self._lock:
+            return {
+                "dedup_hits": self.hits,
+                "dedup_misses": self.misses,
+                "dedup_entries": len(self._entries),
+            }
+
+    def close(self):
+        '''
+        Close the SQLite file, if any
+        '''
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
@@ -0,0 +1,168 @@
+'''
+    Kafka intake thread.
+    Polling is separated from processing: a dedicated thread keeps calling poll(),
+      so heartbeats and max.poll.interval.ms are honoured while a long fan-out runs,
+      and hands messages to the processing side through a bounded queue.
+    When the queue is full the assigned partitions are paused (poll() keeps being
+      called but returns no messages) and resumed once it drained to resume_at.
+'''
+import collections
+import contextlib
+import threading
+import time
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+class PollingIntake:
+    '''
+        Poll thread feeding a bounded hand-off queue with pause/resume backpressure.
+        admit(msg) -> bool runs on the poll thread for every polled message
+          (error handling, offset tracking), only admitted messages are queued.
+        keep_paused(topic, partition) -> bool tells which partitions paused by
+          someone else (e.g. deferred retries) must not be resumed here.
+    '''
+
+    def __init__(self,
+                 consumer,
+                 admit,
+                 max_queued: int = 100,
+                 resume_at: int = None,
+                 poll_timeout: float = 1.0,
+                 keep_paused=None):
+        self.consumer = consumer
+        self.admit = admit
+        self.max_queued = max_queued
+        self.resume_at = max_queued // 2 if resume_at is None else resume_at
+        self.poll_timeout = poll_timeout
+        self.keep_paused = keep_paused
+        self._queue = collections.deque()
+        self._not_empty = threading.Condition()
+        # Held by the poll thread around every poll, see suspended()
+        self._poll_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._paused = []
+        self._thread = None
+        self.pauses = 0
+
+    def start(self):
+        '''
+        Start the poll thread
+        '''
+        self._thread = threading.Thread(target=self._poll_loop,
+                                        name="de-intake",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop the poll thread
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _poll_loop(self):
+        while not self._stop.is_set():
+            with self._poll_lock:
+                try:
+                    msg = self.consumer.poll(timeout=self.poll_timeout)
+                    if msg is not None and self.admit(msg):
+                        self._put(msg)
+                except Exception as exc:  # pylint: disable=broad-except
+                    # Raised on the processing side, see get()
+                    self._put(exc)
+                self._apply_backpressure()
+
+    def _put(self, item):
+        with self._not_empty:
+            self._queue.append(item)
+            self._not_empty.notify()
+
+    def _apply_backpressure(self):
+        queued = len(self._queue)
+        if not self._paused and queued >= self.max_queued:
+            self._paused = list(self.consumer.assignment())
+            if self._paused:
+                self.consumer.pause(self._paused)
+                self.pauses += 1
+                logger.info("Intake queue full (%s), pausing %s partitions",
+                            queued, len(self._paused))
+        elif self._paused and queued <= self.resume_at:
+            partitions = [
+                partition for partition in self._paused
+                if not (self.keep_paused and self.keep_paused(
+                    partition.topic, partition.partition))
+            ]
+            if partitions:
+                self.consumer.resume(partitions)
+            self._paused = []
+            logger.info("Intake queue drained (%s), resuming partitions",
+                        queued)
+
+    def get(self, timeout: float = 1.0):
+        '''
+        Next admitted message, None on timeout.
+        Exceptions raised while polling are re-raised here
+        '''
+        return next(iter(self.get_batch(1, timeout)), None)
+
+    def get_batch(self, max_items: int, timeout: float = 1.0) -> list:
+        '''
+        Up to max_items admitted messages. Like Consumer.consume(), waits until
+          max_items are queued or timeout expired, so batch mode still collects a window.
+          A polling error queued meanwhile ends the wait early
+        '''
+        deadline = time.monotonic() + timeout
+        items = []
+        with self._not_empty:
+            while len(self._queue) < max_items and not any(
+                    isinstance(item, Exception) for item in self._queue):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_empty.wait(remaining)
+            while self._queue and len(items) < max_items:
+                item = self._queue[0]
+                if isinstance(item, Exception):
+                    if items:
+                        # Hand over what came before the error first
+                        break
+                    self._queue.popleft()
+                    raise item
+                items.append(self._queue.popleft())
+        return items
+
+    def qsize(self) -> int:
+        '''
+        Number of messages waiting for processing
+        '''
+        return len(self._queue)
+
+    def discard(self, partitions):
+        '''
+        Drop queued messages of revoked partitions
+        '''
+        revoked = {(partition.topic, partition.partition)
+                   for partition in partitions}
+        with self._not_empty:
+            self._queue = collections.deque(
+                item for item in self._queue
+                if isinstance(item, Exception) or (item.topic(),
+                                                   item.partition()) not in revoked)
+        self._paused = [
+            partition for partition in self._paused
+            if (partition.topic, partition.partition) not in revoked
+        ]
+
+    @contextlib.contextmanager
+    def suspended(self):
+        '''
+        Stop polling and drop every queued message for the duration of the block,
+          e.g. while the consumer is rewound
+        '''
+        with self._poll_lock:
+            with self._not_empty:
+                self._queue.clear()
+            yield
@@ -0,0 +1,163 @@
+'''
+    In-flight offset tracking for at-least-once commits.
+    Messages may finish out of order (keyed workers, retries), so per topic partition
+      we only ever commit up to the highest offset below which every message is done.
+    Commits are sent on a timer or after a number of completed messages,
+      not once per message.
+'''
+import threading
+import time
+from collections import deque
+from confluent_kafka import TopicPartition
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+class _PartitionOffsets:
+    '''
+        Offsets of one topic partition, in the order they were polled
+    '''
+
+    __slots__ = ('in_flight', 'done', 'position', 'committed')
+
+    def __init__(self):
+        self.in_flight = deque()
+        self.done = set()
+        # Next offset to commit (Kafka expects the offset of the next message to consume)
+        self.position = None
+        self.committed = None
+
+    def advance(self):
+        '''
+        Drop the completed head of the queue and move the commit position after it
+        '''
+        while self.in_flight and self.in_flight[0] in self.done:
+            offset = self.in_flight.popleft()
+            self.done.discard(offset)
+            self.position = offset + 1
+
+
+class OffsetTracker:
+    '''
+        Track polled messages per topic partition and commit contiguous completed offsets.
+        track() and commit() are expected on the polling thread,
+          done() can be called from any worker thread.
+        before_commit() is called before offsets are committed, e.g. to flush writes
+          made while processing the messages; if it returns False the commit is postponed.
+    '''
+
+    def __init__(self,
+                 consumer,
+                 commit_interval: float = 5.0,
+                 commit_every: int = 100,
+                 before_commit=None):
+        self.consumer = consumer
+        self.before_commit = before_commit
+        self.commit_interval = commit_interval
+        self.commit_every = commit_every
+        self._partitions = {}
+        self._lock = threading.Lock()
+        self._completed_since_commit = 0
+        self._last_commit = time.monotonic()
+        self.commits = 0
+
+    def track(self, msg):
+        '''
+        Register a polled message as in flight
+        '''
+        key = (msg.topic(), msg.partition())
+        with self._lock:
+            self._partitions.setdefault(key, _PartitionOffsets()).in_flight.append(
+                msg.offset())
+
+    def done(self, msg):
+        '''
+        Mark a tracked message as completed
+        '''
+        key = (msg.topic(), msg.partition())
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is None:
+                # Partition revoked meanwhile, nothing to commit for us
+                return
+            partition.done.add(msg.offset())
+            self._completed_since_commit += 1
+
+    def in_flight(self) -> int:
+        '''
+        Number of tracked messages not yet committed
+        '''
+        with self._lock:
+            return sum(
+                len(partition.in_flight) for partition in self._partitions.values())
+
+    def maybe_commit(self):
+        '''
+        Commit if the count threshold or the commit interval has been reached
+        '''
+        due = (self._completed_since_commit >= self.commit_every
+               or time.monotonic() - self._last_commit >= self.commit_interval)
+        if due:
+            self.commit()
+
+    def commit(self, asynchronous: bool = True):
+        '''
+        Commit the highest contiguous completed offset of every partition
+        '''
+        offsets = []
+        with self._lock:
+            for (topic, partition_id), partition in self._partitions.items():
+                partition.advance()
+                if partition.position is not None and partition.position != partition.committed:
+                    offsets.append(
+                        TopicPartition(topic, partition_id, partition.position))
+            self._completed_since_commit = 0
+            self._last_commit = time.monotonic()
+        if not offsets:
+            return
+        if self.before_commit is not None and self.before_commit() is False:
+            # Next commit carries the offsets again
+            logger.warning("Postponed commit of offsets %s", offsets)
+            return
+        try:
+            self.consumer.commit(offsets=offsets, asynchronous=asynchronous)
+        except Exception:  # pylint: disable=broad-except
+            # e.g. no group coordinator, next commit will carry the offsets again
+            logger.exception("Failed to commit offsets %s", offsets)
+            return
+        self.commits += 1
+        with self._lock:
+            for offset in offsets:
+                partition = self._partitions.get(
+                    (offset.topic, offset.partition))
+                if partition is not None:
+                    partition.committed = offset.offset
+
+    def rewind(self) -> list:
+        '''
+        Forget in-flight messages after a processing failure
+        :return TopicPartition list with the first not completed offset of each partition,
+                the consumer has to seek there so those messages are consumed again
+        '''
+        positions = []
+        with self._lock:
+            for (topic, partition_id), partition in self._partitions.items():
+                partition.advance()
+                if partition.in_flight:
+                    positions.append(
+                        TopicPartition(topic, partition_id,
+                                       partition.in_flight[0]))
+                    partition.in_flight.clear()
+                    partition.done.clear()
+        return positions
+
+    def on_revoke(self, _consumer, partitions):
+        '''
+        Rebalance callback: commit what is done and forget revoked partitions
+        '''
+        self.commit(asynchronous=False)
+        with self._lock:
+            for partition in partitions:
+                self._partitions.pop((partition.topic, partition.partition),
+                                     None)
@@ -0,0 +1,276 @@
+'''
+    Transactional outbox of remote (de)allocations.
+    Before a service component's remote calls are dispatched they are recorded,
+      together with the overlay state they were planned with (subnet, WireGuard peers,
+      last peer IP), and each call is marked done once it completed.
+    When the same delivery is processed again after a crash or a failed attempt
+      (redelivered from its kafka offset or republished to the retry topic),
+      only the calls not done yet are replayed, with the same keys and IPs,
+      and the components already planned are not resolved again.
+    Entries are keyed on the kafka delivery, not on the input alone: a later input with
+      the same bytes (e.g. the DESTROY of a service, whose action type is in CB) is a new entry.
+    Entries are removed once an input is fully processed or its message is dead lettered.
+    Without a SQLite file the outbox lives in memory and only covers failed attempts
+      within the same process.
+'''
+import base64
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from app.app_models.py_files import hlo_pb2 as hlo
+from app.localAllocationManager.models import WgClientConf
+from app.runtime.retry import get_header, HEADER_ORIGINAL_TOPIC, \
+    HEADER_ORIGINAL_PARTITION, HEADER_ORIGINAL_OFFSET
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+def delivery_key(msg) -> str:
+    '''
+    Outbox key of a kafka message: original topic:partition:offset:sha256(value).
+    A message republished to the retry topic keeps the key of the message it retries
+    '''
+    topic = get_header(msg, HEADER_ORIGINAL_TOPIC, msg.topic())
+    partition = get_header(msg, HEADER_ORIGINAL_PARTITION, str(msg.partition()))
+    offset = get_header(msg, HEADER_ORIGINAL_OFFSET, str(msg.offset()))
+    digest = hashlib.sha256(msg.value() or b'').hexdigest()
+    return f"{topic}:{partition}:{offset}:{digest}"
+
+
+def input_key(msgs: list = None) -> str:
+    '''
+    Outbox key of an input built from kafka messages msgs (several when coalesced).
+    An input received without kafka gets a key of its own, it is never resumed
+    '''
+    if not msgs:
+        return f"local:{uuid.uuid4().hex}"
+    return "|".join(sorted(delivery_key(msg) for msg in msgs))
+
+
+def encode_params(params: dict) -> str:
+    '''
+    JSON of HLOALClient method params (protobuf and pydantic values included)
+    '''
+    encoded = {}
+    for name, value in params.items():
+        if isinstance(value, hlo.ServiceComponent):
+            value = {
+                "__protobuf__":
+                base64.b64encode(value.SerializeToString()).decode('ascii')
+            }
+        elif isinstance(value, WgClientConf):
+            value = {"__wg_client_conf__": value.model_dump()}
+        encoded[name] = value
+    return json.dumps(encoded)
+
+
+def decode_params(data: str) -> dict:
+    '''
+    Inverse of encode_params
+    '''
+    params = json.loads(data)
+    for name, value in params.items():
+        if isinstance(value, dict) and "__protobuf__" in value:
+            scomponent = hlo.ServiceComponent()
+            scomponent.ParseFromString(base64.b64decode(value["__protobuf__"]))
+            params[name] = scomponent
+        elif isinstance(value, dict) and "__wg_client_conf__" in value:
+            params[name] = WgClientConf(**value["__wg_client_conf__"])
+    return params
+
+
+class OutboxEntry:
+    '''
+        Outbox record of one input: planning state and its remote calls
+    '''
+
+    def __init__(self, outbox, key: str, state: dict):
+        self.outbox = outbox
+        self.key = key
+        self.state = state
+        self.resumed = bool(state)
+
+    def update(self, **values):
+        '''
+        Persist planning state values
+        '''
+        self.state.update(values)
+        self.outbox.save(self, [])
+
+    def plan(self, calls: list, **values) -> list:
+        '''
+        Record calls [(api_url, method_name, params)] and state values in one transaction
+        :return the call ids, in the same order
+        '''
+        self.state.update(values)
+        return self.outbox.save(self, calls)
+
+    def reset(self):
+        '''
+        Drop the state and calls of a previous attempt, e.g. when they no longer
+          match the continuum, and start over
+        '''
+        self.state = {}
+        self.resumed = False
+        self.outbox.reset(self)
+
+    def is_planned(self, scomponent_id: str) -> bool:
+        '''
+        Whether the calls of scomponent_id were recorded by a previous attempt
+        '''
+        return scomponent_id in self.state.get("planned", [])
+
+    def unfinished(self) -> list:
+        '''
+        [(call_id, api_url, method_name, params)] recorded but not done
+        '''
+        return self.outbox.unfinished(self.key)
+
+    def done(self, call_id: int):
+        '''
+        Mark a call as completed
+        '''
+        self.outbox.done(self.key, call_id)
+
+
+class Outbox:
+    '''
+        SQLite backed outbox, shared by all worker threads
+    '''
+
+    def __init__(self, sqlite_path: str = None, ttl: float = 86400.0,
+                 clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(sqlite_path or ":memory:",
+                                   check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_inputs (key TEXT PRIMARY KEY, state TEXT, created_at REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_calls (key TEXT, call_id INTEGER, api_url TEXT, "
+            "method_name TEXT, params TEXT, done INTEGER DEFAULT 0, PRIMARY KEY (key, call_id))"
+        )
+        oldest = self.clock() - self.ttl
+        self._db.execute(
+            "DELETE FROM outbox_calls WHERE key IN (SELECT key FROM outbox_inputs WHERE created_at < ?)",
+            (oldest, ))
+        self._db.execute("DELETE FROM outbox_inputs WHERE created_at < ?",
+                         (oldest, ))
+        self._db.commit()
+
+    def open(self, msgs: list = None) -> OutboxEntry:
+        '''
+        Entry of the input built from kafka messages msgs,
+          with the state left by a previous attempt of the same delivery if any
+        '''
+        key = input_key(msgs)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM outbox_inputs WHERE key = ?",
+                (key, )).fetchone()
+            if row is None:
+                self._db.execute(
+                    "INSERT INTO outbox_inputs (key, state, created_at) VALUES (?, ?, ?)",
+                    (key, "{}", self.clock()))
+                self._db.commit()
+                return OutboxEntry(self, key, {})
+        logger.info("Resuming input %s from the outbox", key)
+        return OutboxEntry(self, key, json.loads(row[0]))
+
+    def save(self, entry: OutboxEntry, calls: list) -> list:
+        '''
+        Persist entry state and new calls atomically
+        :return ids of the new calls
+        '''
+        with self._lock:
+            next_id = self._db.execute(
+                "SELECT COALESCE(MAX(call_id), 0) + 1 FROM outbox_calls WHERE key = ?",
+                (entry.key, )).fetchone()[0]
+            call_ids = list(range(next_id, next_id + len(calls)))
+            self._db.executemany(
+                "INSERT INTO outbox_calls (key, call_id, api_url, method_name, params) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(entry.key, call_id, api_url, method_name,
+                  encode_params(params))
+                 for call_id, (api_url, method_name,
+                               params) in zip(call_ids, calls)])
+            self._db.execute("UPDATE outbox_inputs SET state = ? WHERE key = ?",
+                             (json.dumps(entry.state), entry.key))
+            self._db.commit()
+        return call_ids
+
+    def unfinished(self, key: str) -> list:
+        '''
+        Calls of key not done yet
+        '''
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT call_id, api_url, method_name, params FROM outbox_calls "
+                "WHERE key = ? AND done = 0 ORDER BY call_id", (key, )).fetchall()
+        return [(call_id, api_url, method_name, decode_params(params))
+                for call_id, api_url, method_name, params in rows]
+
+    def done(self, key: str, call_id: int):
+        '''
+        Mark a call as completed
+        '''
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox_calls SET done = 1 WHERE key = ? AND call_id = ?",
+                (key, call_id))
+            self._db.commit()
+
+    def finish(self, entry: OutboxEntry):
+        '''
+        Forget a fully processed input
+        '''
+        with self._lock:
+            self._db.execute("DELETE FROM outbox_calls WHERE key = ?",
+                             (entry.key, ))
+            self._db.execute("DELETE FROM outbox_inputs WHERE key = ?",
+                             (entry.key, ))
+            self._db.commit()
+
+    def reset(self, entry: OutboxEntry):
+        '''
+        Drop the calls of entry and empty its state
+        '''
+        with self._lock:
+            self._db.execute("DELETE FROM outbox_calls WHERE key = ?",
+                             (entry.key, ))
+            self._db.execute("UPDATE outbox_inputs SET state = ? WHERE key = ?",
+                             ("{}", entry.key))
+            self._db.commit()
+
+    def abandon(self, msg):
+        '''
+        Forget the entries of inputs built from msg, which will not be attempted again
+        '''
+        key = delivery_key(msg)
+        with self._lock:
+            keys = [
+                row[0] for row in self._db.execute(
+                    "SELECT key FROM outbox_inputs WHERE instr(key, ?) > 0",
+                    (key, )).fetchall()
+            ]
+            for abandoned in keys:
+                self._db.execute("DELETE FROM outbox_calls WHERE key = ?",
+                                 (abandoned, ))
+                self._db.execute("DELETE FROM outbox_inputs WHERE key = ?",
+                                 (abandoned, ))
+            self._db.commit()
+        if keys:
+            logger.info("Abandoned outbox entries of %s", key)
+
+    def close(self):
+        '''
+        Close the SQLite file
+        '''
+        with self._lock:
+            self._db.close()
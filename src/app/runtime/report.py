@@ -0,0 +1,217 @@
+'''
+    Outcome of one HLODeploymentEngineInput.
+    Filled while the input is processed (service level and per component stage timings,
+      remote call results, errors) and turned into an HLODeploymentEngineResult
+      protobuf published on the result topic, so upstream components learn the outcome
+      without polling the context broker.
+'''
+import contextlib
+import threading
+import time
+from app.app_models.py_files import deployment_engine_pb2 as deployment_engine
+import app.app_models.aeriOS_continuum as aeriOS_c
+
+# HLOALClient method -> (stage name, component status when it succeeded)
+CALL_STAGES = {
+    "request_allocate_scompenent":
+    ("allocate", aeriOS_c.ServiceComponentStatusEnum.RUNNING),
+    "request_deallocate_scompenent":
+    ("deallocate", aeriOS_c.ServiceComponentStatusEnum.FINISHED),
+    "request_destroy_service_overlay": ("destroy_overlay", None),
+}
+
+
+def _call_status_code(result):
+    '''
+    HTTP status code out of an HLOALClient method result,
+      None when the request itself failed
+    '''
+    if result is None or isinstance(result, int):
+        return result
+    return getattr(result, 'status_code', None)
+
+
+class _ComponentReport:
+    '''
+        Outcome of one service component
+    '''
+
+    __slots__ = ('status', 'domain_id', 'ie_id', 'timings', 'errors')
+
+    def __init__(self):
+        self.status = ""
+        self.domain_id = ""
+        self.ie_id = ""
+        self.timings = []
+        self.errors = []
+
+
+class DeploymentReport:
+    '''
+        Thread safe collector of the outcome of one input,
+          remote calls report from the dispatcher threads
+    '''
+
+    def __init__(self, service_id: str, clock=time.monotonic):
+        self.service_id = service_id
+        self.action_type = ""
+        self.clock = clock
+        self.timings = []
+        self.errors = []
+        # scomponent_id -> _ComponentReport, in input order
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def component(self, scomponent_id: str, domain_id: str = None,
+                  ie_id: str = None):
+        '''
+        Register a service component and its target domain / IE
+        '''
+        with self._lock:
+            report = self._components.setdefault(scomponent_id,
+                                                 _ComponentReport())
+            report.domain_id = domain_id or report.domain_id
+            report.ie_id = ie_id or report.ie_id
+
+    @contextlib.contextmanager
+    def stage(self, name: str, scomponent_id: str = None):
+        '''
+        Time the enclosed block as a service level stage,
+          or as a stage of scomponent_id
+        '''
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.add_timing(name, self.clock() - started, scomponent_id)
+
+    def add_timing(self, name: str, seconds: float, scomponent_id: str = None):
+        '''
+        Record an already measured stage
+        '''
+        with self._lock:
+            self._timings_of(scomponent_id).append((name, seconds))
+
+    def set_status(self, scomponent_id: str, status: str, error: str = None):
+        '''
+        Final status of a service component as seen by the Deployment Engine
+        '''
+        with self._lock:
+            report = self._components.setdefault(scomponent_id,
+                                                 _ComponentReport())
+            report.status = status
+            if error:
+                report.errors.append(error)
+
+    def fail(self, error):
+        '''
+        Record a service level error
+        '''
+        with self._lock:
+            self.errors.append(repr(error) if isinstance(error, Exception)
+                               else str(error))
+
+    def record_call(self, method_name: str, params: dict, result, error,
+                    seconds: float):
+        '''
+        Record the outcome of one HLOALClient method call
+        :param result: what the method returned, None if it raised or the request failed
+        :param error: exception raised by the method, if any
+        '''
+        stage, success_status = CALL_STAGES.get(method_name,
+                                                (method_name, None))
+        if "scomponent_allocation" in params:
+            scomponent_id = params["scomponent_allocation"].id
+        else:
+            scomponent_id = params.get("service_component_id")
+        status_code = _call_status_code(result)
+        if error is None and status_code is not None and status_code < 300:
+            error_text = None
+        elif error is not None:
+            error_text = f"{stage}: {error!r}"
+        elif status_code is None:
+            error_text = f"{stage}: request failed"
+        else:
+            error_text = f"{stage}: HTTP {status_code}"
+        self.add_timing(stage, seconds, scomponent_id)
+        if scomponent_id is None:
+            if error_text:
+                self.fail(error_text)
+            return
+        with self._lock:
+            report = self._components.setdefault(scomponent_id,
+                                                 _ComponentReport())
+            if error_text:
+                report.status = aeriOS_c.ServiceComponentStatusEnum.FAILED
+                report.errors.append(error_text)
+            elif report.errors or not success_status:
+                return
+            elif success_status == aeriOS_c.ServiceComponentStatusEnum.RUNNING or \
+                    not report.status:
+                # On overload the allocation on the new IE is the final status,
+                #   whichever of deallocate/allocate finishes last
+                report.status = success_status
+
+    def _timings_of(self, scomponent_id: str) -> list:
+        if scomponent_id is None:
+            return self.timings
+        return self._components.setdefault(scomponent_id,
+                                           _ComponentReport()).timings
+
+    def failed(self) -> bool:
+        '''
+        Whether a service level error or a FAILED component was recorded
+        '''
+        with self._lock:
+            return bool(self.errors) or any(
+                report.status == aeriOS_c.ServiceComponentStatusEnum.FAILED
+                for report in self._components.values())
+
+    def scomponent_ids(self) -> list:
+        '''
+        Service components of the input, in input order
+        '''
+        with self._lock:
+            return list(self._components)
+
+    def to_dict(self) -> dict:
+        '''
+        JSON serializable outcome: service level errors and status and errors
+          of every service component
+        '''
+        with self._lock:
+            return {
+                "service_id": self.service_id,
+                "action_type": self.action_type or "",
+                "errors": list(self.errors),
+                "service_components": [{
+                    "id": scomponent_id,
+                    "status": report.status,
+                    "domain_id": report.domain_id,
+                    "infrastructure_element_id": report.ie_id,
+                    "errors": list(report.errors)
+                } for scomponent_id, report in self._components.items()]
+            }
+
+    def to_protobuf(self) -> deployment_engine.HLODeploymentEngineResult:
+        '''
+        HLODeploymentEngineResult of the collected outcome
+        '''
+        with self._lock:
+            result = deployment_engine.HLODeploymentEngineResult(
+                service_id=self.service_id,
+                action_type=self.action_type or "",
+                errors=self.errors,
+                finished_at_ms=int(time.time() * 1000))
+            for name, seconds in self.timings:
+                result.stage_timings.add(stage=name, seconds=seconds)
+            for scomponent_id, report in self._components.items():
+                component = result.service_component_results.add(
+                    service_component_id=scomponent_id,
+                    status=report.status,
+                    domain_id=report.domain_id,
+                    infrastructure_element_id=report.ie_id,
+                    errors=report.errors)
+                for name, seconds in report.timings:
+                    component.stage_timings.add(stage=name, seconds=seconds)
+            return result
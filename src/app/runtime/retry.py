@@ -0,0 +1,193 @@
+'''
+    Retry and dead letter routing for failed kafka messages.
+    A message that fails processing is republished, with its original protobuf bytes,
+      to the retry topic with attempt metadata in the kafka headers,
+      so the main partition keeps flowing.
+    The loop consumes the retry topic too; a retry message is only processed once
+      its backoff has elapsed, until then its partition is paused.
+    After max_attempts the message is published to the dead letter topic.
+'''
+import threading
+import time
+from confluent_kafka import TopicPartition
+from app.api_clients.kafka_client import log_delivery
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+# Kafka header names of the attempt metadata
+HEADER_ATTEMPT = 'hlo-de-attempt'
+HEADER_NOT_BEFORE = 'hlo-de-not-before'
+HEADER_ORIGINAL_TOPIC = 'hlo-de-original-topic'
+HEADER_ORIGINAL_PARTITION = 'hlo-de-original-partition'
+HEADER_ORIGINAL_OFFSET = 'hlo-de-original-offset'
+HEADER_ERROR = 'hlo-de-error'
+
+
+def get_header(msg, name: str, default: str = None) -> str:
+    '''
+    Get a header of a kafka message as str
+    '''
+    for key, value in msg.headers() or []:
+        if key == name and value is not None:
+            return value.decode('utf-8') if isinstance(value, bytes) else value
+    return default
+
+
+class RetryRouter:
+    '''
+        Republish failed messages to retry or dead letter topic
+          and delay consumption of retry messages until they are due.
+        producer and consumer are duck typed (produce/poll, pause/resume/seek)
+          so in-process fakes can be used in place of confluent_kafka objects.
+    '''
+
+    def __init__(self,
+                 producer,
+                 retry_topic: str,
+                 dlq_topic: str = None,
+                 max_attempts: int = 5,
+                 backoff_base: float = 5.0,
+                 backoff_max: float = 300.0,
+                 clock=time.time):
+        self.producer = producer
+        self.retry_topic = retry_topic
+        self.dlq_topic = dlq_topic
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        # (topic, partition) -> (due timestamp, TopicPartition) of paused retry partitions
+        self._paused = {}
+        self._lock = threading.Lock()
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def backoff(self, attempt: int) -> float:
+        '''
+        Seconds to wait before retry attempt number attempt (1 based)
+        '''
+        return min(self.backoff_base * 2**(attempt - 1), self.backoff_max)
+
+    def publish_failure(self,
+                        msg,
+                        error: Exception,
+                        retriable: bool = True,
+                        on_published=None):
+        '''
+        Republish a failed message to the retry topic,
+          or to the dead letter topic when attempts are exhausted or retriable is False
+        :param msg: the consumed kafka message that failed
+        :param error: the processing error
+        :param retriable: False for errors a retry can not fix, e.g. unparsable payload
+        :param on_published: called once the republished message is delivered,
+                             the original offset is safe to commit from then on
+        :return True if the message will be attempted again,
+                False if it was dead lettered or dropped
+        '''
+        attempt = int(get_header(msg, HEADER_ATTEMPT, '0')) + 1
+        headers = {
+            HEADER_ATTEMPT:
+            str(attempt),
+            HEADER_ORIGINAL_TOPIC:
+            get_header(msg, HEADER_ORIGINAL_TOPIC, msg.topic()),
+            HEADER_ORIGINAL_PARTITION:
+            get_header(msg, HEADER_ORIGINAL_PARTITION, str(msg.partition())),
+            HEADER_ORIGINAL_OFFSET:
+            get_header(msg, HEADER_ORIGINAL_OFFSET, str(msg.offset())),
+            HEADER_ERROR:
+            repr(error)[:512],
+        }
+        if retriable and attempt <= self.max_attempts:
+            delay = self.backoff(attempt)
+            headers[HEADER_NOT_BEFORE] = str(self.clock() + delay)
+            topic = self.retry_topic
+            self.retried += 1
+            logger.warning("Message %s/%s/%s failed, retry %s of %s in %ss",
+                           msg.topic(), msg.partition(), msg.offset(), attempt,
+                           self.max_attempts, delay)
+        elif self.dlq_topic:
+            topic = self.dlq_topic
+            self.dead_lettered += 1
+            logger.error("Message %s/%s/%s failed %s times, sent to %s",
+                         msg.topic(), msg.partition(), msg.offset(), attempt,
+                         self.dlq_topic)
+        else:
+            self.dead_lettered += 1
+            logger.error(
+                "Message %s/%s/%s failed %s times and no DLQ topic is configured, dropping",
+                msg.topic(), msg.partition(), msg.offset(), attempt)
+            if on_published:
+                on_published()
+            return False
+
+        def on_delivery(err, produced_msg):
+            log_delivery(err, produced_msg)
+            if err is None and on_published:
+                on_published()
+
+        self.producer.produce(topic,
+                              value=msg.value(),
+                              key=msg.key(),
+                              headers=headers,
+                              on_delivery=on_delivery)
+        self.poll()
+        return topic == self.retry_topic
+
+    def poll(self):
+        '''
+        Serve delivery callbacks of republished messages
+        '''
+        self.producer.poll(0)
+
+    def defer_if_not_due(self, consumer, msg) -> bool:
+        '''
+        Pause the partition of a retry message that is not due yet
+          and rewind it, so the message is consumed again once resumed
+        :return True if the message was deferred and must not be processed now
+        '''
+        if msg.topic() != self.retry_topic:
+            return False
+        due = float(get_header(msg, HEADER_NOT_BEFORE, '0'))
+        if due <= self.clock():
+            return False
+        partition = TopicPartition(msg.topic(), msg.partition(), msg.offset())
+        consumer.pause([partition])
+        consumer.seek(partition)
+        with self._lock:
+            self._paused[(msg.topic(), msg.partition())] = (due, partition)
+        return True
+
+    def is_deferred(self, topic: str, partition: int) -> bool:
+        '''
+        Whether a retry partition is currently paused waiting for its head message
+        '''
+        with self._lock:
+            return (topic, partition) in self._paused
+
+    def resume_due(self, consumer):
+        '''
+        Resume retry partitions whose head message is now due
+        '''
+        now = self.clock()
+        with self._lock:
+            due_keys = [
+                key for key, (due, _) in self._paused.items() if due <= now
+            ]
+            partitions = [self._paused.pop(key)[1] for key in due_keys]
+        if partitions:
+            consumer.resume(partitions)
+
+    def forget(self, partitions):
+        '''
+        Drop pause state of revoked partitions
+        '''
+        with self._lock:
+            for partition in partitions:
+                self._paused.pop((partition.topic, partition.partition), None)
+
+    def flush(self, timeout: float = 10.0):
+        '''
+        Wait for republished messages to be delivered
+        '''
+        self.producer.flush(timeout)
@@ -0,0 +1,147 @@
+'''
+    Priority scheduling of pending deployment work.
+    Work polled from kafka is ordered before processing by
+      class: DESTROYING and OVERLOAD free capacity, so they go before DEPLOYING,
+      estimated cost: sum over service components of the observed per-component
+        latency of their target domain (shortest job first),
+      aging: waiting time lowers the score so big deployments are not starved.
+    Work of the same service keeps its arrival order, only the head of each
+      service queue competes.
+'''
+import threading
+import time
+from collections import OrderedDict, deque
+from app.app_models.aeriOS_continuum import ServiceActionTypeEnum
+from app.app_models.aeriOS_continuum import ServiceComponentStatusEnum
+
+# Score offset (seconds) per work class, lower runs first
+CLASS_PENALTY = {
+    ServiceActionTypeEnum.DESTROYING: 0.0,
+    ServiceComponentStatusEnum.OVERLOAD: 0.0,
+    ServiceActionTypeEnum.DEPLOYING: 60.0,
+}
+DEFAULT_CLASS_PENALTY = 60.0
+UNKNOWN_DOMAIN = "unknown"
+
+
+class _Work:
+    '''
+        One pending work item
+    '''
+
+    __slots__ = ('item', 'work_class', 'domains', 'enqueued')
+
+    def __init__(self, item, work_class: str, domains: list, enqueued: float):
+        self.item = item
+        self.work_class = work_class
+        self.domains = domains
+        self.enqueued = enqueued
+
+
+class PriorityScheduler:
+    '''
+        Per-service FIFO queues, the service whose head has the lowest
+          class penalty + estimated cost - aging * waited seconds is served first
+    '''
+
+    def __init__(self,
+                 aging: float = 1.0,
+                 default_latency: float = 1.0,
+                 smoothing: float = 0.2,
+                 class_penalty: dict = None,
+                 clock=time.monotonic):
+        self.aging = aging
+        self.default_latency = default_latency
+        self.smoothing = smoothing
+        self.class_penalty = class_penalty or CLASS_PENALTY
+        self.clock = clock
+        # service_id -> deque of _Work
+        self._services = OrderedDict()
+        # domain_id -> EWMA of seconds per service component
+        self._latency = {}
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, key: str, item, work_class: str, domains: list):
+        '''
+        Queue work
+        :param key: service id, work with the same key is served in push order
+        :param item: opaque work item returned by pop()
+        :param work_class: DESTROYING, OVERLOAD or DEPLOYING
+        :param domains: target domain id of every service component
+        '''
+        with self._lock:
+            self._services.setdefault(key, deque()).append(
+                _Work(item, work_class, domains, self.clock()))
+            self._size += 1
+
+    def estimated_cost(self, domains: list) -> float:
+        '''
+        Estimated processing seconds of work touching domains
+        '''
+        return sum(
+            self._latency.get(domain or UNKNOWN_DOMAIN, self.default_latency)
+            for domain in domains)
+
+    def score(self, work: _Work, now: float) -> float:
+        '''
+        Lower is served first
+        '''
+        penalty = self.class_penalty.get(work.work_class,
+                                         DEFAULT_CLASS_PENALTY)
+        return penalty + self.estimated_cost(
+            work.domains) - self.aging * (now - work.enqueued)
+
+    def pop(self):
+        '''
+        :return (key, item) of the best service head, None if empty
+        '''
+        with self._lock:
+            if not self._size:
+                return None
+            now = self.clock()
+            key = min(self._services,
+                      key=lambda k: self.score(self._services[k][0], now))
+            work_queue = self._services[key]
+            work = work_queue.popleft()
+            if not work_queue:
+                del self._services[key]
+            self._size -= 1
+            return key, work.item
+
+    def discard(self, predicate) -> int:
+        '''
+        Drop queued work whose item matches predicate(item)
+        :return number of dropped items
+        '''
+        dropped = 0
+        with self._lock:
+            for key in list(self._services):
+                work_queue = self._services[key]
+                kept = deque(work for work in work_queue
+                             if not predicate(work.item))
+                dropped += len(work_queue) - len(kept)
+                if kept:
+                    self._services[key] = kept
+                else:
+                    del self._services[key]
+            self._size -= dropped
+        return dropped
+
+    def observe(self, domains: list, elapsed: float):
+        '''
+        Feed the measured processing time of work touching domains
+          into the per-domain latency estimate
+        '''
+        if not domains:
+            return
+        per_component = elapsed / len(domains)
+        with self._lock:
+            for domain in set(domain or UNKNOWN_DOMAIN for domain in domains):
+                previous = self._latency.get(domain)
+                self._latency[domain] = per_component if previous is None else (
+                    self.smoothing * per_component +
+                    (1 - self.smoothing) * previous)
@@ -0,0 +1,137 @@
+'''
+    Supervisor of the kafka loop.
+    Keeps one long-lived consumer and, when a processing step raises,
+      recovers it in place (rewind to the first unfinished offset) after a
+      bounded exponential backoff instead of closing and rebuilding the consumer,
+      so a failure does not trigger a consumer group rebalance.
+    The consumer is only rebuilt on fatal kafka errors.
+'''
+import threading
+import time
+from confluent_kafka import KafkaException
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+def is_fatal(error: Exception) -> bool:
+    '''
+    Whether error leaves the kafka consumer unusable
+    '''
+    if isinstance(error, KafkaException) and error.args:
+        kafka_error = error.args[0]
+        return hasattr(kafka_error, 'fatal') and kafka_error.fatal()
+    return False
+
+
+class ConsumerSupervisor:
+    '''
+        Run engine.step() forever on a consumer built once by factory.
+        factory() returns an object with step(), recover() and close(),
+          e.g. app.loop.DeploymentEngineConsumer
+    '''
+
+    def __init__(self,
+                 factory,
+                 backoff_base: float = 1.0,
+                 backoff_max: float = 60.0,
+                 sleep=time.sleep):
+        self.factory = factory
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self.engine = None
+        self.stop_event = threading.Event()
+        # Counters
+        self.restarts = 0
+        self.consumer_rebuilds = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_restart = None
+
+    def backoff(self) -> float:
+        '''
+        Seconds to wait before the next restart
+        '''
+        return min(self.backoff_base * 2**(self.consecutive_failures - 1),
+                   self.backoff_max)
+
+    def stats(self) -> dict:
+        '''
+        Restart counters
+        '''
+        return {
+            "restarts": self.restarts,
+            "consumer_rebuilds": self.consumer_rebuilds,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "last_restart": self.last_restart,
+        }
+
+    def stop(self):
+        '''
+        Ask run() to return after the current step
+        '''
+        self.stop_event.set()
+
+    def run(self):
+        '''
+        Supervise the processing loop until stop() or KeyboardInterrupt
+        '''
+        self._build()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.engine.step()
+                    self.consecutive_failures = 0
+                except KeyboardInterrupt:
+                    break
+                except Exception as exc:  # pylint: disable=broad-except
+                    self._restart(exc)
+        finally:
+            if self.engine is not None:
+                logger.info('Closing kafka consumer')
+                self.engine.close()
+
+    def _restart(self, error: Exception):
+        self.restarts += 1
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        self.last_restart = time.time()
+        delay = self.backoff()
+        logger.exception(
+            'An exception while processing msg in Deployment Engine, restart %s in %ss',
+            self.restarts, delay)
+        self.sleep(delay)
+        if is_fatal(error):
+            logger.error("Fatal kafka error, rebuilding consumer")
+            self._rebuild()
+            return
+        try:
+            self.engine.recover()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not recover consumer, rebuilding it")
+            self._rebuild()
+
+    def _rebuild(self):
+        self.consumer_rebuilds += 1
+        try:
+            self.engine.close()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Failed to close consumer")
+        self.engine = None
+        self._build()
+
+    def _build(self):
+        '''
+        Create the engine, retrying with backoff while e.g. the broker is unreachable
+        '''
+        while not self.stop_event.is_set():
+            try:
+                self.engine = self.factory()
+                return
+            except Exception as exc:  # pylint: disable=broad-except
+                self.consecutive_failures += 1
+                self.last_error = repr(exc)
+                logger.exception("Failed to create kafka consumer")
+                self.sleep(self.backoff())
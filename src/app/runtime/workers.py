@@ -0,0 +1,112 @@
+'''
+    Keyed worker pool for the kafka loop.
+    Work items carrying the same key (the orchestrated service id) always land
+      on the same worker thread, so messages of one service are handled strictly
+      in arrival order while different services are handled in parallel.
+'''
+import queue
+import threading
+import zlib
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+# Sentinel put on worker queues to stop the threads
+_STOP = object()
+
+
+def key_to_worker(key: str, workers: int) -> int:
+    '''
+    Map a key to a worker index.
+    crc32 is used instead of hash() as it is stable across processes
+    :param key: the routing key, e.g. service id
+    :param workers: number of workers in the pool
+    :return worker index in [0, workers)
+    '''
+    return zlib.crc32(key.encode('utf-8')) % workers
+
+
+class KeyedWorkerPool:
+    '''
+        Fixed pool of threads, each one with its own bounded FIFO queue.
+        submit() blocks when the queue of the selected worker is full,
+          which throttles the caller (the kafka poll loop),
+          or raises queue.Full with block=False.
+    '''
+
+    def __init__(self, workers: int, queue_size: int = 100):
+        if workers < 1:
+            raise ValueError("KeyedWorkerPool needs at least one worker")
+        self.workers = workers
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work,
+                                      args=(work_queue, ),
+                                      name=f"de-worker-{index}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self,
+               key: str,
+               func,
+               *args,
+               callback=None,
+               block: bool = True,
+               **kwargs):
+        '''
+        Queue func(*args, **kwargs) on the worker owning key
+        :param key: routing key, work with equal keys is serialized
+        :param func: callable to run
+        :param callback: optional callable(result, exception) called on the worker
+                         once func returns or raises
+        :param block: wait for room in a full worker queue, else raise queue.Full
+        '''
+        index = key_to_worker(key, self.workers)
+        self._queues[index].put((func, args, kwargs, callback), block=block)
+
+    def pending(self) -> int:
+        '''
+        Number of work items queued and not yet picked up by the workers
+        '''
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def join(self):
+        '''
+        Block until every queued work item has been processed
+        '''
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def shutdown(self, wait: bool = True):
+        '''
+        Stop the workers after they drain their queues
+        '''
+        for work_queue in self._queues:
+            work_queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    @staticmethod
+    def _work(work_queue: queue.Queue):
+        while True:
+            item = work_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                func, args, kwargs, callback = item
+                result, error = None, None
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception("Worker task failed")
+                    error = exc
+                if callback:
+                    try:
+                        callback(result, error)
+                    except Exception:  # pylint: disable=broad-except
+                        logger.exception("Worker callback failed")
+            finally:
+                work_queue.task_done()
@@ -1,13 +1,127 @@
 '''
  Module with funcions to check or update continuum state representations
+ Topology lookups (IE domain, domain URL and key, IE container technology and hostname)
+   are answered by the TopologyIndex when it knows the entities, else read through a LookupCache.
+   Service and service component state is always queried.
+ Service component status and IE updates are written behind, in coalesced batches
+   (see WriteBehindQueue); reads of a component flush its pending updates first
 '''
+import threading
 from app.api_clients.cb_client import CBClient
 from app.app_models.aeriOS_continuum import ServiceComponentStatusEnum as status
 from app.app_models.aeriOS_continuum import ServiceActionTypeEnum
+from app.utils.lookup_cache import LookupCache, LookupFailed
+from app.utils.write_behind import WriteBehindQueue
+from app.utils.topology import get_topology_index
 from app.utils.log import get_app_logger
+from app.config import CB_CACHE_MAX_ENTRIES, CB_CACHE_IE_TTL, \
+    CB_CACHE_DOMAIN_TTL, CB_CACHE_NEGATIVE_TTL, WRITE_BEHIND, \
+    WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_FLUSH_TIMEOUT
 
 logger = get_app_logger()
 
+_cache = LookupCache(max_entries=CB_CACHE_MAX_ENTRIES,
+                     ttls={
+                         "ie_domain": CB_CACHE_IE_TTL,
+                         "ie_llo_type": CB_CACHE_IE_TTL,
+                         "ie_hostname": CB_CACHE_IE_TTL,
+                         "domain": CB_CACHE_DOMAIN_TTL,
+                         "host_domain": CB_CACHE_DOMAIN_TTL,
+                     },
+                     negative_ttl=CB_CACHE_NEGATIVE_TTL)
+
+# Process wide write-behind queue of service component updates, see _get_writes()
+_writes = None
+_writes_lock = threading.Lock()
+
+
+def invalidate_infrastructure_element(ie_id: str = None):
+    '''
+    Drop the cached lookups of an IE, of all IEs when ie_id is None
+    '''
+    _cache.invalidate("ie_domain", ie_id)
+    _cache.invalidate("ie_hostname", ie_id)
+    if ie_id is None:
+        _cache.invalidate("ie_llo_type")
+    else:
+        # keyed on (ie_id, is_ie_local)
+        for is_ie_local in (True, False):
+            _cache.invalidate("ie_llo_type", (ie_id, is_ie_local))
+
+
+def invalidate_domain(domain_id: str = None):
+    '''
+    Drop the cached URL and key of a domain, of all domains when domain_id is None
+    '''
+    _cache.invalidate("domain", domain_id)
+    _cache.invalidate("host_domain")
+
+
+def get_cache_stats() -> dict:
+    '''
+    Entries, hits, misses and hit rate of the topology lookup cache
+    '''
+    return _cache.stats()
+
+
+def _get_writes() -> WriteBehindQueue:
+    '''
+    Process wide write-behind queue, started on first use. None when WRITE_BEHIND is disabled
+    '''
+    global _writes  # pylint: disable=global-statement
+    if not WRITE_BEHIND:
+        return None
+    with _writes_lock:
+        if _writes is None:
+            _writes = WriteBehindQueue(update_service_components,
+                                       interval=WRITE_BEHIND_INTERVAL,
+                                       max_batch=WRITE_BEHIND_MAX_BATCH)
+    return _writes
+
+
+def queue_service_component_updates(updates: list):
+    '''
+    Queue service component updates (see service_component_update) to be written behind,
+      written at once when WRITE_BEHIND is disabled
+    '''
+    writes = _get_writes()
+    if writes is None:
+        update_service_components(updates)
+    else:
+        writes.put(updates)
+
+
+def flush_service_component_updates(
+        scomponent_ids: list = None,
+        timeout: float = WRITE_BEHIND_FLUSH_TIMEOUT) -> bool:
+    '''
+    Wait until the queued service component updates are written (or failed),
+      only if some of scomponent_ids has an update pending when given
+    :return False if timeout expired first
+    '''
+    if _writes is None:
+        return True
+    flushed = _writes.flush(entity_ids=scomponent_ids, timeout=timeout)
+    if not flushed:
+        logger.warning("Service component updates not written after %ss",
+                       timeout)
+    return flushed
+
+
+def stop_service_component_updates():
+    '''
+    Write the queued service component updates and stop the write-behind thread
+    '''
+    if _writes is not None:
+        _writes.stop(timeout=WRITE_BEHIND_FLUSH_TIMEOUT)
+
+
+def get_write_behind_stats() -> dict:
+    '''
+    Updates queued, coalesced and written by the write-behind queue
+    '''
+    return _writes.stats() if _writes is not None else {}
+
 
 def check_service_exists(service_id: str, ) -> bool:
     '''
@@ -35,6 +149,7 @@ def check_service_component_exists(service_id: str,
     :param  service_component_id: id of the service component id
     :return True or False
     '''
+    flush_service_component_updates([service_component_id])
     cb_client = CBClient()
     jsonld_params = 'format=simplified'
     scomponent_json = cb_client.query_entity(entity_id=service_component_id,
@@ -56,16 +171,64 @@ def check_service_component_exists(service_id: str,
 def set_service_component_status(service_id, scomponent_id,
                                  scomponent_status: str):
     """
-        Set the status for a service component in CB
+        Set the status for a service component in CB, written behind
     """
-    cb_client = CBClient()
-    data = {
-        "serviceComponentStatus": {
+    queue_service_component_updates([
+        service_component_update(scomponent_id,
+                                 scomponent_status=scomponent_status)
+    ])
+
+
+def set_service_components_status(scomponent_ids: list,
+                                  scomponent_status: str):
+    """
+        Set the same status for several service components, written behind in one batch
+    """
+    queue_service_component_updates([
+        service_component_update(scomponent_id,
+                                 scomponent_status=scomponent_status)
+        for scomponent_id in scomponent_ids
+    ])
+
+
+def service_component_update(scomponent_id: str,
+                             scomponent_status: str = None,
+                             allocated_ie_id: str = None) -> dict:
+    """
+        Entity fragment with the service component attributes to update,
+          for update_service_components or queue_service_component_updates
+    """
+    data = {"id": scomponent_id, "type": "ServiceComponent"}
+    if scomponent_status is not None:
+        data["serviceComponentStatus"] = {
             "type": "Relationship",
             "object": scomponent_status
         }
-    }
-    cb_client.patch_entity(entity_id=scomponent_id, upd_object=data)
+    if allocated_ie_id is not None:
+        data["infrastructureElement"] = {
+            "type": "Relationship",
+            "object": allocated_ie_id
+        }
+    return data
+
+
+def update_service_components(updates: list) -> dict:
+    """
+        Apply service component updates (see service_component_update) in one CB
+          batch request, updates of the same component are merged
+        Returns:
+          {"success": [ids], "errors": {id: error}}, None if the request failed
+    """
+    if not updates:
+        return {"success": [], "errors": {}}
+    cb_client = CBClient()
+    results = cb_client.update_entities(entities=updates)
+    if results is None:
+        logger.error("Failed to update %s service components", len(updates))
+    elif results["errors"]:
+        logger.error("Failed to update service components: %s",
+                     results["errors"])
+    return results
 
 
 def set_service_component_status_attr(service_id, scomponent_id,
@@ -83,18 +246,14 @@ def set_service_component_status_attr(service_id, scomponent_id,
 
 def set_service_component_ie(service_id, scomponent_id, allocated_ie_id: str):
     """
-        Update IE for Service Component
+        Update IE for Service Component, written behind
         Create relationship upon allocation
         Delete relationship upon deallocation
     """
-    cb_client = CBClient()
-    data = {
-        "infrastructureElement": {
-            "type": "Relationship",
-            "object": allocated_ie_id
-        }
-    }
-    cb_client.patch_entity(entity_id=scomponent_id, upd_object=data)
+    queue_service_component_updates([
+        service_component_update(scomponent_id,
+                                 allocated_ie_id=allocated_ie_id)
+    ])
 
 
 def set_service_component_ie_attr(service_id, scomponent_id,
@@ -132,6 +291,7 @@ def get_service_component_status(service_component_id: str,
         scomponent_id = service_component_id
         parts = scomponent_id.split(':')
         service_id = ':'.join(parts[:4])
+    flush_service_component_updates([service_component_id])
     cb_client = CBClient()
     jsonld_params = 'format=simplified'
     scomponent_json = cb_client.query_entity(entity_id=service_component_id,
@@ -145,24 +305,142 @@ def get_service_component_status(service_component_id: str,
     return None
 
 
+def get_service_components_status(scomponent_ids: list) -> dict:
+    '''
+    Status of several service components, in one CB request per URL sized chunk
+    :param  scomponent_ids: ids of the service components
+    :return {service_component_id: ServiceComponentStatusEnum},
+              components not found or without status are left out
+    '''
+    flush_service_component_updates(scomponent_ids)
+    cb_client = CBClient()
+    scomponents_json = cb_client.query_entities_by_id(
+        entity_ids=scomponent_ids,
+        attrs_list=["serviceComponentStatus"],
+        entity_type="ServiceComponent")
+    statuses = {}
+    for scomponent_json in scomponents_json or []:
+        if scomponent_json.get('serviceComponentStatus') is not None:
+            statuses[scomponent_json["id"]] = scomponent_json.get(
+                'serviceComponentStatus')
+    return statuses
+
+
+def _answered(entity_json, key):
+    '''
+    Check CB answered a lookup of key, with the entity or ResourceNotFound.
+      Request errors (None) and other error responses are not answers to cache
+    :raise LookupFailed otherwise
+    '''
+    if isinstance(entity_json, list):
+        return entity_json
+    if isinstance(entity_json, dict) and (
+            "id" in entity_json
+            or str(entity_json.get("type", "")).endswith("ResourceNotFound")):
+        return entity_json
+    raise LookupFailed(f"No answer from CB for {key}")
+
+
+def _load_ie_domain(ie_id: str):
+    cb_client = CBClient()
+    jsonld_params = 'attrs=domain&format=simplified'
+    ie_json = _answered(
+        cb_client.query_entity(entity_id=ie_id, ngsild_params=jsonld_params),
+        ie_id)
+    return ie_json.get("domain")
+
+
+def _load_domain(domain_id: str):
+    cb_client = CBClient()
+    jsonld_params = 'attrs=publicUrl,publicKey&format=simplified'
+    url_json = _answered(
+        cb_client.query_entity(entity_id=domain_id,
+                               ngsild_params=jsonld_params), domain_id)
+    if url_json.get("publicUrl"):
+        return url_json.get("publicUrl"), url_json.get("publicKey")
+    return None
+
+
 def get_domain_url(ie_id: str) -> str:
     """
         Get (any) domain URL and public key
     """
+    index = get_topology_index()
+    domain = index.domain_of(ie_id) if index is not None else None
+    if domain is not None and domain.public_url:
+        return domain.public_url, domain.public_key
+    domain_id = _cache.get("ie_domain", ie_id, _load_ie_domain)
+    if domain_id is None:
+        logger.error('Failed to get domain of %s', ie_id)
+        return None
+    return _cache.get("domain", domain_id, _load_domain)
+
+
+def get_domain_urls(ie_ids: list) -> dict:
+    """
+        Get domain URL and public key of several IEs,
+          indexed and cached ones first, then two CB requests (IEs, then their domains)
+          per URL sized chunk for the rest
+        Returns:
+          {ie_id: (publicUrl, publicKey)}, IEs whose domain was not found are left out
+    """
     cb_client = CBClient()
-    jsonld_params = 'attrs=domain&format=simplified'
-    domain_json = cb_client.query_entity(entity_id=ie_id,
-                                         ngsild_params=jsonld_params)
-    if domain_json is not None:
-        jsonld_params = 'attrs=publicUrl,publicKey&format=simplified'
-        try:
-            url_json = cb_client.query_entity(
-                entity_id=domain_json.get("domain"),
-                ngsild_params=jsonld_params)
-            return url_json.get("publicUrl"), url_json.get("publicKey")
-        except AttributeError:
-            logger.exception('Failed to get domain')
-    return None
+    index = get_topology_index()
+    resolved = {}
+    ie_domains = {}
+    missing_ies = []
+    for ie_id in dict.fromkeys(ie_ids):
+        domain = index.domain_of(ie_id) if index is not None else None
+        if domain is not None and domain.public_url:
+            resolved[ie_id] = (domain.public_url, domain.public_key)
+            continue
+        found, domain_id = _cache.lookup("ie_domain", ie_id)
+        if not found:
+            missing_ies.append(ie_id)
+        elif domain_id:
+            ie_domains[ie_id] = domain_id
+    if missing_ies:
+        ies_json = cb_client.query_entities_by_id(
+            entity_ids=missing_ies,
+            attrs_list=["domain"],
+            entity_type="InfrastructureElement")
+        if ies_json is not None:
+            loaded = {
+                ie_json["id"]: ie_json.get("domain")
+                for ie_json in ies_json
+            }
+            for ie_id in missing_ies:
+                _cache.store("ie_domain", ie_id, loaded.get(ie_id))
+                if loaded.get(ie_id):
+                    ie_domains[ie_id] = loaded[ie_id]
+    domains = {}
+    missing_domains = []
+    for domain_id in dict.fromkeys(ie_domains.values()):
+        found, domain = _cache.lookup("domain", domain_id)
+        if not found:
+            missing_domains.append(domain_id)
+        elif domain:
+            domains[domain_id] = domain
+    if missing_domains:
+        domains_json = cb_client.query_entities_by_id(
+            entity_ids=missing_domains,
+            attrs_list=["publicUrl", "publicKey"],
+            entity_type="Domain")
+        if domains_json is not None:
+            loaded = {
+                domain_json["id"]:
+                (domain_json.get("publicUrl"), domain_json.get("publicKey"))
+                for domain_json in domains_json
+                if domain_json.get("publicUrl")
+            }
+            for domain_id in missing_domains:
+                _cache.store("domain", domain_id, loaded.get(domain_id))
+            domains.update(loaded)
+    resolved.update({
+        ie_id: domains[domain_id]
+        for ie_id, domain_id in ie_domains.items() if domain_id in domains
+    })
+    return resolved
 
 
 def get_host_domain():
@@ -173,9 +451,14 @@ def get_host_domain():
     Returns:
       publicUrl and publicKey of host domain
     """
+    return _cache.get("host_domain", "local", _load_host_domain)
+
+
+def _load_host_domain(_):
     cb_client = CBClient()
     jsonld_params = 'type=Domain&format=simplified&local=true&attrs=publicUrl,publicKey'
-    domain_json = cb_client.query_entities(ngsild_params=jsonld_params)
+    domain_json = _answered(
+        cb_client.query_entities(ngsild_params=jsonld_params), "local domain")
     # We are confident about [0] because each domain has just one domain registrered locally
     if domain_json:
         return domain_json[0].get("publicUrl"), domain_json[0].get("publicKey")
@@ -194,12 +477,17 @@ def get_full_ie_spec(ie_id: str):
     IE hostname: str
 
     """
+    return _cache.get("ie_hostname", ie_id, _load_ie_hostname)
+
+
+def _load_ie_hostname(ie_id: str):
     client = CBClient()
     ngsi_ld_options = "local=true&format=simplified"
-    response = client.query_entity_attrs(entity_id=ie_id,
-                                         attrs_list=["hostname"],
-                                         ngsi_ld_params=ngsi_ld_options)
-    return response["hostname"]
+    response = _answered(
+        client.query_entity_attrs(entity_id=ie_id,
+                                  attrs_list=["hostname"],
+                                  ngsi_ld_params=ngsi_ld_options), ie_id)
+    return response.get("hostname")
 
 
 def get_scompnent_hosting_ie(scomponent_id: str) -> str:
@@ -239,16 +527,8 @@ def get_ie_llo_type(ie_id: str, is_ie_local=True) -> str:
     Returns:
         str: The container technology as expected from LLO API ("K8s", "docker", or raw value if unknown).
     """
-    client = CBClient()
-    ngsi_ld_options = "format=simplified"
-    if is_ie_local:
-        ngsi_ld_options = ngsi_ld_options + "&local=true"
-    response = client.query_entity_attrs(entity_id=ie_id,
-                                         attrs_list=["containerTechnology"],
-                                         ngsi_ld_params=ngsi_ld_options)
-
-    # Extract value safely
-    tech = response.get("containerTechnology", "").strip()
+    tech = _cache.get("ie_llo_type", (ie_id, is_ie_local),
+                      _load_ie_container_technology) or ""
 
     # Map known values
     mapping = {"Kubernetes": "K8s", "Docker": "docker", "containerd": "containerd"}
@@ -257,6 +537,21 @@ def get_ie_llo_type(ie_id: str, is_ie_local=True) -> str:
         tech, tech)  # fallback: return original value if not in mapping
 
 
+def _load_ie_container_technology(key: tuple):
+    ie_id, is_ie_local = key
+    client = CBClient()
+    ngsi_ld_options = "format=simplified"
+    if is_ie_local:
+        ngsi_ld_options = ngsi_ld_options + "&local=true"
+    response = _answered(
+        client.query_entity_attrs(entity_id=ie_id,
+                                  attrs_list=["containerTechnology"],
+                                  ngsi_ld_params=ngsi_ld_options), ie_id)
+
+    # Extract value safely
+    return (response.get("containerTechnology") or "").strip() or None
+
+
 def get_service_action_type(service_id: str):
     """
     Get service action type used to check if we are
@@ -291,10 +586,9 @@ def get_service_handler_domain_url(service_id):
     service_json = cb_client.query_entity(entity_id=service_id,
                                           ngsild_params=jsonld_params)
     domain_handler_ref = service_json.get("domainHandler", None)
-    jsonld_params = 'attrs=publicUrl&format=simplified'
-    domain_json = cb_client.query_entity(entity_id=domain_handler_ref,
-                                         ngsild_params=jsonld_params)
-    domain_handler_url = domain_json.get("publicUrl", None)
+    # The handler changes with each deployment, its domain URL does not
+    domain = _cache.get("domain", domain_handler_ref, _load_domain)
+    domain_handler_url = domain[0] if domain else None
     return domain_handler_url
 
 
@@ -0,0 +1,85 @@
+'''
+    Per-message deadline budget.
+    process_message opens a deadline scope for each input; every HTTP call made inside it,
+      also from threads started with a copy of the context, uses the remaining budget as
+      timeout (capped by the call's own timeout) and fails fast once the budget is spent.
+    Outside a scope the calls keep their own fixed timeouts.
+'''
+import contextlib
+import contextvars
+import time
+from requests.exceptions import Timeout
+
+# time.monotonic() value after which the current message is out of budget
+_deadline = contextvars.ContextVar('hlo_de_deadline', default=None)
+
+
+class DeadlineExceeded(Timeout):
+    '''
+        Raised instead of sending a request once the message budget is spent.
+        A requests Timeout, so catch_requests_exceptions handles it like one
+    '''
+
+
+def remaining():
+    '''
+    Seconds left in the current budget, None when there is no deadline
+    '''
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired() -> bool:
+    '''
+    Whether the current budget is spent
+    '''
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def timeout(default: float) -> float:
+    '''
+    Timeout for the next request: default, capped by the remaining budget
+    :raise DeadlineExceeded if the budget is spent
+    '''
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("Message deadline exceeded")
+    return min(default, left)
+
+
+@contextlib.contextmanager
+def deadline_scope(seconds: float):
+    '''
+    Run the enclosed block with a budget of seconds, 0 or None means no deadline.
+    A nested scope never extends the budget of the enclosing one
+    '''
+    if not seconds:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def suspended():
+    '''
+    Run the enclosed block without deadline, e.g. to record failures
+      after the budget is spent
+    '''
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
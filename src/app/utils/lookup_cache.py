@@ -0,0 +1,130 @@
+'''
+    Read-through cache of continuum lookups (IE -> domain, domain -> publicUrl/publicKey, ...).
+    Entries are grouped by kind, each kind with its own TTL; lookups that found nothing
+      are remembered for a short negative TTL so a missing entity is not queried
+      again for every message. Lookups that failed (e.g. CB unreachable) are not cached.
+    The cache is bounded, least recently used entries go first.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+# Stored for lookups that found nothing, so None can still be a cached miss
+_MISSING = object()
+
+
+class LookupFailed(Exception):
+    '''
+        Raised by a loader whose lookup got no answer, so nothing is cached
+    '''
+
+
+class LookupCache:
+    '''
+        Thread safe LRU/TTL cache keyed on (kind, key)
+    '''
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 ttls: dict = None,
+                 default_ttl: float = 300.0,
+                 negative_ttl: float = 10.0,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        # (kind, key) -> (value, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # kind -> [hits, misses]
+        self._counters = {}
+
+    def ttl(self, kind: str) -> float:
+        '''
+        TTL of the entries of kind, 0 disables caching them
+        '''
+        return self.ttls.get(kind, self.default_ttl)
+
+    def lookup(self, kind: str, key):
+        '''
+        Cached value of (kind, key)
+        :return (found, value), value None for a cached miss
+        '''
+        with self._lock:
+            counters = self._counters.setdefault(kind, [0, 0])
+            entry = self._entries.get((kind, key))
+            if entry is None or entry[1] <= self.clock():
+                if entry is not None:
+                    del self._entries[(kind, key)]
+                counters[1] += 1
+                return False, None
+            self._entries.move_to_end((kind, key))
+            counters[0] += 1
+            value = entry[0]
+        return True, None if value is _MISSING else value
+
+    def store(self, kind: str, key, value):
+        '''
+        Cache value for the TTL of kind, None for the negative TTL
+        '''
+        ttl = self.ttl(kind)
+        if not ttl:
+            return
+        if value is None:
+            value = _MISSING
+            ttl = min(ttl, self.negative_ttl)
+        with self._lock:
+            self._entries[(kind, key)] = (value, self.clock() + ttl)
+            self._entries.move_to_end((kind, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, kind: str, key, load):
+        '''
+        Cached value of (kind, key), load(key) on a miss.
+        load returns None when there is nothing to find (cached for the negative TTL)
+          and raises LookupFailed when it could not tell (not cached, None is returned).
+        Concurrent misses of the same key may each call load, the last one is kept
+        '''
+        found, value = self.lookup(kind, key)
+        if found:
+            return value
+        try:
+            value = load(key)
+        except LookupFailed:
+            return None
+        self.store(kind, key, value)
+        return value
+
+    def invalidate(self, kind: str = None, key=None):
+        '''
+        Drop (kind, key), every entry of kind when key is None,
+          everything when kind is None too
+        '''
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+            elif key is None:
+                for cached in [
+                        cached for cached in self._entries
+                        if cached[0] == kind
+                ]:
+                    del self._entries[cached]
+            else:
+                self._entries.pop((kind, key), None)
+
+    def stats(self) -> dict:
+        '''
+        Entries, hits, misses and hit rate per kind
+        '''
+        with self._lock:
+            stats = {"entries": len(self._entries)}
+            for kind, (hits, misses) in self._counters.items():
+                stats[kind] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+                }
+        return stats
@@ -1,13 +1,19 @@
 '''
     Module with all functions to create pydantic objects for aeriOS continuum entities
+    Domains, LLOs and Organizations known to the TopologyIndex are built without CB requests
 '''
 # from typing import List
 from app.api_clients.cb_client import CBClient
+from app.utils.topology import get_topology_index
 import app.app_models.aeriOS_continuum as aeriOS_C
 
 
 def get_aeriOS_orginization(entity_id) -> aeriOS_C.Organization:
     """Get Organization from aeriOS"""
+    index = get_topology_index()
+    org = index.organization(entity_id) if index is not None else None
+    if org is not None:
+        return aeriOS_C.Organization(id=org.id, name=org.name)
     cb_client = CBClient()
     aeriOS_org_json = cb_client.query_entity(entity_id=entity_id,
                                             ngsild_params='format=simplified')
@@ -17,10 +23,20 @@ def get_aeriOS_orginization(entity_id) -> aeriOS_C.Organization:
 
 def get_aeriOS_domain(entity_id) -> aeriOS_C.Domain:
     """Get Domain from aeriOS"""
-    cb_client = CBClient()
-    aeriOS_domain_json = cb_client.query_entity(
-        entity_id=entity_id, ngsild_params='format=simplified')
-    domain_py = aeriOS_C.Domain(**aeriOS_domain_json)
+    index = get_topology_index()
+    domain = index.domain(entity_id) if index is not None else None
+    if domain is not None:
+        domain_py = aeriOS_C.Domain(id=domain.id,
+                                    description=domain.description,
+                                    publicUrl=domain.public_url,
+                                    owner=[domain.owner],
+                                    isEntrypoint=domain.is_entrypoint,
+                                    domainStatus=domain.domain_status)
+    else:
+        cb_client = CBClient()
+        aeriOS_domain_json = cb_client.query_entity(
+            entity_id=entity_id, ngsild_params='format=simplified')
+        domain_py = aeriOS_C.Domain(**aeriOS_domain_json)
     org_py = get_aeriOS_orginization(
         domain_py.owner[0])  # FIXME, will there be many Owners ?
     domain_py.owner = org_py
@@ -29,10 +45,18 @@ def get_aeriOS_domain(entity_id) -> aeriOS_C.Domain:
 
 def get_aeriOS_llo(entity_id) -> aeriOS_C.LowLevelOrchestrator:
     """Get LowLevelOrchestrator from aeriOS"""
-    cb_client = CBClient()
-    aeriOS_llo_json = cb_client.query_entity(entity_id=entity_id,
-                                            ngsild_params='format=simplified')
-    aeriOS_llo_py = aeriOS_C.LowLevelOrchestrator(**aeriOS_llo_json)
+    index = get_topology_index()
+    llo = index.llo(entity_id) if index is not None else None
+    if llo is not None:
+        aeriOS_llo_py = aeriOS_C.LowLevelOrchestrator(
+            id=llo.id,
+            domain=llo.domain,
+            orchestrationType=llo.orchestration_type)
+    else:
+        cb_client = CBClient()
+        aeriOS_llo_json = cb_client.query_entity(
+            entity_id=entity_id, ngsild_params='format=simplified')
+        aeriOS_llo_py = aeriOS_C.LowLevelOrchestrator(**aeriOS_llo_json)
     domain_py = get_aeriOS_domain(aeriOS_llo_py.domain)
     aeriOS_llo_py.domain = domain_py
     return aeriOS_llo_py
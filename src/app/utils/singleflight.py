@@ -0,0 +1,87 @@
+'''
+    Request coalescing (singleflight).
+    While a call for a key is in flight, identical calls do not run again: they wait for
+      the first one and get its result, or its exception.
+    Nothing is kept once the call returns, so it never serves stale data, see LookupCache for that.
+'''
+import threading
+from app.utils import deadline
+
+
+class _Call:
+    '''
+        One in flight call and the callers waiting for it
+    '''
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+        Thread safe singleflight group keyed on any hashable key
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        '''
+        Result of func(*args, **kwargs), shared with identical calls in flight.
+        Every caller, the one running the call included, waits at most for its own
+          deadline budget: under a deadline the call runs in a thread of its own, without
+          deadline, so it is not cut short for the other callers by the first one's budget
+        :raise the exception of the shared call, DeadlineExceeded if the budget is spent
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if leader:
+            if deadline.remaining() is None:
+                self._run(key, call, func, args, kwargs)
+            else:
+                threading.Thread(target=self._run,
+                                 args=(key, call, func, args, kwargs),
+                                 daemon=True).start()
+        if not call.done.wait(deadline.remaining()):
+            raise deadline.DeadlineExceeded("Message deadline exceeded")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self, key, call: _Call, func, args, kwargs):
+        '''
+        Run the shared call and release the callers waiting for it
+        '''
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as error:  # pylint: disable=broad-except
+            call.error = error
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        '''
+        Calls run, calls answered by another caller's call and calls in flight
+        '''
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "shared": self.shared,
+                "in_flight": len(self._calls)
+            }
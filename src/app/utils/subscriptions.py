@@ -0,0 +1,197 @@
+'''
+    Context broker change subscriptions keeping the topology index and lookup cache fresh.
+    At startup one NGSI-LD subscription per Domain, InfrastructureElement and
+      LowLevelOrchestrator is registered, notifying /hlo_de/notifications.
+    Notifications are queued and applied in batches: NOTIFICATION_DEBOUNCE seconds after the
+      first one arrives (or once NOTIFICATION_MAX_BATCH entities are queued) the latest
+      version of every notified entity is written to the TopologyIndex and its cached
+      lookups are invalidated.
+'''
+import hashlib
+import threading
+from app.api_clients.cb_client import CBClient
+from app.utils import continuum_utils
+from app.utils.topology import get_topology_index
+from app.utils.log import get_app_logger
+from app.config import NOTIFICATION_URL, NOTIFICATION_DEBOUNCE, \
+    NOTIFICATION_MAX_BATCH
+
+logger = get_app_logger()
+
+SUBSCRIBED_TYPES = ("Domain", "InfrastructureElement", "LowLevelOrchestrator")
+
+# Process wide batcher, see get_notification_batcher()
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def subscription_id(entity_type: str, notification_url: str) -> str:
+    '''
+    Stable id of the subscription of entity_type, so restarts do not add subscriptions
+    '''
+    digest = hashlib.sha256(notification_url.encode()).hexdigest()[:12]
+    return f"urn:ngsi-ld:Subscription:hlo-de:{entity_type}:{digest}"
+
+
+def register_subscriptions(notification_url: str = NOTIFICATION_URL) -> list:
+    '''
+    Register the change subscriptions
+    :return the entity types whose subscription exists
+    '''
+    if not notification_url:
+        return []
+    cb_client = CBClient()
+    registered = []
+    for entity_type in SUBSCRIBED_TYPES:
+        subscription = {
+            "id": subscription_id(entity_type, notification_url),
+            "type": "Subscription",
+            "entities": [{
+                "type": entity_type
+            }],
+            "notificationTrigger":
+            ["entityCreated", "entityUpdated", "entityDeleted"],
+            "notification": {
+                "format": "keyValues",
+                "endpoint": {
+                    "uri": notification_url,
+                    "accept": "application/json"
+                }
+            }
+        }
+        status_code = cb_client.create_subscription(subscription=subscription)
+        if status_code in (201, 409):
+            registered.append(entity_type)
+        else:
+            logger.error("Failed to subscribe to %s changes: %s", entity_type,
+                         status_code)
+    logger.info("Subscribed to %s changes", registered)
+    return registered
+
+
+def apply_entities(entities: list):
+    '''
+    Write notified entities to the topology index and drop their cached lookups
+    '''
+    index = get_topology_index()
+    for entity in entities:
+        entity_type = entity.get("type")
+        entity_id = entity.get("id")
+        if index is not None:
+            if entity.get("deletedAt"):
+                index.remove(entity_type, entity_id)
+            else:
+                index.update(entity_type, entity)
+        if entity_type == "InfrastructureElement":
+            continuum_utils.invalidate_infrastructure_element(entity_id)
+        elif entity_type == "Domain":
+            continuum_utils.invalidate_domain(entity_id)
+
+
+class NotificationBatcher:
+    '''
+        Debounces notified entities and applies them in batches from a daemon thread.
+        Several notifications of the same entity within a batch are applied once, latest wins
+    '''
+
+    def __init__(self,
+                 apply=apply_entities,
+                 debounce: float = 0.5,
+                 max_batch: int = 500):
+        self.apply = apply
+        self.debounce = debounce
+        self.max_batch = max_batch
+        # (type, id) -> latest entity, in arrival order
+        self._pending = {}
+        self._applying = False
+        self._cond = threading.Condition()
+        self._stop = False
+        self.received = 0
+        self.applied = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name="cb-notifications",
+                                        daemon=True)
+        self._thread.start()
+
+    def add(self, entities: list):
+        '''
+        Queue notified entities
+        '''
+        with self._cond:
+            for entity in entities:
+                if "id" not in entity:
+                    continue
+                key = (entity.get("type"), entity["id"])
+                self._pending.pop(key, None)
+                self._pending[key] = entity
+                self.received += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop:
+                    self._cond.wait()
+                if self._stop and not self._pending:
+                    return
+                # Let the burst settle, unless the batch is already full
+                self._cond.wait_for(
+                    lambda: self._stop or len(self._pending) >= self.max_batch,
+                    timeout=self.debounce)
+                batch = list(self._pending.values())
+                self._pending = {}
+                self._applying = True
+            try:
+                self.apply(batch)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to apply %s notified entities",
+                                 len(batch))
+            with self._cond:
+                self._applying = False
+                self.applied += len(batch)
+                self.batches += 1
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        '''
+        Wait until everything queued so far is applied
+        '''
+        with self._cond:
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._applying,
+                timeout=timeout)
+
+    def stop(self):
+        '''
+        Apply what is queued and stop the thread
+        '''
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        '''
+        Notified, applied entities and batches
+        '''
+        with self._cond:
+            return {
+                "notified_entities": self.received,
+                "applied_entities": self.applied,
+                "pending_entities": len(self._pending),
+                "batches": self.batches
+            }
+
+
+def get_notification_batcher() -> NotificationBatcher:
+    '''
+    Process wide notification batcher, started on first use
+    '''
+    global _batcher  # pylint: disable=global-statement
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = NotificationBatcher(debounce=NOTIFICATION_DEBOUNCE,
+                                           max_batch=NOTIFICATION_MAX_BATCH)
+    return _batcher
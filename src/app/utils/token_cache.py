@@ -0,0 +1,180 @@
+'''
+    Expiry aware cache of an M2M token.
+    The token is shared by all threads and kept until shortly before the JWT "exp" claim,
+      a background thread fetches the next one before it expires and,
+      on a miss, a single caller fetches while the others wait for its result.
+'''
+import base64
+import json
+import threading
+import time
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+# Shortest wait of the background refresher between two fetches
+MIN_REFRESH_DELAY = 1.0
+
+
+def jwt_expiry(token: str):
+    '''
+    "exp" claim (epoch seconds) of a JWT, None if token is not a JWT or has no exp
+    '''
+    try:
+        payload = token.split('.')[1]
+        # base64url without padding
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenCache:
+    '''
+        Token returned by fetch(), reused until refresh_margin seconds before it expires.
+        fetch() returns the token or None on failure.
+        Tokens without exp are kept default_ttl seconds.
+        The margin is at most half the lifetime of the token, and a token that looks
+          (nearly) expired once fetched, e.g. with skewed clocks, is kept min_lifetime seconds,
+          so short lived tokens do not make the refresher fetch in a tight loop
+    '''
+
+    def __init__(self,
+                 fetch,
+                 name: str = "token",
+                 refresh_margin: float = 60.0,
+                 default_ttl: float = 300.0,
+                 retry_interval: float = 10.0,
+                 min_lifetime: float = 10.0,
+                 clock=time.time):
+        self.fetch = fetch
+        self.name = name
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.retry_interval = retry_interval
+        self.min_lifetime = min_lifetime
+        self.clock = clock
+        self._token = None
+        self._expires_at = 0.0
+        self._lifetime = 0.0
+        self._fetching = False
+        self._cond = threading.Condition()
+        self._refresher = None
+        self._stop = threading.Event()
+        # Counters
+        self.hits = 0
+        self.fetches = 0
+        self.failures = 0
+
+    def _margin(self) -> float:
+        '''
+        Seconds before expiry the current token is refreshed
+        '''
+        return min(self.refresh_margin, self._lifetime / 2)
+
+    def _valid(self) -> bool:
+        return self._token is not None and \
+            self.clock() < self._expires_at - self._margin() / 2
+
+    def get(self):
+        '''
+        Current token, fetched on a miss by a single caller
+        :return the token or None if it could not be fetched
+        '''
+        with self._cond:
+            if self._valid():
+                self.hits += 1
+                return self._token
+            if self._fetching:
+                # Someone else is fetching, wait for its result
+                while self._fetching:
+                    self._cond.wait()
+                return self._token if self._valid() else None
+            self._fetching = True
+        return self._refresh()
+
+    def invalidate(self, token: str = None):
+        '''
+        Drop the cached token, e.g. after a 401.
+        :param token: the rejected token, a newer cached token is kept
+        '''
+        with self._cond:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+    def _refresh(self):
+        '''
+        Fetch a new token, the caller has set _fetching
+        '''
+        token = None
+        try:
+            token = self.fetch()
+        finally:
+            with self._cond:
+                self.fetches += 1
+                if token:
+                    now = self.clock()
+                    expires_at = jwt_expiry(token) or now + self.default_ttl
+                    if expires_at - now < self.min_lifetime:
+                        logger.warning(
+                            "%s expires in %.0fs, keeping it %ss",
+                            self.name, expires_at - now, self.min_lifetime)
+                        expires_at = now + self.min_lifetime
+                    self._token = token
+                    self._expires_at = expires_at
+                    self._lifetime = expires_at - now
+                else:
+                    self.failures += 1
+                    logger.error("Could not fetch %s", self.name)
+                self._fetching = False
+                self._cond.notify_all()
+        self._start_refresher()
+        return token
+
+    def _start_refresher(self):
+        with self._cond:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               name=f"{self.name}-refresh",
+                                               daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        '''
+        Fetch the next token a margin before the current one expires,
+          waiting at least MIN_REFRESH_DELAY between fetches
+        '''
+        while not self._stop.is_set():
+            with self._cond:
+                if self._token is None:
+                    delay = self.retry_interval
+                else:
+                    delay = max(
+                        self._expires_at - self._margin() - self.clock(),
+                        MIN_REFRESH_DELAY)
+            if self._stop.wait(delay):
+                return
+            with self._cond:
+                if self._fetching:
+                    continue
+                self._fetching = True
+            if self._refresh() is None:
+                self._stop.wait(self.retry_interval)
+
+    def stop(self):
+        '''
+        Stop the background refresh
+        '''
+        self._stop.set()
+
+    def stats(self) -> dict:
+        '''
+        Hit, fetch and failure counters
+        '''
+        return {
+            f"{self.name}_hits": self.hits,
+            f"{self.name}_fetches": self.fetches,
+            f"{self.name}_failures": self.failures,
+        }
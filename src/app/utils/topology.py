@@ -0,0 +1,346 @@
+'''
+    In memory index of the continuum topology.
+    All Organization, Domain, LowLevelOrchestrator and InfrastructureElement entities are
+      streamed once, in pages, into compact records with interned URNs, together with the
+      reverse maps domain -> IEs and LLO -> IEs, so IE -> domain -> publicUrl/publicKey and
+      IE -> LLO resolve without a request to the context broker.
+    A background thread refreshes the index: every TOPOLOGY_REFRESH_INTERVAL seconds only
+      the entities modified since the last refresh (modifiedAt) are queried, every
+      TOPOLOGY_FULL_RELOAD_INTERVAL seconds everything is reloaded to drop deleted entities.
+    Lookups of entities not indexed yet return None and callers fall back to querying CB.
+'''
+import sys
+import threading
+import time
+from urllib.parse import quote
+from requests.exceptions import RequestException
+from app.api_clients.cb_client import CBClient
+from app.utils.log import get_app_logger
+from app.config import TOPOLOGY_INDEX, TOPOLOGY_PAGE_SIZE, \
+    TOPOLOGY_REFRESH_INTERVAL, TOPOLOGY_FULL_RELOAD_INTERVAL
+
+logger = get_app_logger()
+
+# Process wide index, see get_topology_index()
+_index = None
+_index_lock = threading.Lock()
+
+
+def _urn(value):
+    '''
+    Interned URN, relationships to several objects keep the first one
+    '''
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return sys.intern(value) if isinstance(value, str) else None
+
+
+class OrganizationRecord:
+    '''
+        Indexed Organization
+    '''
+
+    __slots__ = ('id', 'name')
+
+    def __init__(self, entity: dict):
+        self.id = _urn(entity["id"])
+        self.name = entity.get("name")
+
+
+class DomainRecord:
+    '''
+        Indexed Domain
+    '''
+
+    __slots__ = ('id', 'description', 'public_url', 'public_key', 'owner',
+                 'is_entrypoint', 'domain_status')
+
+    def __init__(self, entity: dict):
+        self.id = _urn(entity["id"])
+        self.description = entity.get("description")
+        self.public_url = entity.get("publicUrl")
+        self.public_key = entity.get("publicKey")
+        self.owner = _urn(entity.get("owner"))
+        self.is_entrypoint = entity.get("isEntrypoint")
+        self.domain_status = _urn(entity.get("domainStatus"))
+
+
+class LLORecord:
+    '''
+        Indexed LowLevelOrchestrator
+    '''
+
+    __slots__ = ('id', 'domain', 'orchestration_type')
+
+    def __init__(self, entity: dict):
+        self.id = _urn(entity["id"])
+        self.domain = _urn(entity.get("domain"))
+        self.orchestration_type = _urn(entity.get("orchestrationType"))
+
+
+class IERecord:
+    '''
+        Indexed InfrastructureElement, topology attributes only
+    '''
+
+    __slots__ = ('id', 'domain', 'llo', 'hostname', 'container_technology')
+
+    def __init__(self, entity: dict):
+        self.id = _urn(entity["id"])
+        self.domain = _urn(entity.get("domain"))
+        self.llo = _urn(entity.get("lowLevelOrchestrator"))
+        self.hostname = entity.get("hostname")
+        self.container_technology = _urn(entity.get("containerTechnology"))
+
+
+# Indexed entity type -> (record class, attributes queried)
+ENTITY_TYPES = {
+    "Organization": (OrganizationRecord, ["name"]),
+    "Domain": (DomainRecord, [
+        "description", "publicUrl", "publicKey", "owner", "isEntrypoint",
+        "domainStatus"
+    ]),
+    "LowLevelOrchestrator": (LLORecord, ["domain", "orchestrationType"]),
+    "InfrastructureElement":
+    (IERecord,
+     ["domain", "lowLevelOrchestrator", "hostname", "containerTechnology"]),
+}
+
+
+class TopologyIndex:
+    '''
+        Forward and reverse maps of the continuum topology.
+        Lookups read the maps without locking, updates swap or change them under a lock
+    '''
+
+    def __init__(self, page_size: int = 1000, clock=time.monotonic):
+        self.page_size = page_size
+        self.clock = clock
+        # entity type -> {id: record}
+        self._records = {entity_type: {} for entity_type in ENTITY_TYPES}
+        # domain -> set of IE ids, LLO -> set of IE ids
+        self._domain_ies = {}
+        self._llo_ies = {}
+        # Highest modifiedAt seen, next incremental refresh asks for newer entities
+        self._modified_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+        self.loaded = False
+        self.last_full_load = None
+        self.loads = 0
+        self.refreshes = 0
+
+    def _scan(self, entity_type: str, since: str = None):
+        '''
+        Entities of entity_type, modified after since if given, streamed page by page
+        :raise requests.RequestException if a page could not be read
+        '''
+        _, attrs = ENTITY_TYPES[entity_type]
+        params = f"type={entity_type}&format=simplified&options=sysAttrs" \
+                 f"&attrs={','.join(attrs)}"
+        if since:
+            params += f"&q={quote(f'modifiedAt>{since}', safe='')}"
+        return CBClient().iter_entities(params,
+                                        page_size=self.page_size,
+                                        prefetch=True)
+
+    def load(self) -> bool:
+        '''
+        (Re)load the whole index, the previous maps are kept if any type fails to load.
+        Records are built while the pages stream in, raw entities are not kept
+        '''
+        records = {}
+        modified_at = None
+        for entity_type, (record_class, _) in ENTITY_TYPES.items():
+            records[entity_type] = {}
+            try:
+                for entity in self._scan(entity_type):
+                    record = record_class(entity)
+                    records[entity_type][record.id] = record
+                    modified_at = max(modified_at or "",
+                                      entity.get("modifiedAt") or "") or None
+            except RequestException as e:
+                logger.error("Failed to load %s entities in topology index: %s",
+                             entity_type, e)
+                return False
+        domain_ies = {}
+        llo_ies = {}
+        for ie in records["InfrastructureElement"].values():
+            domain_ies.setdefault(ie.domain, set()).add(ie.id)
+            llo_ies.setdefault(ie.llo, set()).add(ie.id)
+        with self._lock:
+            self._records = records
+            self._domain_ies = domain_ies
+            self._llo_ies = llo_ies
+            self._modified_at = modified_at
+            self.loaded = True
+            self.last_full_load = self.clock()
+            self.loads += 1
+        logger.info("Topology index loaded: %s", self.stats())
+        return True
+
+    def refresh(self) -> bool:
+        '''
+        Apply the entities modified since the last load or refresh
+        '''
+        if not self.loaded:
+            return self.load()
+        since = self._modified_at
+        changed = {}
+        for entity_type in ENTITY_TYPES:
+            try:
+                changed[entity_type] = list(self._scan(entity_type, since=since))
+            except RequestException as e:
+                logger.error("Failed to refresh %s entities in topology index: %s",
+                             entity_type, e)
+                return False
+        with self._lock:
+            for entity_type, entities in changed.items():
+                for entity in entities:
+                    self._apply(entity_type, entity)
+            self.refreshes += 1
+        return True
+
+    def _apply(self, entity_type: str, entity: dict):
+        '''
+        Insert or replace one entity, the lock is held
+        '''
+        record_class, _ = ENTITY_TYPES[entity_type]
+        record = record_class(entity)
+        if entity_type == "InfrastructureElement":
+            previous = self._records[entity_type].get(record.id)
+            if previous is not None:
+                self._domain_ies.get(previous.domain, set()).discard(previous.id)
+                self._llo_ies.get(previous.llo, set()).discard(previous.id)
+            self._domain_ies.setdefault(record.domain, set()).add(record.id)
+            self._llo_ies.setdefault(record.llo, set()).add(record.id)
+        self._records[entity_type][record.id] = record
+        if entity.get("modifiedAt"):
+            self._modified_at = max(self._modified_at or "",
+                                    entity["modifiedAt"])
+
+    def update(self, entity_type: str, entity: dict):
+        '''
+        Apply an entity received by other means (e.g. a notification)
+        '''
+        if entity_type in ENTITY_TYPES and "id" in entity:
+            with self._lock:
+                self._apply(entity_type, entity)
+
+    def remove(self, entity_type: str, entity_id: str):
+        '''
+        Drop a deleted entity
+        '''
+        with self._lock:
+            record = self._records.get(entity_type, {}).pop(entity_id, None)
+            if isinstance(record, IERecord):
+                self._domain_ies.get(record.domain, set()).discard(record.id)
+                self._llo_ies.get(record.llo, set()).discard(record.id)
+
+    def ie(self, ie_id: str) -> IERecord:
+        '''
+        Indexed IE, None if unknown
+        '''
+        return self._records["InfrastructureElement"].get(ie_id)
+
+    def domain(self, domain_id: str) -> DomainRecord:
+        '''
+        Indexed Domain, None if unknown
+        '''
+        return self._records["Domain"].get(domain_id)
+
+    def llo(self, llo_id: str) -> LLORecord:
+        '''
+        Indexed LowLevelOrchestrator, None if unknown
+        '''
+        return self._records["LowLevelOrchestrator"].get(llo_id)
+
+    def organization(self, organization_id: str) -> OrganizationRecord:
+        '''
+        Indexed Organization, None if unknown
+        '''
+        return self._records["Organization"].get(organization_id)
+
+    def domain_of(self, ie_id: str) -> DomainRecord:
+        '''
+        Domain of an IE, None if either is unknown
+        '''
+        ie = self.ie(ie_id)
+        return self.domain(ie.domain) if ie is not None else None
+
+    def llo_of(self, ie_id: str) -> str:
+        '''
+        LowLevelOrchestrator id of an IE, None if the IE is unknown
+        '''
+        ie = self.ie(ie_id)
+        return ie.llo if ie is not None else None
+
+    def ies_of_domain(self, domain_id: str) -> set:
+        '''
+        Ids of the IEs of a domain
+        '''
+        return set(self._domain_ies.get(domain_id, ()))
+
+    def ies_of_llo(self, llo_id: str) -> set:
+        '''
+        Ids of the IEs managed by an LLO
+        '''
+        return set(self._llo_ies.get(llo_id, ()))
+
+    def start(self, refresh_interval: float, full_reload_interval: float):
+        '''
+        Refresh the index from a daemon thread
+        '''
+        self._refresher = threading.Thread(
+            target=self._refresh_loop,
+            args=(refresh_interval, full_reload_interval),
+            name="topology-refresh",
+            daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self, refresh_interval: float,
+                      full_reload_interval: float):
+        while not self._stop.wait(refresh_interval):
+            try:
+                if not self.loaded or \
+                        self.clock() - self.last_full_load >= full_reload_interval:
+                    self.load()
+                else:
+                    self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Topology index refresh failed")
+
+    def stop(self):
+        '''
+        Stop the background refresh
+        '''
+        self._stop.set()
+
+    def stats(self) -> dict:
+        '''
+        Indexed entities per type, loads and refreshes
+        '''
+        stats = {
+            entity_type: len(records)
+            for entity_type, records in self._records.items()
+        }
+        stats.update(loads=self.loads, refreshes=self.refreshes)
+        return stats
+
+
+def get_topology_index():
+    '''
+    Process wide topology index, loaded and refreshed from the first call on.
+    None when TOPOLOGY_INDEX is disabled
+    '''
+    global _index  # pylint: disable=global-statement
+    if not TOPOLOGY_INDEX:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = TopologyIndex(page_size=TOPOLOGY_PAGE_SIZE)
+            _index.load()
+            _index.start(TOPOLOGY_REFRESH_INTERVAL,
+                         TOPOLOGY_FULL_RELOAD_INTERVAL)
+    return _index
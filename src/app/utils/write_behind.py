@@ -0,0 +1,201 @@
+'''
+    Write-behind queue of entity updates.
+    Updates are keyed on entity id and merged while they wait, the latest value of every
+      attribute wins, so several updates of one entity within a few milliseconds are
+      written once. A daemon thread writes the pending entities as one batch
+      WRITE_BEHIND_INTERVAL seconds after the first one is queued, or as soon as
+      WRITE_BEHIND_MAX_BATCH entities are pending or a caller asks for a flush.
+    flush() is the barrier for callers that need their writes in CB, e.g. before reading
+      them back or before committing the kafka offsets of the messages that made them.
+    Entities whose write failed transiently (request failed, 5xx, 429) are queued again,
+      under any newer update of theirs, and retried after retry_interval seconds;
+      flush() waits for them, so it returns False on timeout while CB is unreachable.
+    Entities CB rejects (other 4xx) are dropped and make the next flush() return False.
+'''
+import threading
+from app.utils.log import get_app_logger
+
+logger = get_app_logger()
+
+
+def is_transient(error) -> bool:
+    '''
+    Whether an entity error of update_entities may succeed when retried
+    '''
+    status = error.get("status") if isinstance(error, dict) else None
+    return status is None or status >= 500 or status == 429
+
+
+class WriteBehindQueue:
+    '''
+        Coalesces entity updates and writes them in batches from a daemon thread.
+        write(entities) gets the merged fragments and returns
+          {"success": [ids], "errors": {id: error}} or None when the request failed
+    '''
+
+    def __init__(self,
+                 write,
+                 interval: float = 0.005,
+                 max_batch: int = 100,
+                 retry_interval: float = 1.0):
+        self.write = write
+        self.interval = interval
+        self.max_batch = max_batch
+        self.retry_interval = retry_interval
+        # entity id -> merged fragment, in order of first update
+        self._pending = {}
+        # ids of the batch being written and ids queued again after a transient failure
+        self._writing = set()
+        self._retrying = set()
+        # Entities rejected since the last full flush
+        self._rejected = 0
+        # Updates queued so far and the highest of them written, dropped or queued again
+        self._queued_seq = 0
+        self._written_seq = 0
+        self._flush_requests = 0
+        self._cond = threading.Condition()
+        self._stop = False
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name="cb-write-behind",
+                                        daemon=True)
+        self._thread.start()
+
+    def put(self, updates: list):
+        '''
+        Queue entity fragments, each with id, type and the attributes to update
+        '''
+        with self._cond:
+            for update in updates:
+                pending = self._pending.get(update["id"])
+                if pending is None:
+                    self._pending[update["id"]] = dict(update)
+                else:
+                    pending.update(update)
+                    self.coalesced += 1
+                self.queued += 1
+                self._queued_seq += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop:
+                    self._cond.wait()
+                if self._stop and not self._pending:
+                    return
+                # Let more updates join the batch, unless it is full or awaited
+                self._cond.wait_for(
+                    lambda: self._stop or self._flush_requests or len(
+                        self._pending) >= self.max_batch,
+                    timeout=self.interval)
+                batch = list(self._pending.values())
+                self._pending = {}
+                self._writing = {entity["id"] for entity in batch}
+                seq = self._queued_seq
+            try:
+                results = self.write(batch)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to write %s entities", len(batch))
+                results = None
+            if results is None:
+                results = {
+                    "success": [],
+                    "errors": {entity["id"]: None
+                               for entity in batch}
+                }
+            with self._cond:
+                retry = self._settle(batch, results)
+                self._writing = set()
+                self._written_seq = seq
+                self.batches += 1
+                self._cond.notify_all()
+                if retry:
+                    # Back off before writing the failed entities again
+                    self._cond.wait_for(lambda: self._stop,
+                                        timeout=self.retry_interval)
+
+    def _settle(self, batch: list, results: dict) -> bool:
+        '''
+        Count the outcome of a written batch and queue its transient failures again,
+          the lock is held
+        :return True if entities were queued again
+        '''
+        self.written += len(results["success"])
+        self._retrying.difference_update(results["success"])
+        retry = False
+        for entity in batch:
+            if entity["id"] not in results["errors"]:
+                continue
+            error = results["errors"][entity["id"]]
+            if is_transient(error) and not self._stop:
+                # Newer updates queued meanwhile win over the failed ones
+                entity.update(self._pending.pop(entity["id"], {}))
+                self._pending[entity["id"]] = entity
+                self._retrying.add(entity["id"])
+                self.retried += 1
+                retry = True
+            else:
+                logger.error("Dropped update of %s: %s", entity["id"], error)
+                self._retrying.discard(entity["id"])
+                self._rejected += 1
+                self.failed += 1
+        return retry
+
+    def flush(self, entity_ids: list = None, timeout: float = None) -> bool:
+        '''
+        Wait until every update queued so far is written, retried ones included.
+        With entity_ids, return at once when none of them has an update pending
+        :return False if timeout expired first or, for a full flush,
+                if CB rejected entities since the last full flush
+        '''
+        with self._cond:
+            if entity_ids is not None and not any(
+                    entity_id in self._pending or entity_id in self._writing
+                    for entity_id in entity_ids):
+                return True
+            target = self._queued_seq
+            awaited = self._retrying if entity_ids is None else set(entity_ids)
+            self._flush_requests += 1
+            self._cond.notify_all()
+            try:
+                written = self._cond.wait_for(
+                    lambda: self._written_seq >= target and self._retrying.
+                    isdisjoint(awaited),
+                    timeout=timeout)
+            finally:
+                self._flush_requests -= 1
+            if entity_ids is None and self._rejected:
+                self._rejected = 0
+                return False
+            return written
+
+    def stop(self, timeout: float = None):
+        '''
+        Write what is queued and stop the thread
+        '''
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        '''
+        Updates queued, merged into a pending one, entities written, dropped or retried
+          and batches
+        '''
+        with self._cond:
+            return {
+                "queued_updates": self.queued,
+                "coalesced_updates": self.coalesced,
+                "written_entities": self.written,
+                "failed_entities": self.failed,
+                "retried_entities": self.retried,
+                "pending_entities": len(self._pending),
+                "batches": self.batches
+            }
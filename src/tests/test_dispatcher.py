@@ -0,0 +1,106 @@
+'''
+    RemoteAllocationDispatcher under a per-message deadline
+'''
+import concurrent.futures
+import threading
+import time
+import pytest
+from app.api_clients import la_manager_client
+from app.api_clients.la_manager_client import RemoteAllocationDispatcher
+from app.runtime.report import DeploymentReport
+from app.utils import deadline
+from app.utils.decorators import catch_requests_exceptions
+import app.app_models.aeriOS_continuum as aeriOS_c
+
+FAILED = aeriOS_c.ServiceComponentStatusEnum.FAILED
+
+
+class FakeHLOALClient:
+    '''
+        HLOALClient stand-in, deallocations take delay seconds before their request
+    '''
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent = []
+
+    @catch_requests_exceptions
+    def request_deallocate_scompenent(self, service_component_id: str,
+                                      service_id: str):
+        time.sleep(self.delay)
+        # The request timeout is the remaining budget, raises once it is spent
+        deadline.timeout(15)
+        self.sent.append(service_component_id)
+        return 200
+
+
+@pytest.fixture(name="failed_writes")
+def fixture_failed_writes(monkeypatch):
+    writes = []
+    monkeypatch.setattr(
+        la_manager_client.c_utils, "set_service_components_status",
+        lambda scomponent_ids, scomponent_status: writes.append(
+            (list(scomponent_ids), scomponent_status)))
+    return writes
+
+
+def _deallocate(dispatcher, client, scomponent_id):
+    dispatcher.submit(client, "request_deallocate_scompenent", {
+        "service_id": "",
+        "service_component_id": scomponent_id
+    })
+
+
+def test_calls_within_budget(failed_writes):
+    client = FakeHLOALClient()
+    with deadline.deadline_scope(5):
+        with RemoteAllocationDispatcher() as dispatcher:
+            _deallocate(dispatcher, client, "urn:ngsi-ld:Service:1:Component:1")
+    assert client.sent == ["urn:ngsi-ld:Service:1:Component:1"]
+    assert not failed_writes
+
+
+def test_budget_spent_during_call_sets_failed(failed_writes):
+    client = FakeHLOALClient(delay=0.3)
+    report = DeploymentReport("urn:ngsi-ld:Service:1")
+    with deadline.deadline_scope(0.1):
+        with RemoteAllocationDispatcher(report=report) as dispatcher:
+            _deallocate(dispatcher, client, "urn:ngsi-ld:Service:1:Component:1")
+    assert client.sent == []
+    assert failed_writes == [(["urn:ngsi-ld:Service:1:Component:1"], FAILED)]
+    component = report.to_dict()["service_components"][0]
+    assert component["status"] == FAILED
+
+
+def test_unstarted_calls_cancelled_in_one_write(failed_writes):
+    started = threading.Event()
+    release = threading.Event()
+
+    class BlockedClient(FakeHLOALClient):
+
+        @catch_requests_exceptions
+        def request_deallocate_scompenent(self, service_component_id: str,
+                                          service_id: str):
+            started.set()
+            release.wait()
+            deadline.timeout(15)
+            return 200
+
+    dispatcher = RemoteAllocationDispatcher()
+    # A single worker, so the second call cannot start before the deadline
+    dispatcher.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    with deadline.deadline_scope(0.1):
+        _deallocate(dispatcher, BlockedClient(),
+                    "urn:ngsi-ld:Service:1:Component:1")
+        _deallocate(dispatcher, BlockedClient(),
+                    "urn:ngsi-ld:Service:1:Component:2")
+        assert started.wait(1)
+        threading.Timer(0.3, release.set).start()
+        dispatcher.wait()
+    assert len(failed_writes) == 1
+    ids, status = failed_writes[0]
+    assert status == FAILED
+    assert sorted(ids) == [
+        "urn:ngsi-ld:Service:1:Component:1",
+        "urn:ngsi-ld:Service:1:Component:2"
+    ]
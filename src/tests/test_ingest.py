@@ -0,0 +1,120 @@
+'''
+    HTTP ingestion of HLODeploymentEngineInput, POST /hlo_de/allocations
+'''
+import pytest
+from app import app, loop
+from app.app_models.py_files import deployment_engine_pb2 as deployment_engine
+from app.localAllocationManager import routers
+from app.runtime.report import DeploymentReport
+import app.app_models.aeriOS_continuum as aeriOS_c
+
+testclient = pytest.importorskip("fastapi.testclient")
+
+SERVICE_ID = "urn:ngsi-ld:Service:1"
+RUNNING_ID = "urn:ngsi-ld:Service:1:Component:1"
+FAILED_ID = "urn:ngsi-ld:Service:1:Component:2"
+
+
+def _input_bytes(*scomponent_ids) -> bytes:
+    input_protbuf_msg = deployment_engine.HLODeploymentEngineInput()
+    for scomponent_id in scomponent_ids:
+        component = input_protbuf_msg.service_component_allocations.add(
+        ).new_allocated_service_component
+        component.id = scomponent_id
+        component.service.id = SERVICE_ID
+    return input_protbuf_msg.SerializeToString()
+
+
+@pytest.fixture(name="client")
+def fixture_client(monkeypatch):
+    flushed = []
+    monkeypatch.setattr(routers.manager_utils,
+                        "flush_service_component_updates",
+                        lambda scomponent_ids=None: flushed.append(
+                            list(scomponent_ids)) or True)
+    client = testclient.TestClient(app)
+    client.flushed = flushed
+    return client
+
+
+def _post(client, body: bytes, **params):
+    return client.post("/hlo_de/allocations",
+                       content=body,
+                       params=params,
+                       headers={"Content-Type": "application/x-protobuf"})
+
+
+def test_wait_returns_component_outcome(client, monkeypatch):
+
+    def process_message(input_protbuf_msg, msgs=None):
+        assert msgs is None
+        report = DeploymentReport(SERVICE_ID)
+        report.action_type = aeriOS_c.ServiceActionTypeEnum.DEPLOYING
+        report.component(RUNNING_ID)
+        report.component(FAILED_ID)
+        report.record_call("request_allocate_scompenent",
+                           {"service_component_id": RUNNING_ID}, 201, None, 0.1)
+        # What a request failing in catch_requests_exceptions returns
+        report.record_call("request_allocate_scompenent",
+                           {"service_component_id": FAILED_ID}, None, None, 0.1)
+        return report
+
+    monkeypatch.setattr(loop, "process_message", process_message)
+    response = _post(client, _input_bytes(RUNNING_ID, FAILED_ID), wait="true")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "failed"
+    assert body["service_id"] == SERVICE_ID
+    components = {
+        component["id"]: component
+        for component in body["service_components"]
+    }
+    assert components[RUNNING_ID]["status"] == \
+        aeriOS_c.ServiceComponentStatusEnum.RUNNING
+    assert components[RUNNING_ID]["errors"] == []
+    assert components[FAILED_ID]["status"] == \
+        aeriOS_c.ServiceComponentStatusEnum.FAILED
+    assert components[FAILED_ID]["errors"] == ["allocate: request failed"]
+    # Written behind statuses are flushed before answering
+    assert client.flushed == [[RUNNING_ID, FAILED_ID]]
+
+
+def test_wait_completed(client, monkeypatch):
+
+    def process_message(input_protbuf_msg, msgs=None):
+        report = DeploymentReport(SERVICE_ID)
+        report.record_call("request_allocate_scompenent",
+                           {"service_component_id": RUNNING_ID}, 201, None, 0.1)
+        return report
+
+    monkeypatch.setattr(loop, "process_message", process_message)
+    response = _post(client, _input_bytes(RUNNING_ID), wait="true")
+    assert response.status_code == 200
+    assert response.json()["status"] == "completed"
+
+
+def test_wait_processing_error(client, monkeypatch):
+
+    def process_message(input_protbuf_msg, msgs=None):
+        raise RuntimeError("CB unreachable")
+
+    monkeypatch.setattr(loop, "process_message", process_message)
+    response = _post(client, _input_bytes(RUNNING_ID), wait="true")
+    assert response.status_code == 500
+    assert response.json()["status"] == "failed"
+    assert client.flushed == []
+
+
+def test_accepted_without_wait(client, monkeypatch):
+    monkeypatch.setattr(loop, "process_message",
+                        lambda input_protbuf_msg, msgs=None: None)
+    response = _post(client, _input_bytes(RUNNING_ID))
+    assert response.status_code == 202
+    assert response.json() == {"status": "accepted", "service_id": SERVICE_ID}
+
+
+def test_rejects_other_content_types(client):
+    response = client.post("/hlo_de/allocations",
+                           content=b"{}",
+                           headers={"Content-Type": "application/json"})
+    assert response.status_code == 415
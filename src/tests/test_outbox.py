@@ -0,0 +1,361 @@
+'''
+    Resuming an interrupted input from the outbox
+'''
+import pytest
+from app import loop
+from app.app_models.py_files import deployment_engine_pb2 as deployment_engine
+from app.runtime.outbox import Outbox, delivery_key
+from app.runtime.report import DeploymentReport
+from app.runtime import retry
+from app.utils import continuum_utils
+from app.api_clients import k8s_shim_client
+import app.app_models.aeriOS_continuum as aeriOS_c
+from tests.test_retry import FakeMessage
+
+SERVICE_ID = "urn:ngsi-ld:Service:1"
+COMPONENT_IDS = [f"{SERVICE_ID}:Component:{n}" for n in range(1, 4)]
+SUBNET = "10.10.1.0/24"
+
+DEPLOYING = aeriOS_c.ServiceActionTypeEnum.DEPLOYING
+DESTROYING = aeriOS_c.ServiceActionTypeEnum.DESTROYING
+
+
+class Crash(Exception):
+    '''
+        The process dying in the middle of the dispatch
+    '''
+
+
+class FakeHLOALClient:
+    '''
+        HLOALClient stand-in recording every remote call
+    '''
+
+    sent = []
+
+    def __init__(self, api_url):
+        self.api_url = api_url
+
+    def request_allocate_scompenent(self, scomponent_allocation,
+                                    overlay_conf=None, service_id=""):
+        FakeHLOALClient.sent.append(
+            (self.api_url, "allocate", scomponent_allocation.id,
+             overlay_conf.model_dump() if overlay_conf else None))
+        return 201
+
+    def request_deallocate_scompenent(self, service_component_id, service_id):
+        FakeHLOALClient.sent.append(
+            (self.api_url, "deallocate", service_component_id, None))
+        return 200
+
+    def request_destroy_service_overlay(self, service_id):
+        FakeHLOALClient.sent.append(
+            (self.api_url, "destroy_overlay", service_id, None))
+        return 200
+
+
+class CrashingDispatcher:
+    '''
+        Dispatcher running the first calls inline, the process dies on the next submit
+    '''
+
+    def __init__(self, calls_before_crash: int):
+        self.calls_before_crash = calls_before_crash
+
+    def submit(self, instance, method_name, params, on_done=None):
+        if not self.calls_before_crash:
+            raise Crash()
+        self.calls_before_crash -= 1
+        getattr(instance, method_name)(**params)
+        if on_done is not None:
+            on_done()
+
+
+class Continuum:
+    '''
+        Stubbed continuum_utils and k8s_shim_client, with the state CB reports
+    '''
+
+    def __init__(self):
+        self.action_type = DEPLOYING
+        self.scomponent_status = aeriOS_c.ServiceComponentStatusEnum.STARTING
+        self.handled = []
+        self.subnets = 0
+        self.keys = 0
+        self.wg_servers = []
+        self.failed = []
+
+    def get_service_action_type(self, service_id):
+        return self.action_type, True
+
+    def service_handled(self, entity_id, action_type):
+        self.handled.append(action_type)
+
+    def get_service_components_status(self, scomponent_ids):
+        return {
+            scomponent_id: self.scomponent_status
+            for scomponent_id in scomponent_ids
+        }
+
+    @staticmethod
+    def get_domain_urls(ie_ids):
+        return {
+            ie_id: (f"https://{ie_id.split(':')[-1]}.example.org",
+                    f"pk-{ie_id}")
+            for ie_id in ie_ids
+        }
+
+    @staticmethod
+    def get_host_domain():
+        return "https://host.example.org", "host-pk"
+
+    @staticmethod
+    def get_service_handler_domain_url(service_id):
+        return "https://host.example.org"
+
+    def set_service_components_status(self, scomponent_ids, scomponent_status):
+        self.failed.extend(scomponent_ids)
+
+    def allocate_subnet(self, service_id):
+        self.subnets += 1
+        return SUBNET
+
+    def generate_wireguard_keys(self):
+        self.keys += 1
+        return f"private-{self.keys}", f"public-{self.keys}"
+
+    def setup_wireguard_server(self, service_id, wg_clients):
+        self.wg_servers.append(wg_clients)
+
+
+@pytest.fixture(name="continuum")
+def fixture_continuum(monkeypatch):
+    continuum = Continuum()
+    for name in ("get_service_action_type", "service_handled",
+                 "get_service_components_status", "get_domain_urls",
+                 "get_host_domain", "get_service_handler_domain_url",
+                 "set_service_components_status"):
+        monkeypatch.setattr(continuum_utils, name, getattr(continuum, name))
+    monkeypatch.setattr(k8s_shim_client, "allocate_subnet",
+                        continuum.allocate_subnet)
+    monkeypatch.setattr(k8s_shim_client, "setup_wireguard_server",
+                        continuum.setup_wireguard_server)
+    monkeypatch.setattr(loop.tools, "generate_wireguard_keys",
+                        continuum.generate_wireguard_keys)
+    monkeypatch.setattr(loop, "HLOALClient", FakeHLOALClient)
+    monkeypatch.setattr(loop, "RESULT_TOPIC", "")
+    monkeypatch.setattr(loop, "MESSAGE_DEADLINE", 0)
+    FakeHLOALClient.sent = []
+    return continuum
+
+
+@pytest.fixture(name="outbox")
+def fixture_outbox(monkeypatch):
+    outbox = Outbox()
+    monkeypatch.setattr(loop, "_outbox", outbox)
+    yield outbox
+    outbox.close()
+
+
+def _input():
+    input_protbuf_msg = deployment_engine.HLODeploymentEngineInput()
+    for n, scomponent_id in enumerate(COMPONENT_IDS):
+        component = input_protbuf_msg.service_component_allocations.add(
+        ).new_allocated_service_component
+        component.id = scomponent_id
+        component.service.id = SERVICE_ID
+        component.image = "nginx"
+        component.infrastructure_element.id = \
+            f"urn:ngsi-ld:InfrastructureElement:domain{n % 2}"
+        component.infrastructure_element.domain.id = f"urn:ngsi-ld:Domain:{n % 2}"
+        component.infrastructure_element.container_technology = "Kubernetes"
+    return input_protbuf_msg
+
+
+def _msgs(input_protbuf_msg):
+    return [
+        FakeMessage("allocator2deployment", 0, 42,
+                    input_protbuf_msg.SerializeToString())
+    ]
+
+
+def _first_attempt(outbox, input_protbuf_msg, msgs, dispatcher):
+    entry = outbox.open(msgs)
+    loop.dispatch_remote_allocations(input_protbuf_msg, dispatcher,
+                                     DeploymentReport(SERVICE_ID), entry)
+    return entry
+
+
+def _allocations():
+    return {
+        scomponent_id: overlay_conf
+        for _, method, scomponent_id, overlay_conf in FakeHLOALClient.sent
+        if method == "allocate"
+    }
+
+
+def test_crash_mid_dispatch_resumes_remaining_calls(continuum, outbox):
+    input_protbuf_msg = _input()
+    msgs = _msgs(input_protbuf_msg)
+    with pytest.raises(Crash):
+        # Component 1 is allocated, component 2 planned, the process dies submitting it
+        _first_attempt(outbox, input_protbuf_msg, msgs, CrashingDispatcher(1))
+    first_attempt = list(FakeHLOALClient.sent)
+    assert [call[2] for call in first_attempt] == [COMPONENT_IDS[0]]
+    planned = outbox.open(msgs).unfinished()
+    assert [(method, params["scomponent_allocation"].id)
+            for _, _, method, params in planned
+            ] == [("request_allocate_scompenent", COMPONENT_IDS[1])]
+    assert continuum.wg_servers == []
+
+    FakeHLOALClient.sent = []
+    report = loop.process_message(input_protbuf_msg, msgs)
+
+    # Only the calls left are sent: the one planned before the crash, then component 3
+    assert [call[2] for call in FakeHLOALClient.sent] == COMPONENT_IDS[1:]
+    allocations = _allocations()
+    # Replayed with the keys and IP it was planned with
+    assert allocations[COMPONENT_IDS[1]] == \
+        planned[0][3]["overlay_conf"].model_dump()
+    assert allocations[COMPONENT_IDS[1]]["PrivateKey"] == "private-2"
+    assert allocations[COMPONENT_IDS[1]]["Address"] == "10.10.1.3"
+    # The new component continues after the peers planned before the crash
+    assert allocations[COMPONENT_IDS[2]]["PrivateKey"] == "private-3"
+    assert allocations[COMPONENT_IDS[2]]["Address"] == "10.10.1.4"
+    assert continuum.keys == 3
+
+    # One subnet, one handled update, one wireguard server with every peer
+    assert continuum.subnets == 1
+    assert continuum.handled == [DEPLOYING]
+    assert len(continuum.wg_servers) == 1
+    assert [(peer["peer_public_key"], peer["peer_overlay_ip"])
+            for peer in continuum.wg_servers[0]] == [
+                ("public-1", "10.10.1.2"), ("public-2", "10.10.1.3"),
+                ("public-3", "10.10.1.4"),
+                ("we_do_not_care_about_this", "10.10.1.1")
+            ]
+    assert not report.failed()
+    # Fully processed, nothing left to resume
+    assert not outbox.open(msgs).resumed
+
+
+def test_crash_after_wireguard_server_replays_calls_only(continuum, outbox):
+    input_protbuf_msg = _input()
+    msgs = _msgs(input_protbuf_msg)
+
+    class NotRunningDispatcher:
+        '''
+            Calls are submitted, the process dies before any completes
+        '''
+
+        def submit(self, instance, method_name, params, on_done=None):
+            pass
+
+    entry = _first_attempt(outbox, input_protbuf_msg, msgs,
+                           NotRunningDispatcher())
+    assert entry.state["wg_server_done"]
+    assert len(continuum.wg_servers) == 1
+    assert len(entry.unfinished()) == 3
+
+    loop.process_message(input_protbuf_msg, msgs)
+    assert sorted(call[2] for call in FakeHLOALClient.sent) == COMPONENT_IDS
+    assert [conf["PrivateKey"] for conf in _allocations().values()
+            ] == ["private-1", "private-2", "private-3"]
+    assert continuum.keys == 3
+    assert continuum.subnets == 1
+    assert len(continuum.wg_servers) == 1
+    assert continuum.handled == [DEPLOYING]
+
+
+def test_resumes_when_cb_reports_the_action_handled(continuum, outbox):
+    input_protbuf_msg = _input()
+    msgs = _msgs(input_protbuf_msg)
+    with pytest.raises(Crash):
+        _first_attempt(outbox, input_protbuf_msg, msgs, CrashingDispatcher(1))
+    # The first attempt marked the service DEPLOYED before it died
+    continuum.action_type = aeriOS_c.ServiceActionTypeEnum.DEPLOYED
+    FakeHLOALClient.sent = []
+    loop.process_message(input_protbuf_msg, msgs)
+    assert [call[2] for call in FakeHLOALClient.sent] == COMPONENT_IDS[1:]
+    assert continuum.subnets == 1
+
+
+def test_action_type_mismatch_starts_over(continuum, outbox):
+    input_protbuf_msg = _input()
+    msgs = _msgs(input_protbuf_msg)
+    with pytest.raises(Crash):
+        _first_attempt(outbox, input_protbuf_msg, msgs, CrashingDispatcher(1))
+    # Meanwhile the service is being destroyed, the planned allocations are stale
+    continuum.action_type = DESTROYING
+    continuum.scomponent_status = aeriOS_c.ServiceComponentStatusEnum.REMOVING
+    FakeHLOALClient.sent = []
+    loop.process_message(input_protbuf_msg, msgs)
+    assert not _allocations()
+    assert sorted((method, target)
+                  for _, method, target, _ in FakeHLOALClient.sent) == [
+                      ("deallocate", scomponent_id)
+                      for scomponent_id in COMPONENT_IDS
+                  ] + [("destroy_overlay", SERVICE_ID)]
+    assert continuum.handled == [DEPLOYING, DESTROYING]
+    assert continuum.wg_servers == []
+
+
+def test_failed_attempt_resumes_where_it_failed(continuum, outbox,
+                                                monkeypatch):
+    input_protbuf_msg = _input()
+    msgs = _msgs(input_protbuf_msg)
+    setup_wireguard_server = continuum.setup_wireguard_server
+    monkeypatch.setattr(k8s_shim_client, "setup_wireguard_server",
+                        lambda service_id, wg_clients: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        loop.process_message(input_protbuf_msg, msgs)
+    assert len(FakeHLOALClient.sent) == 3
+    entry = outbox.open(msgs)
+    assert entry.resumed
+    assert not entry.state.get("wg_server_done")
+
+    # Redelivered: the allocations are done, only the wireguard server is left
+    monkeypatch.setattr(k8s_shim_client, "setup_wireguard_server",
+                        setup_wireguard_server)
+    FakeHLOALClient.sent = []
+    loop.process_message(input_protbuf_msg, msgs)
+    assert FakeHLOALClient.sent == []
+    assert len(continuum.wg_servers) == 1
+    assert [peer["peer_public_key"] for peer in continuum.wg_servers[0]
+            ][:3] == ["public-1", "public-2", "public-3"]
+    assert continuum.subnets == 1
+
+
+def test_failed_http_input_is_not_kept(continuum, outbox, monkeypatch):
+    monkeypatch.setattr(k8s_shim_client, "setup_wireguard_server",
+                        lambda service_id, wg_clients: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        loop.process_message(_input())
+    # Nothing redelivers an input posted over HTTP, its entry is dropped
+    assert outbox._db.execute(
+        "SELECT COUNT(*) FROM outbox_inputs").fetchone() == (0, )
+
+
+def test_abandon_on_dead_letter(outbox):
+    msg = FakeMessage("allocator2deployment", 0, 42, b"input")
+    other = FakeMessage("allocator2deployment", 0, 43, b"other")
+    entry = outbox.open([msg])
+    entry.plan([("https://a.example.org", "request_destroy_service_overlay", {
+        "service_id": SERVICE_ID
+    })], planned=[])
+    coalesced = outbox.open([msg, other])
+    coalesced.update(planned=[])
+    kept = outbox.open([other])
+    kept.update(planned=[])
+    # The last retry of msg, dead lettered
+    retried = FakeMessage(
+        "allocator2deployment-retry", 0, 7, b"input",
+        headers=[(retry.HEADER_ORIGINAL_TOPIC, b"allocator2deployment"),
+                 (retry.HEADER_ORIGINAL_PARTITION, b"0"),
+                 (retry.HEADER_ORIGINAL_OFFSET, b"42")])
+    assert delivery_key(retried) == delivery_key(msg)
+    outbox.abandon(retried)
+    assert not outbox.open([msg]).resumed
+    assert outbox.unfinished(entry.key) == []
+    assert not outbox.open([msg, other]).resumed
+    assert outbox.open([other]).resumed
@@ -0,0 +1,388 @@
+'''
+    Retry and dead letter routing against an in-process fake broker
+'''
+import pytest
+from app import loop
+from app.app_models.py_files import deployment_engine_pb2 as deployment_engine
+from app.runtime import retry
+from app.runtime.retry import RetryRouter, get_header
+
+MAIN_TOPIC = "allocator2deployment"
+RETRY_TOPIC = "allocator2deployment-retry"
+DLQ_TOPIC = "allocator2deployment-dlq"
+
+
+class FakeMessage:
+    '''
+        confluent_kafka Message stand-in
+    '''
+
+    def __init__(self, topic, partition, offset, value, key=None, headers=None):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._value = value
+        self._key = key
+        self._headers = headers
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+    def key(self):
+        return self._key
+
+    def headers(self):
+        return self._headers
+
+    def error(self):
+        return None
+
+
+class FakeBroker:
+    '''
+        Topics of a single partition each, as lists of messages
+    '''
+
+    def __init__(self):
+        self.topics = {}
+
+    def append(self, topic, value, key=None, headers=None) -> FakeMessage:
+        log = self.topics.setdefault(topic, [])
+        msg = FakeMessage(topic, 0, len(log), value, key, headers)
+        log.append(msg)
+        return msg
+
+
+class FakeProducer:
+    '''
+        Producer whose messages reach the broker on the next poll(),
+          or are held back while delivering is False
+    '''
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.delivering = True
+        self._undelivered = []
+
+    def produce(self, topic, value=None, key=None, headers=None,
+                on_delivery=None):
+        self._undelivered.append((topic, value, key, headers, on_delivery))
+
+    def poll(self, _timeout=None):
+        if not self.delivering:
+            return 0
+        undelivered, self._undelivered = self._undelivered, []
+        for topic, value, key, headers, on_delivery in undelivered:
+            msg = self.broker.append(
+                topic, value, key,
+                [(name, header.encode()) for name, header in headers.items()])
+            if on_delivery:
+                on_delivery(None, msg)
+        return len(undelivered)
+
+    def flush(self, _timeout=None):
+        self.poll()
+
+
+class FakeConsumer:
+    '''
+        Consumer of every subscribed topic of the broker, with pause/resume/seek
+    '''
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.topics = []
+        self.positions = {}
+        self.paused = set()
+        self.commits = []
+
+    def subscribe(self, topics, on_revoke=None):
+        self.topics = topics
+
+    def consume(self, num_messages=1, timeout=None):
+        msgs = []
+        for topic in self.topics:
+            if (topic, 0) in self.paused:
+                continue
+            log = self.broker.topics.get(topic, [])
+            position = self.positions.get((topic, 0), 0)
+            while position < len(log) and len(msgs) < num_messages:
+                msgs.append(log[position])
+                position += 1
+            self.positions[(topic, 0)] = position
+        return msgs
+
+    def pause(self, partitions):
+        self.paused.update((p.topic, p.partition) for p in partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update((p.topic, p.partition) for p in partitions)
+
+    def seek(self, partition):
+        self.positions[(partition.topic, partition.partition)] = partition.offset
+
+    def commit(self, offsets=None, asynchronous=True):
+        self.commits.append({(o.topic, o.partition): o.offset for o in offsets})
+
+    def assignment(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeClock:
+    '''
+        Clock moved by hand
+    '''
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(name="broker")
+def fixture_broker():
+    return FakeBroker()
+
+
+@pytest.fixture(name="router")
+def fixture_router(broker):
+    return RetryRouter(FakeProducer(broker),
+                       retry_topic=RETRY_TOPIC,
+                       dlq_topic=DLQ_TOPIC,
+                       max_attempts=3,
+                       backoff_base=5.0,
+                       backoff_max=15.0,
+                       clock=FakeClock())
+
+
+def test_backoff_is_exponential_and_capped(router):
+    assert [router.backoff(attempt) for attempt in range(1, 5)] == \
+        [5.0, 10.0, 15.0, 15.0]
+
+
+def test_retry_headers(router, broker):
+    original = broker.append(MAIN_TOPIC, b"input", key=b"service-1")
+    assert router.publish_failure(original, RuntimeError("LLO down"))
+    router.poll()
+    first = broker.topics[RETRY_TOPIC][0]
+    assert first.value() == b"input"
+    assert first.key() == b"service-1"
+    assert get_header(first, retry.HEADER_ATTEMPT) == "1"
+    assert float(get_header(first, retry.HEADER_NOT_BEFORE)) == 1005.0
+    assert get_header(first, retry.HEADER_ORIGINAL_TOPIC) == MAIN_TOPIC
+    assert get_header(first, retry.HEADER_ORIGINAL_PARTITION) == "0"
+    assert get_header(first, retry.HEADER_ORIGINAL_OFFSET) == "0"
+    assert "LLO down" in get_header(first, retry.HEADER_ERROR)
+
+    # A failed retry keeps pointing at the original delivery
+    router.clock.now = 1010.0
+    assert router.publish_failure(first, RuntimeError("LLO down"))
+    router.poll()
+    second = broker.topics[RETRY_TOPIC][1]
+    assert get_header(second, retry.HEADER_ATTEMPT) == "2"
+    assert float(get_header(second, retry.HEADER_NOT_BEFORE)) == 1020.0
+    assert get_header(second, retry.HEADER_ORIGINAL_TOPIC) == MAIN_TOPIC
+    assert get_header(second, retry.HEADER_ORIGINAL_OFFSET) == "0"
+    assert router.retried == 2
+
+
+def test_dead_letter_after_max_attempts(router, broker):
+    msg = broker.append(MAIN_TOPIC, b"input")
+    for _ in range(3):
+        assert router.publish_failure(msg, RuntimeError("LLO down"))
+        router.poll()
+        msg = broker.topics[RETRY_TOPIC][-1]
+    published = []
+    assert not router.publish_failure(
+        msg, RuntimeError("LLO down"), on_published=lambda: published.append(1))
+    router.poll()
+    assert len(broker.topics[RETRY_TOPIC]) == 3
+    dead = broker.topics[DLQ_TOPIC][0]
+    assert get_header(dead, retry.HEADER_ATTEMPT) == "4"
+    assert get_header(dead, retry.HEADER_NOT_BEFORE) is None
+    assert published == [1]
+    assert router.dead_lettered == 1
+
+
+def test_non_retriable_goes_straight_to_dlq(router, broker):
+    msg = broker.append(MAIN_TOPIC, b"garbage")
+    assert not router.publish_failure(msg, ValueError("bad"), retriable=False)
+    router.poll()
+    assert RETRY_TOPIC not in broker.topics
+    assert get_header(broker.topics[DLQ_TOPIC][0], retry.HEADER_ATTEMPT) == "1"
+
+
+def test_dropped_without_dlq(broker):
+    published = []
+    router = RetryRouter(FakeProducer(broker), retry_topic=RETRY_TOPIC,
+                         max_attempts=0)
+    msg = broker.append(MAIN_TOPIC, b"input")
+    assert not router.publish_failure(msg,
+                                      RuntimeError("LLO down"),
+                                      on_published=lambda: published.append(1))
+    assert published == [1]
+    assert broker.topics.keys() == {MAIN_TOPIC}
+
+
+def test_pause_seek_resume_cycle(router, broker):
+    consumer = FakeConsumer(broker)
+    consumer.subscribe([RETRY_TOPIC])
+    router.publish_failure(broker.append(MAIN_TOPIC, b"input"),
+                           RuntimeError("LLO down"))
+    router.poll()
+    msg, = consumer.consume()
+    # Not due before 1005
+    assert router.defer_if_not_due(consumer, msg)
+    assert router.is_deferred(RETRY_TOPIC, 0)
+    assert (RETRY_TOPIC, 0) in consumer.paused
+    assert consumer.positions[(RETRY_TOPIC, 0)] == 0
+    assert consumer.consume() == []
+    router.clock.now = 1004.0
+    router.resume_due(consumer)
+    assert router.is_deferred(RETRY_TOPIC, 0)
+    router.clock.now = 1005.0
+    router.resume_due(consumer)
+    assert not router.is_deferred(RETRY_TOPIC, 0)
+    assert consumer.consume() == [msg]
+    assert not router.defer_if_not_due(consumer, msg)
+    # Messages of other topics are never deferred
+    assert not router.defer_if_not_due(consumer,
+                                       broker.topics[MAIN_TOPIC][0])
+
+
+def _input_bytes(service_id: str) -> bytes:
+    input_protbuf_msg = deployment_engine.HLODeploymentEngineInput()
+    component = input_protbuf_msg.service_component_allocations.add(
+    ).new_allocated_service_component
+    component.id = f"{service_id}:Component:1"
+    component.service.id = service_id
+    return input_protbuf_msg.SerializeToString()
+
+
+@pytest.fixture(name="engine")
+def fixture_engine(broker, monkeypatch):
+    '''
+    DeploymentEngineConsumer polling inline, with retry and DLQ topics and
+      a process_message failing the inputs of services listed in failing
+    '''
+    monkeypatch.setattr(loop, "CONSUMER_TOPIC", MAIN_TOPIC)
+    monkeypatch.setattr(loop, "RETRY_TOPIC", RETRY_TOPIC)
+    monkeypatch.setattr(loop, "DLQ_TOPIC", DLQ_TOPIC)
+    monkeypatch.setattr(loop, "RETRY_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(loop, "RETRY_BACKOFF_BASE", 5.0)
+    monkeypatch.setattr(loop, "LOOP_WORKERS", 1)
+    monkeypatch.setattr(loop, "LOOP_BATCH_SIZE", 1)
+    monkeypatch.setattr(loop, "SCHEDULER_WINDOW", 0)
+    monkeypatch.setattr(loop, "INTAKE_QUEUE_SIZE", 0)
+    monkeypatch.setattr(loop, "DEDUP_MAX_ENTRIES", 0)
+    monkeypatch.setattr(loop, "RESULT_TOPIC", "")
+    monkeypatch.setattr(loop, "COMMIT_EVERY", 1000)
+    monkeypatch.setattr(loop, "COMMIT_INTERVAL", 1000.0)
+    failing = set()
+    processed = []
+
+    def process_message(input_protbuf_msg, msgs=None):
+        service_id = loop.get_orchestrated_service_id(input_protbuf_msg)
+        processed.append((service_id, msgs[0].topic()))
+        if service_id in failing:
+            raise RuntimeError(f"{service_id} failed")
+
+    monkeypatch.setattr(loop, "process_message", process_message)
+    abandoned = []
+    monkeypatch.setattr(loop.get_outbox(), "abandon", abandoned.append)
+    engine = loop.DeploymentEngineConsumer(consumer=FakeConsumer(broker),
+                                           producer=FakeProducer(broker))
+    engine.retry_router.clock = FakeClock()
+    engine.failing = failing
+    engine.processed = processed
+    engine.abandoned = abandoned
+    return engine
+
+
+def _steps(engine, count):
+    for _ in range(count):
+        engine.step()
+
+
+def test_failed_message_does_not_block_partition(engine, broker):
+    engine.failing.add("urn:ngsi-ld:Service:1")
+    producer = engine.retry_router.producer
+    producer.delivering = False
+    for n in range(1, 4):
+        broker.append(MAIN_TOPIC, _input_bytes(f"urn:ngsi-ld:Service:{n}"))
+    _steps(engine, 3)
+    assert [service for service, _ in engine.processed] == [
+        "urn:ngsi-ld:Service:1", "urn:ngsi-ld:Service:2",
+        "urn:ngsi-ld:Service:3"
+    ]
+    # Offsets 1 and 2 are done, 0 waits for its republish to be delivered
+    engine.offset_tracker.commit()
+    assert engine.consumer.commits == []
+    producer.delivering = True
+    engine.retry_router.poll()
+    engine.offset_tracker.commit()
+    assert engine.consumer.commits == [{(MAIN_TOPIC, 0): 3}]
+    assert len(broker.topics[RETRY_TOPIC]) == 1
+
+
+def test_retry_is_processed_once_due(engine, broker):
+    engine.failing.add("urn:ngsi-ld:Service:1")
+    broker.append(MAIN_TOPIC, _input_bytes("urn:ngsi-ld:Service:1"))
+    _steps(engine, 3)
+    # Processed once, the retry is not due before its backoff
+    assert engine.processed == [("urn:ngsi-ld:Service:1", MAIN_TOPIC)]
+    assert engine.retry_router.is_deferred(RETRY_TOPIC, 0)
+    engine.failing.clear()
+    engine.retry_router.clock.now += 5.0
+    _steps(engine, 2)
+    assert engine.processed[-1] == ("urn:ngsi-ld:Service:1", RETRY_TOPIC)
+    assert not engine.retry_router.is_deferred(RETRY_TOPIC, 0)
+    engine.offset_tracker.commit()
+    assert engine.consumer.commits[-1] == {
+        (MAIN_TOPIC, 0): 1,
+        (RETRY_TOPIC, 0): 1
+    }
+    assert DLQ_TOPIC not in broker.topics
+
+
+def test_dead_letter_after_retries(engine, broker):
+    engine.failing.add("urn:ngsi-ld:Service:1")
+    broker.append(MAIN_TOPIC, _input_bytes("urn:ngsi-ld:Service:1"))
+    for _ in range(3):
+        _steps(engine, 2)
+        engine.retry_router.clock.now += 60.0
+    _steps(engine, 2)
+    # Attempted once plus RETRY_MAX_ATTEMPTS retries, then dead lettered
+    assert len(engine.processed) == 3
+    assert len(broker.topics[RETRY_TOPIC]) == 2
+    dead, = broker.topics[DLQ_TOPIC]
+    assert get_header(dead, retry.HEADER_ORIGINAL_TOPIC) == MAIN_TOPIC
+    assert get_header(dead, retry.HEADER_ATTEMPT) == "3"
+    # Nothing will resume the outbox entry of a dead lettered message
+    assert engine.abandoned == [broker.topics[RETRY_TOPIC][1]]
+
+
+def test_undecodable_message_goes_to_dlq(engine, broker):
+    broker.append(MAIN_TOPIC, b"\xff\xff\xff")
+    broker.append(MAIN_TOPIC, _input_bytes("urn:ngsi-ld:Service:2"))
+    _steps(engine, 3)
+    assert RETRY_TOPIC not in broker.topics
+    dead, = broker.topics[DLQ_TOPIC]
+    assert dead.value() == b"\xff\xff\xff"
+    assert get_header(dead, retry.HEADER_ATTEMPT) == "1"
+    assert engine.processed == [("urn:ngsi-ld:Service:2", MAIN_TOPIC)]
+    engine.offset_tracker.commit()
+    assert engine.consumer.commits == [{(MAIN_TOPIC, 0): 2}]
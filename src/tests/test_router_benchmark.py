@@ -0,0 +1,133 @@
+'''
+    Benchmark of the hlo_al DELETE handler under a slow LLO stand-in:
+      the blocking LLO client called on the event loop, as the handlers did before,
+      against the awaitable client run on the I/O thread pool.
+    Run with -s to see the timings.
+'''
+import asyncio
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from app import app
+from app.api_clients.llo_api_client import LLORESTClient
+from app.localAllocationManager import routers
+import app.config as config
+
+httpx = pytest.importorskip("httpx")
+
+# Seconds the fake LLO takes to answer, concurrent DELETE requests
+LLO_DELAY = 0.1
+CONCURRENCY = 20
+
+
+class SlowLLOHandler(BaseHTTPRequestHandler):
+    '''
+        LLO REST API stand-in answering every DELETE after LLO_DELAY seconds
+    '''
+
+    protocol_version = "HTTP/1.1"
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        time.sleep(LLO_DELAY)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class SlowLLOServer(ThreadingHTTPServer):
+    '''
+        Listen backlog large enough for every concurrent connection,
+          the default of 5 makes the others retry their SYN a second later
+    '''
+
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class BlockingLLORESTClient:
+    '''
+        LLORESTClient awaited the way the handlers used to call it,
+          the request runs on the event loop
+    '''
+
+    def __init__(self):
+        self._client = LLORESTClient()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+
+        async def call(*args, **kwargs):
+            return attr(*args, **kwargs)
+
+        return call
+
+
+@pytest.fixture(name="slow_llo")
+def fixture_slow_llo(monkeypatch):
+    server = SlowLLOServer(("127.0.0.1", 0), SlowLLOHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(config, "LLO_REST_URL", "http://127.0.0.1")
+    monkeypatch.setattr(config, "LLO_REST_PORT", str(server.server_port))
+    # CB is out of the picture, only the LLO is slow
+    monkeypatch.setattr(routers.manager_utils,
+                        "check_service_component_exists",
+                        lambda **kwargs: True)
+    monkeypatch.setattr(routers.manager_utils, "get_scompnent_hosting_ie",
+                        lambda **kwargs: "urn:ngsi-ld:InfrastructureElement:1")
+    monkeypatch.setattr(routers.manager_utils, "get_ie_llo_type",
+                        lambda ie_id: "K8s")
+    monkeypatch.setattr(routers.manager_utils,
+                        "queue_service_component_updates", lambda updates: None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+async def _delete_concurrently(concurrency: int) -> tuple:
+    '''
+    Fire concurrent DELETEs at the app
+    :return wall time and latency of every request
+    '''
+
+    async def delete(client, n):
+        started = time.perf_counter()
+        response = await client.delete(
+            f"/hlo_al/services/urn:ngsi-ld:Service:{n}"
+            f"/service_components/urn:ngsi-ld:Service:{n}:Component:1")
+        assert response.status_code == 200
+        return time.perf_counter() - started
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://test") as client:
+        started = time.perf_counter()
+        latencies = await asyncio.gather(
+            *(delete(client, n) for n in range(concurrency)))
+        return time.perf_counter() - started, latencies
+
+
+def _report(name: str, elapsed: float, latencies: list):
+    print(f"\n{name}: {len(latencies)} DELETEs in {elapsed:.2f}s, "
+          f"p50 {statistics.median(latencies):.2f}s, "
+          f"max {max(latencies):.2f}s")
+
+
+def test_blocking_client_serializes_requests(slow_llo, monkeypatch):
+    monkeypatch.setattr(routers, "AsyncLLORESTClient", BlockingLLORESTClient)
+    elapsed, latencies = asyncio.run(_delete_concurrently(CONCURRENCY))
+    _report("blocking LLO client", elapsed, latencies)
+    # Head-of-line blocking: every request waits for the ones before it
+    assert elapsed >= CONCURRENCY * LLO_DELAY * 0.9
+
+
+def test_async_client_serves_requests_concurrently(slow_llo):
+    elapsed, latencies = asyncio.run(_delete_concurrently(CONCURRENCY))
+    _report("awaitable LLO client", elapsed, latencies)
+    assert elapsed < CONCURRENCY * LLO_DELAY / 4
+    assert max(latencies) < CONCURRENCY * LLO_DELAY / 4
@@ -0,0 +1,95 @@
+'''
+    Context broker GETs shared by concurrent callers with different budgets
+'''
+import threading
+import time
+import pytest
+from app.api_clients import cb_client
+from app.utils import deadline
+from app.utils.decorators import catch_requests_exceptions
+from app.utils.singleflight import SingleFlight
+
+URL = "http://cb/ngsi-ld/v1/entities/urn:ngsi-ld:Domain:1"
+
+
+class SlowCBClient(cb_client.CBClient):
+    '''
+        CBClient whose GETs take delay seconds, recording the timeouts they are sent with
+    '''
+
+    def __init__(self, delay: float):  # pylint: disable=super-init-not-called
+        self.delay = delay
+        self.timeouts = []
+
+    def _send(self, method: str, url: str, **kwargs):
+        self.timeouts.append(kwargs["timeout"])
+        time.sleep(self.delay)
+        if self.delay >= kwargs["timeout"]:
+            raise deadline.DeadlineExceeded("Read timed out")
+        return 200
+
+    @catch_requests_exceptions
+    def get(self):
+        return self._request("GET", URL, timeout=deadline.timeout(15))
+
+
+@pytest.fixture(name="flight")
+def fixture_flight(monkeypatch):
+    flight = SingleFlight()
+    monkeypatch.setattr(cb_client, "_get_flight", flight)
+    monkeypatch.setattr(cb_client.config, "CB_SINGLEFLIGHT", True)
+    return flight
+
+
+def test_joiner_without_deadline_outlives_leader_budget(flight):
+    client = SlowCBClient(delay=0.3)
+    results = {}
+
+    def leader():
+        with deadline.deadline_scope(0.1):
+            results["leader"] = client.get()
+
+    def joiner():
+        results["joiner"] = client.get()
+
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    while not flight.stats()["in_flight"]:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=joiner))
+    threads[1].start()
+    for thread in threads:
+        thread.join(5)
+
+    # One request, sent with the default timeout whatever the leader's budget
+    assert client.timeouts == [15]
+    assert flight.stats()["shared"] == 1
+    # The leader gave up at its own deadline, the joiner got the response
+    assert results == {"leader": None, "joiner": 200}
+
+
+def test_joiner_waits_within_its_own_budget(flight):
+    client = SlowCBClient(delay=0.5)
+    results = {}
+
+    def leader():
+        results["leader"] = client.get()
+
+    def joiner():
+        with deadline.deadline_scope(0.1):
+            started = time.monotonic()
+            results["joiner"] = client.get()
+            results["waited"] = time.monotonic() - started
+
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    while not flight.stats()["in_flight"]:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=joiner))
+    threads[1].start()
+    for thread in threads:
+        thread.join(5)
+
+    assert results["leader"] == 200
+    assert results["joiner"] is None
+    assert results["waited"] < 0.4
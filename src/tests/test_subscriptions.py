@@ -0,0 +1,169 @@
+'''
+    Change notifications posted to /hlo_de/notifications by a fake context broker
+'''
+import pytest
+from app import app
+from app.utils import continuum_utils, subscriptions
+from app.utils.lookup_cache import LookupCache
+from app.utils.subscriptions import NotificationBatcher
+from app.utils.topology import TopologyIndex
+
+testclient = pytest.importorskip("fastapi.testclient")
+
+DOMAIN_A = "urn:ngsi-ld:Domain:A"
+DOMAIN_B = "urn:ngsi-ld:Domain:B"
+LLO_A = "urn:ngsi-ld:LowLevelOrchestrator:A"
+IE_1 = "urn:ngsi-ld:InfrastructureElement:1"
+IE_2 = "urn:ngsi-ld:InfrastructureElement:2"
+
+
+def _domain(domain_id, public_url):
+    return {"id": domain_id, "type": "Domain", "publicUrl": public_url}
+
+
+def _ie(ie_id, domain_id):
+    return {
+        "id": ie_id,
+        "type": "InfrastructureElement",
+        "domain": domain_id,
+        "lowLevelOrchestrator": LLO_A
+    }
+
+
+class FakeBroker:
+    '''
+        Context broker side of the subscriptions, posting keyValues notifications
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def notify(self, *entities, subscription_type="InfrastructureElement"):
+        return self.client.post(
+            "/hlo_de/notifications",
+            json={
+                "id": "urn:ngsi-ld:Notification:1",
+                "type": "Notification",
+                "subscriptionId": subscriptions.subscription_id(
+                    subscription_type, "http://hlo-de/hlo_de/notifications"),
+                "data": list(entities)
+            })
+
+
+@pytest.fixture(name="index")
+def fixture_index(monkeypatch):
+    index = TopologyIndex()
+    for entity in (_domain(DOMAIN_A, "https://a.example.org"),
+                   _domain(DOMAIN_B, "https://b.example.org")):
+        index.update("Domain", entity)
+    index.update("InfrastructureElement", _ie(IE_1, DOMAIN_A))
+    index.update("InfrastructureElement", _ie(IE_2, DOMAIN_A))
+    monkeypatch.setattr(subscriptions, "get_topology_index", lambda: index)
+    return index
+
+
+@pytest.fixture(name="cache")
+def fixture_cache(monkeypatch):
+    cache = LookupCache()
+    monkeypatch.setattr(continuum_utils, "_cache", cache)
+    cache.store("ie_domain", IE_1, DOMAIN_A)
+    cache.store("ie_domain", IE_2, DOMAIN_A)
+    cache.store("ie_llo_type", (IE_1, True), "K8s")
+    cache.store("domain", DOMAIN_A, ("https://a.example.org", "key-a"))
+    cache.store("domain", DOMAIN_B, ("https://b.example.org", "key-b"))
+    cache.store("host_domain", "local", ("https://a.example.org", "key-a"))
+    return cache
+
+
+@pytest.fixture(name="batches")
+def fixture_batches(monkeypatch):
+    '''
+    Batches applied by a fresh process wide NotificationBatcher
+    '''
+    batches = []
+
+    def apply(entities):
+        batches.append(entities)
+        subscriptions.apply_entities(entities)
+
+    batcher = NotificationBatcher(apply=apply, debounce=0.5, max_batch=500)
+    monkeypatch.setattr(subscriptions, "_batcher", batcher)
+    yield batches
+    batcher.stop()
+
+
+@pytest.fixture(name="broker")
+def fixture_broker():
+    return FakeBroker(testclient.TestClient(app))
+
+
+def _cached(cache, kind, key) -> bool:
+    found, _ = cache.lookup(kind, key)
+    return found
+
+
+def test_burst_is_applied_once_latest_wins(broker, batches, index, cache):
+    # IE_1 moves to B and back to A then B again, all within the debounce window
+    for domain_id in (DOMAIN_B, DOMAIN_A, DOMAIN_B):
+        assert broker.notify(_ie(IE_1, domain_id)).status_code == 204
+    assert broker.notify(_domain(DOMAIN_B, "https://b2.example.org"),
+                         subscription_type="Domain").status_code == 204
+    assert subscriptions.get_notification_batcher().flush(timeout=5)
+
+    assert len(batches) == 1
+    batch, = batches
+    assert [entity["id"] for entity in batch] == [IE_1, DOMAIN_B]
+    assert batch[0]["domain"] == DOMAIN_B
+
+    assert index.domain_of(IE_1).id == DOMAIN_B
+    assert index.ies_of_domain(DOMAIN_A) == {IE_2}
+    assert index.ies_of_domain(DOMAIN_B) == {IE_1}
+    assert index.domain(DOMAIN_B).public_url == "https://b2.example.org"
+
+    # Lookups of the notified entities are dropped, the others kept
+    assert not _cached(cache, "ie_domain", IE_1)
+    assert not _cached(cache, "ie_llo_type", (IE_1, True))
+    assert not _cached(cache, "domain", DOMAIN_B)
+    assert not _cached(cache, "host_domain", "local")
+    assert _cached(cache, "ie_domain", IE_2)
+    assert _cached(cache, "domain", DOMAIN_A)
+
+    assert broker.client.get("/hlo_de/notifications/stats").json() == {
+        "notified_entities": 4,
+        "applied_entities": 2,
+        "pending_entities": 0,
+        "batches": 1
+    }
+
+
+def test_deleted_entities_are_removed(broker, batches, index, cache):
+    deleted = dict(_ie(IE_2, DOMAIN_A), deletedAt="2024-01-01T00:00:00Z")
+    assert broker.notify(deleted).status_code == 204
+    assert subscriptions.get_notification_batcher().flush(timeout=5)
+    assert len(batches) == 1
+    assert index.ie(IE_2) is None
+    assert index.ies_of_domain(DOMAIN_A) == {IE_1}
+    assert not _cached(cache, "ie_domain", IE_2)
+    assert _cached(cache, "ie_domain", IE_1)
+
+
+def test_bursts_in_separate_windows_are_separate_batches(broker, batches,
+                                                         index):
+    broker.notify(_ie(IE_1, DOMAIN_B))
+    assert subscriptions.get_notification_batcher().flush(timeout=5)
+    broker.notify(_ie(IE_1, DOMAIN_A))
+    assert subscriptions.get_notification_batcher().flush(timeout=5)
+    assert len(batches) == 2
+    assert index.domain_of(IE_1).id == DOMAIN_A
+
+
+def test_rejects_non_notifications(broker, batches):
+    response = broker.client.post("/hlo_de/notifications",
+                                  json={"type": "Notification"})
+    assert response.status_code == 400
+    response = broker.client.post(
+        "/hlo_de/notifications",
+        content=b"not json",
+        headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+    assert not batches
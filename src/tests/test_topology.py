@@ -0,0 +1,214 @@
+'''
+    TopologyIndex loaded from a fake context broker serving entities in pages
+'''
+import tracemalloc
+from urllib.parse import parse_qs
+import pytest
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from app.utils import topology
+from app.utils.topology import TopologyIndex
+
+IE_COUNT = 10000
+DOMAIN_COUNT = 10
+LLO_COUNT = 20
+PAGE_SIZE = 1000
+# Retained by the loaded index, a few MB are expected for 10k IEs
+MAX_INDEX_BYTES = 16 * 1024 * 1024
+
+
+def _domain_id(n):
+    return f"urn:ngsi-ld:Domain:{n}"
+
+
+def _llo_id(n):
+    return f"urn:ngsi-ld:LowLevelOrchestrator:{n}"
+
+
+def _ie_id(n):
+    return f"urn:ngsi-ld:InfrastructureElement:{n}"
+
+
+def _organization(n):
+    return {
+        "id": f"urn:ngsi-ld:Organization:{n}",
+        "type": "Organization",
+        "name": f"organization-{n}"
+    }
+
+
+def _domain(n):
+    return {
+        "id": _domain_id(n),
+        "type": "Domain",
+        "description": f"domain {n}",
+        "publicUrl": f"https://domain-{n}.example.org",
+        "publicKey": f"key-{n}",
+        "owner": f"urn:ngsi-ld:Organization:{n % 2}",
+        "isEntrypoint": n == 0,
+        "domainStatus": "urn:ngsi-ld:DomainStatus:Functional"
+    }
+
+
+def _llo(n):
+    return {
+        "id": _llo_id(n),
+        "type": "LowLevelOrchestrator",
+        "domain": _domain_id(n % DOMAIN_COUNT),
+        "orchestrationType": "urn:ngsi-ld:OrchestrationType:Kubernetes"
+    }
+
+
+def _ie(n):
+    return {
+        "id": _ie_id(n),
+        "type": "InfrastructureElement",
+        "domain": _domain_id(n % DOMAIN_COUNT),
+        "lowLevelOrchestrator": _llo_id(n % LLO_COUNT),
+        "hostname": f"node-{n}",
+        "containerTechnology": "urn:ngsi-ld:ContainerTechnology:Containerd",
+        "modifiedAt": "2024-01-01T00:00:00Z"
+    }
+
+
+class FakeCB:
+    '''
+        Stand-in for CBClient serving every entity type in pages.
+        Entities are built page by page, as a CB answer would be parsed,
+          so nothing but the index keeps them once a page is consumed
+    '''
+
+    counts = {
+        "Organization": (2, _organization),
+        "Domain": (DOMAIN_COUNT, _domain),
+        "LowLevelOrchestrator": (LLO_COUNT, _llo),
+        "InfrastructureElement": (IE_COUNT, _ie),
+    }
+    pages = []
+    down = False
+
+    def iter_entities(self, ngsild_params, page_size=None, prefetch=False):
+        entity_type = parse_qs(ngsild_params)["type"][0]
+        count, build = self.counts[entity_type]
+        for offset in range(0, count, page_size):
+            if FakeCB.down:
+                raise RequestsConnectionError("CB unreachable")
+            FakeCB.pages.append((entity_type, offset))
+            yield from [
+                build(n) for n in range(offset, min(offset + page_size, count))
+            ]
+
+
+@pytest.fixture(name="fake_cb")
+def fixture_fake_cb(monkeypatch):
+    FakeCB.pages = []
+    FakeCB.down = False
+    monkeypatch.setattr(topology, "CBClient", FakeCB)
+    return FakeCB
+
+
+@pytest.fixture(name="index")
+def fixture_index(fake_cb):
+    index = TopologyIndex(page_size=PAGE_SIZE)
+    assert index.load()
+    return index
+
+
+def test_load_10k_ies_in_pages_within_memory_bound(fake_cb):
+    index = TopologyIndex(page_size=PAGE_SIZE)
+    tracemalloc.start()
+    try:
+        assert index.load()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert retained < MAX_INDEX_BYTES
+    assert index.stats() == {
+        "Organization": 2,
+        "Domain": DOMAIN_COUNT,
+        "LowLevelOrchestrator": LLO_COUNT,
+        "InfrastructureElement": IE_COUNT,
+        "loads": 1,
+        "refreshes": 0
+    }
+    ie_pages = [
+        offset for entity_type, offset in fake_cb.pages
+        if entity_type == "InfrastructureElement"
+    ]
+    assert ie_pages == list(range(0, IE_COUNT, PAGE_SIZE))
+
+
+def test_forward_maps(index):
+    ie = index.ie(_ie_id(1234))
+    assert ie.domain == _domain_id(4)
+    assert ie.llo == _llo_id(14)
+    assert ie.hostname == "node-1234"
+    assert index.domain_of(_ie_id(1234)).public_url == \
+        "https://domain-4.example.org"
+    assert index.domain_of(_ie_id(1234)).public_key == "key-4"
+    assert index.llo_of(_ie_id(1234)) == _llo_id(14)
+    assert index.llo(_llo_id(14)).domain == _domain_id(4)
+    assert index.domain(_domain_id(0)).is_entrypoint
+    assert index.organization("urn:ngsi-ld:Organization:1").name == \
+        "organization-1"
+    assert index.ie(_ie_id(IE_COUNT)) is None
+    assert index.domain_of(_ie_id(IE_COUNT)) is None
+    assert index.llo_of(_ie_id(IE_COUNT)) is None
+
+
+def test_reverse_maps(index):
+    assert index.ies_of_domain(_domain_id(3)) == {
+        _ie_id(n) for n in range(3, IE_COUNT, DOMAIN_COUNT)
+    }
+    assert index.ies_of_llo(_llo_id(7)) == {
+        _ie_id(n) for n in range(7, IE_COUNT, LLO_COUNT)
+    }
+    assert sum(
+        len(index.ies_of_domain(_domain_id(n)))
+        for n in range(DOMAIN_COUNT)) == IE_COUNT
+    assert index.ies_of_domain("urn:ngsi-ld:Domain:unknown") == set()
+
+
+def test_update_moves_ie(index):
+    moved = dict(_ie(1234), domain=_domain_id(5), lowLevelOrchestrator=_llo_id(5))
+    index.update("InfrastructureElement", moved)
+    assert index.domain_of(_ie_id(1234)).id == _domain_id(5)
+    assert index.llo_of(_ie_id(1234)) == _llo_id(5)
+    assert _ie_id(1234) not in index.ies_of_domain(_domain_id(4))
+    assert _ie_id(1234) not in index.ies_of_llo(_llo_id(14))
+    assert _ie_id(1234) in index.ies_of_domain(_domain_id(5))
+    assert _ie_id(1234) in index.ies_of_llo(_llo_id(5))
+    assert index.stats()["InfrastructureElement"] == IE_COUNT
+
+
+def test_update_adds_entities(index):
+    index.update("InfrastructureElement", _ie(IE_COUNT))
+    index.update("Domain", dict(_domain(3), publicUrl="https://moved.example.org"))
+    assert index.ie(_ie_id(IE_COUNT)) is not None
+    assert _ie_id(IE_COUNT) in index.ies_of_domain(_domain_id(0))
+    assert index.domain_of(_ie_id(3)).public_url == "https://moved.example.org"
+    # Unknown types and entities without id are ignored
+    index.update("Service", {"id": "urn:ngsi-ld:Service:1"})
+    index.update("InfrastructureElement", {"domain": _domain_id(0)})
+    assert index.stats()["InfrastructureElement"] == IE_COUNT + 1
+
+
+def test_remove(index):
+    index.remove("InfrastructureElement", _ie_id(1234))
+    assert index.ie(_ie_id(1234)) is None
+    assert index.domain_of(_ie_id(1234)) is None
+    assert _ie_id(1234) not in index.ies_of_domain(_domain_id(4))
+    assert _ie_id(1234) not in index.ies_of_llo(_llo_id(14))
+    index.remove("Domain", _domain_id(4))
+    assert index.domain(_domain_id(4)) is None
+    assert index.domain_of(_ie_id(4)) is None
+    # Removing what is not indexed is a no-op
+    index.remove("InfrastructureElement", _ie_id(1234))
+    index.remove("Service", "urn:ngsi-ld:Service:1")
+    assert index.stats()["InfrastructureElement"] == IE_COUNT - 1
+
+
+def test_failed_reload_keeps_index(index, fake_cb):
+    fake_cb.down = True
+    assert not index.load()
+    assert index.stats()["InfrastructureElement"] == IE_COUNT
+    assert index.domain_of(_ie_id(1234)).id == _domain_id(4)